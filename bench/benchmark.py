@@ -0,0 +1,172 @@
+"""Replay a realistic input mix against dapp.py through the local rollup stub.
+
+    python bench/benchmark.py --population 1000 10000 100000 --inputs 5000
+    python bench/benchmark.py --population 1000 --json after.json --baseline before.json
+
+For every population size the dapp is started in a fresh process, one user
+per blockagotchi deposits Ether and creates a pet, and then the mix is
+replayed. Throughput, per-action p50/p99 latency and the peak RSS of the
+dapp process are reported.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from rollup_stub import Record, RollupStub
+
+RUN_DAPP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "run_dapp.py")
+START_TIMESTAMP = 1700000000
+
+# Relative weight of each kind of input in the replayed mix
+MIX = {
+    "feed_blockagotchi": 25,
+    "walk_blockagotchi": 15,
+    "bathe_blockagotchi": 10,
+    "buy_item": 4,
+    "apply_item": 4,
+    "batch": 6,
+    "inspect:ranking": 12,
+    "inspect:user_blockagotchi": 10,
+    "inspect:blockagotchi": 10,
+    "inspect:all_blockagotchis": 4,
+}
+FOODS = ("fish", "meat", "vegetal", "fruit")
+
+def account(index: int) -> str:
+    return "0x%040x" % (index + 1)
+
+def queue_mix(stub: RollupStub, rng: random.Random, population: int, inputs: int, timestamp: int) -> None:
+    kinds = list(MIX)
+    weights = [MIX[kind] for kind in kinds]
+    for kind in rng.choices(kinds, weights, k=inputs):
+        user = rng.randrange(population)
+        timestamp += rng.randint(0, 600)
+        if kind == "feed_blockagotchi":
+            stub.add_action(account(user), {"action": kind, "food_type": rng.choice(FOODS)}, timestamp)
+        elif kind == "walk_blockagotchi":
+            stub.add_action(account(user), {"action": kind, "walk_type": "run"}, timestamp)
+        elif kind == "bathe_blockagotchi":
+            stub.add_action(account(user), {"action": kind, "bath_type": "normal", "is_paid": rng.random() < 0.2}, timestamp)
+        elif kind in ("buy_item", "apply_item"):
+            stub.add_action(account(user), {"action": kind, "item_id": rng.randint(1, 7)}, timestamp)
+        elif kind == "batch":
+            actions = [
+                {"action": "feed_blockagotchi", "food_type": rng.choice(FOODS)},
+                {"action": "walk_blockagotchi", "walk_type": "run"},
+                {"action": "bathe_blockagotchi", "bath_type": "normal", "is_paid": False},
+            ]
+            stub.add_action(account(user), {"action": kind, "actions": actions}, timestamp)
+        elif kind == "inspect:ranking":
+            stub.add_inspect(f"ranking?limit=20&offset={rng.randrange(population)}")
+        elif kind == "inspect:user_blockagotchi":
+            stub.add_inspect(f"user_blockagotchi/{account(user)}")
+        elif kind == "inspect:blockagotchi":
+            stub.add_inspect(f"blockagotchi/{user + 1}")
+        elif kind == "inspect:all_blockagotchis":
+            stub.add_inspect(f"all_blockagotchis?cursor={user + 1}&limit=100")
+
+def peak_rss_kb(pid: int) -> int:
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)] if ordered else 0.0
+
+def summarize(records: List[Record], seconds: float) -> Dict[str, object]:
+    labels: Dict[str, List[Record]] = {}
+    for record in records:
+        labels.setdefault(record.label, []).append(record)
+    actions = {}
+    for label, group in sorted(labels.items()):
+        latencies = [record.seconds for record in group]
+        actions[label] = {
+            "count": len(group),
+            "rejected": sum(record.status != "accept" for record in group),
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "output_bytes": sum(record.output_bytes for record in group) / len(group),
+        }
+    return {"inputs": len(records), "seconds": seconds, "inputs_per_sec": len(records) / seconds if seconds else 0.0, "actions": actions}
+
+def run(population: int, inputs: int, seed: int, timeout: float) -> Dict[str, object]:
+    rng = random.Random(seed)
+    stub = RollupStub().start()
+    env = dict(os.environ, ROLLUP_HTTP_SERVER_URL=stub.url, BLOCKAGOTCHI_EGG_LIMIT=str(population))
+    dapp = subprocess.Popen([sys.executable, RUN_DAPP], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        start = time.perf_counter()
+        for user in range(population):
+            stub.add_deposit(account(user), 10 ** 6, START_TIMESTAMP)
+            stub.add_action(account(user), {"action": "create_blockagotchi", "name": f"pet{user}"}, START_TIMESTAMP)
+        if not stub.drain(timeout):
+            raise TimeoutError(f"Setup of {population} blockagotchis did not finish in {timeout}s")
+        setup_seconds = time.perf_counter() - start
+        setup_records = len(stub.records)
+
+        queue_mix(stub, rng, population, inputs, START_TIMESTAMP)
+        start = time.perf_counter()
+        if not stub.drain(timeout):
+            raise TimeoutError(f"Replay of {inputs} inputs did not finish in {timeout}s")
+        result = summarize(stub.records[setup_records:], time.perf_counter() - start)
+        result["population"] = population
+        result["setup_inputs_per_sec"] = setup_records / setup_seconds if setup_seconds else 0.0
+        result["peak_rss_kb"] = peak_rss_kb(dapp.pid)
+        return result
+    finally:
+        dapp.kill()
+        dapp.wait()
+        stub.stop()
+
+def print_result(result: Dict[str, object], baseline: Dict[str, object] = None) -> None:
+    def delta(value: float, base: float) -> str:
+        return f" ({(value - base) / base * 100:+.1f}%)" if base else ""
+
+    base = baseline or {}
+    print(f"population {result['population']}: {result['inputs_per_sec']:.1f} inputs/s{delta(result['inputs_per_sec'], base.get('inputs_per_sec', 0))}, "
+          f"setup {result['setup_inputs_per_sec']:.1f} inputs/s, peak RSS {result['peak_rss_kb'] / 1024:.1f} MiB{delta(result['peak_rss_kb'], base.get('peak_rss_kb', 0))}")
+    print(f"  {'input':<28}{'count':>8}{'rejected':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for label, stats in result["actions"].items():
+        base_stats = base.get("actions", {}).get(label, {})
+        print(f"  {label:<28}{stats['count']:>8}{stats['rejected']:>10}{stats['p50_ms']:>10.3f}{stats['p99_ms']:>10.3f}{delta(stats['p99_ms'], base_stats.get('p99_ms', 0))}")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--population", type=int, nargs="+", default=[1000])
+    parser.add_argument("--inputs", type=int, default=2000, help="inputs replayed after the population is created")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=3600.0)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--baseline", help="compare against results previously written with --json")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = {str(result["population"]): result for result in json.load(file)}
+
+    results = []
+    for population in args.population:
+        result = run(population, args.inputs, args.seed, args.timeout)
+        print_result(result, baseline.get(str(population)))
+        results.append(result)
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+if __name__ == "__main__":
+    main()
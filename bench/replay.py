@@ -0,0 +1,131 @@
+"""Rebuild state from snapshots and the input journal, with no rollup server.
+
+    python bench/replay.py --journal /data/journal --snapshots /data/snapshots
+    python bench/replay.py --journal /data/journal --snapshots /data/snapshots --from 120000 --to 130000
+    python bench/replay.py --journal /data/journal --snapshots /data/snapshots --workers 8 --verify
+
+The state just before --from is rebuilt from the nearest snapshot plus the
+journal, then inputs --from to --to are replayed at full speed and
+throughput and per-action p50/p99 latency are reported for that range. The
+digest and the state root of the final state are printed so they can be
+compared with the state_digest and state_root inspect routes of a live node.
+With --workers the range is replayed by a pool of processes, each handling
+the inputs of a shard of users, and merged; see sharded_replay.py.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "handlers", "advance"), os.path.join(ROOT, "handlers", "inspect")]
+
+from advance_handler import AdvanceHandler
+from history import HistoryStore
+from journal import read_journal, recover, replay
+from metrics import metrics
+from rollup_client import OfflineRollupClient
+from sharded_replay import replay_sharded
+from snapshot import state_digest
+from user import GlobalState
+
+ETHER_PORTAL_ADDRESS = "0xFfdbe43d4c855BF7e0f105c400A50857f53AB044"
+DAO_ADDRESS = "0x0000000000000000000000000000000000000000"
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--journal", required=True, help="journal directory (JOURNAL_DIR of the dapp)")
+    parser.add_argument("--snapshots", help="snapshot directory (SNAPSHOT_DIR of the dapp)")
+    parser.add_argument("--history", help="history directory (HISTORY_DIR of the dapp, by default <snapshots>/history), only read")
+    parser.add_argument("--from", dest="start", type=int, default=None, help="first input of the measured range")
+    parser.add_argument("--to", dest="stop", type=int, default=None, help="last input to replay")
+    parser.add_argument("--egg-limit", type=int, help="egg limit the inputs were originally handled with")
+    parser.add_argument("--workers", type=int, default=1, help="replay the range with this many processes, sharded by user")
+    parser.add_argument("--verify", action="store_true", help="with --workers, also replay sequentially and compare the state digests")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.egg_limit is not None:
+        AdvanceHandler.EGG_LIMIT = args.egg_limit
+    rollup = OfflineRollupClient()
+    handler = AdvanceHandler(rollup, ETHER_PORTAL_ADDRESS, DAO_ADDRESS)
+    state = GlobalState().get_state()
+    history_dir = args.history or (os.path.join(args.snapshots, "history") if args.snapshots else None)
+    if history_dir and os.path.isdir(history_dir):
+        # Records past the restored snapshot are rebuilt in memory, leaving the files untouched
+        state["history"] = HistoryStore(history_dir, writable=False)
+
+    start = time.perf_counter()
+    if args.start is None:
+        last_input_index = recover(handler.handle, state, args.snapshots, None, args.stop)
+    else:
+        last_input_index = recover(handler.handle, state, args.snapshots, args.journal, args.start - 1)
+    print(f"recovered state at input {last_input_index} in {time.perf_counter() - start:.3f}s")
+
+    metrics.reset()
+    rollup.outputs = rollup.output_bytes = 0
+    inputs = 0
+
+    def handle(data: dict) -> str:
+        nonlocal inputs
+        inputs += 1
+        status = handler.handle(data)
+        rollup.flush()
+        return status
+
+    start = time.perf_counter()
+    sharded = None
+    if args.workers > 1:
+        records = list(read_journal(args.journal, last_input_index + 1, args.stop))
+        sharded = replay_sharded(records, args.workers, ETHER_PORTAL_ADDRESS, DAO_ADDRESS, args.verify)
+        inputs = len(records)
+        if records:
+            last_input_index = max(last_input_index, records[-1][0])
+    else:
+        last_input_index = max(last_input_index, replay(handle, read_journal(args.journal, last_input_index + 1, args.stop)))
+    seconds = time.perf_counter() - start
+
+    result = {
+        "last_input_index": last_input_index,
+        "inputs": inputs,
+        "seconds": seconds,
+        "inputs_per_sec": inputs / seconds if seconds else 0.0,
+        "outputs": rollup.outputs,
+        "output_bytes": rollup.output_bytes,
+        "digest": state_digest(state),
+        "state_root": "0x" + state["merkle"].root().hex(),
+        "metrics": metrics.to_dict(),
+    }
+    if sharded is None:
+        print(f"replayed {inputs} inputs up to {last_input_index} in {seconds:.3f}s ({result['inputs_per_sec']:.1f} inputs/s), "
+              f"{rollup.outputs} outputs")
+        print(f"  {'action':<28}{'count':>8}{'p50 ms':>10}{'p99 ms':>10}")
+        for name, histogram in sorted(metrics.histograms.items()):
+            if name.startswith("advance.") and histogram.bounds is not histogram.BYTES:
+                stats = histogram.to_dict()
+                print(f"  {name[len('advance.'):]:<28}{stats['count']:>8}{stats['p50'] * 1000:>10.3f}{stats['p99'] * 1000:>10.3f}")
+    else:
+        result["sharded"] = sharded
+        print(f"replayed {inputs} inputs up to {last_input_index} in {seconds:.3f}s ({result['inputs_per_sec']:.1f} inputs/s) "
+              f"with {args.workers} shards, run {sharded['runs']} times" + (" to settle statuses and the egg limit" if sharded["egg_cutoff"] is not None else " to settle statuses"))
+        print(f"  {'shard':<28}{'inputs':>8}{'accepted':>10}")
+        for shard in sharded["shards"]:
+            print(f"  {shard['shard']:<28}{shard['inputs']:>8}{shard['accepted']:>10}")
+    print(f"state digest {result['digest']}")
+    print(f"state root {result['state_root']}")
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(result, file, indent=2)
+
+    if sharded is not None and "sequential_digest" in sharded:
+        matches = sharded["sequential_digest"] == result["digest"] and sharded["sequential_state_root"] == result["state_root"]
+        print(f"sequential digest {sharded['sequential_digest']} ({'matches' if matches else 'DIFFERS'})")
+        if not matches:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
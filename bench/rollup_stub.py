@@ -0,0 +1,164 @@
+"""Local stand-in for the Cartesi rollup HTTP server.
+
+It serves /finish, /notice, /report and /voucher to an unmodified dapp.py,
+hands out scripted advance and inspect inputs and records, for every input,
+the status the dapp finished it with, how long it took and how many outputs
+it produced.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Empty, Queue
+from typing import Dict, List, Optional
+
+ETHER_PORTAL_ADDRESS = "0xFfdbe43d4c855BF7e0f105c400A50857f53AB044"
+
+def str_to_hex(s: str) -> str:
+    return "0x" + s.encode("utf-8").hex()
+
+def ether_deposit_payload(account: str, amount: int) -> str:
+    # EtherPortal input: packed depositor address followed by a uint256 amount
+    return "0x" + bytes.fromhex(account[2:]).hex() + amount.to_bytes(32, "big").hex()
+
+class Record:
+    __slots__ = ("label", "request_type", "status", "seconds", "notices", "reports", "output_bytes")
+
+    def __init__(self, label: str, request_type: str):
+        self.label = label
+        self.request_type = request_type
+        self.status: Optional[str] = None
+        self.seconds = 0.0
+        self.notices = 0
+        self.reports = 0
+        self.output_bytes = 0
+
+class RollupStub:
+    IDLE_WAIT = 0.05
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.inputs: Queue = Queue()
+        self.records: List[Record] = []
+        self.input_index = 0
+        self.current: Optional[Record] = None
+        self.started = 0.0
+        self.pending = 0
+        self.idle = threading.Condition()
+        self.server = ThreadingHTTPServer((host, port), self.make_handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "RollupStub":
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_advance(self, sender: str, payload: str, timestamp: int, label: str) -> None:
+        data = {
+            "metadata": {
+                "msg_sender": sender,
+                "epoch_index": 0,
+                "input_index": self.input_index,
+                "block_number": self.input_index,
+                "timestamp": timestamp,
+            },
+            "payload": payload,
+        }
+        self.input_index += 1
+        self.enqueue({"request_type": "advance_state", "data": data}, label)
+
+    def add_action(self, sender: str, action: dict, timestamp: int) -> None:
+        self.add_advance(sender, str_to_hex(json.dumps(action)), timestamp, action["action"])
+
+    def add_deposit(self, account: str, amount: int, timestamp: int) -> None:
+        self.add_advance(ETHER_PORTAL_ADDRESS, ether_deposit_payload(account, amount), timestamp, "ether_deposit")
+
+    def add_inspect(self, path: str) -> None:
+        label = "inspect:" + path.split("?", 1)[0].split("/", 1)[0]
+        self.enqueue({"request_type": "inspect_state", "data": {"payload": str_to_hex(path)}}, label)
+
+    def enqueue(self, request: dict, label: str) -> None:
+        with self.idle:
+            self.pending += 1
+        self.inputs.put((request, label))
+
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every queued input has been finished by the dapp."""
+        with self.idle:
+            return self.idle.wait_for(lambda: self.pending == 0, timeout)
+
+    def finish(self, body: dict) -> Optional[dict]:
+        now = time.perf_counter()
+        if self.current is not None:
+            self.current.status = body.get("status")
+            self.current.seconds = now - self.started
+            self.records.append(self.current)
+            self.current = None
+            with self.idle:
+                self.pending -= 1
+                self.idle.notify_all()
+        try:
+            request, label = self.inputs.get(timeout=self.IDLE_WAIT)
+        except Empty:
+            return None
+        self.current = Record(label, request["request_type"])
+        self.started = time.perf_counter()
+        return request
+
+    def output(self, kind: str, body: dict) -> None:
+        if self.current is None:
+            return
+        if kind == "notice":
+            self.current.notices += 1
+        elif kind == "report":
+            self.current.reports += 1
+        self.current.output_bytes += max(len(body.get("payload", "")) // 2 - 1, 0)
+
+    def make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Send headers and body in one segment so keep-alive requests
+            # are not held back by delayed ACKs
+            disable_nagle_algorithm = True
+            wbufsize = 1 << 16
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                endpoint = self.path.rstrip("/").rsplit("/", 1)[-1]
+                if endpoint == "finish":
+                    request = stub.finish(body)
+                    if request is None:
+                        self.respond(202, None)
+                    else:
+                        self.respond(200, request)
+                elif endpoint in ("notice", "report", "voucher"):
+                    stub.output(endpoint, body)
+                    self.respond(200 if endpoint == "report" else 201, {"index": 0} if endpoint != "report" else None)
+                else:
+                    self.respond(404, None)
+
+            def respond(self, code: int, body: Optional[Dict]) -> None:
+                data = json.dumps(body).encode("utf-8") if body is not None else b""
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                try:
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
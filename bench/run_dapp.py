@@ -0,0 +1,18 @@
+"""Run the unmodified dapp.py with the handler modules on the path.
+
+The egg limit can be raised through BLOCKAGOTCHI_EGG_LIMIT so benchmarks can
+create populations larger than the production limit.
+"""
+import os
+import runpy
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "handlers", "advance"), os.path.join(ROOT, "handlers", "inspect")]
+
+from advance_handler import AdvanceHandler
+
+if "BLOCKAGOTCHI_EGG_LIMIT" in os.environ:
+    AdvanceHandler.EGG_LIMIT = int(os.environ["BLOCKAGOTCHI_EGG_LIMIT"])
+
+runpy.run_path(os.path.join(ROOT, "dapp.py"), run_name="__main__")
@@ -0,0 +1,242 @@
+"""Replay journaled inputs in parallel, one forked process per shard of users.
+
+    python bench/replay.py --journal /data/journal --snapshots /data/snapshots --workers 8 --verify
+
+Apart from the deadlines, an advance input only changes its sender: their
+user, their blockagotchi and their balance, Ether deposits belonging to the
+depositor. Inputs are partitioned by that user, and every shard starts from
+a copy of the recovered state. A shard handles its own inputs, and at the
+time of every other accepted input it runs the deadlines of its own
+blockagotchis, so each blockagotchi ages exactly as it would sequentially.
+Every input gets the state version it would get sequentially.
+
+A rejected input is rolled back whole, deadlines and state version
+included, so shards need to know which inputs of the other shards were
+rejected. They start out assuming every input is accepted and report the
+status of their own inputs; while any status differs from the assumed one
+the shards are run again with the reported statuses. An input's status
+only depends on the inputs before it, so each run settles at least the
+statuses up to the first wrong one, and in practice the second run agrees.
+
+What crosses users is merged afterwards, sequentially and in input order:
+
+- Blockagotchi ids and the egg count. Shards number new blockagotchis after
+  the input ordinal, and the successful creations are renumbered by input
+  index. If they overrun the egg limit, the shards are run again with every
+  creation after the one that reached it rejected; nothing before it changes.
+  The statuses are settled first, and again after the cutoff.
+- The activity history and the leaderboards. Shards only record the care
+  actions, which are appended and scored here.
+- Balances. Shards report their balance changes, which are added up; only
+  the DAO receives from several shards, and it is never debited. Balance
+  checks only read the sender's own balance, so inputs sent by the DAO
+  address are refused.
+
+The merged state is then re-encoded and restored like a snapshot, which
+rebuilds the indexes. ``--verify`` also replays the inputs sequentially in
+another process and compares the state digests.
+"""
+import multiprocessing
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+from advance_handler import AdvanceHandler
+from blockagotchi import BlockaGotchi, get_current_time, set_input_time
+from rollup_client import OfflineRollupClient
+from snapshot import dump_state, restore_state, state_digest
+from user import GlobalState, User
+
+Record = Tuple[int, dict]
+
+# Inputs to replay and the shard of each, inherited by the forked workers
+_records: List[Record] = []
+_shards: List[int] = []
+
+class ShardError(Exception):
+    pass
+
+def input_user(data: dict, ether_portal_address: str) -> str:
+    sender = data["metadata"]["msg_sender"].lower()
+    if sender == ether_portal_address.lower():
+        # The depositor is the first 20 bytes of an Ether deposit
+        return "0x" + data["payload"][2:42].lower()
+    return sender
+
+def shard_of(user_id: str, shards: int) -> int:
+    return zlib.crc32(user_id.encode("utf-8")) % shards
+
+class ShardResult:
+    def __init__(self, shard: int):
+        self.shard = shard
+        self.inputs = 0
+        self.accepted = 0
+        # (ordinal, accepted) of every input of the shard
+        self.statuses: List[Tuple[int, bool]] = []
+        # Blockagotchis and users changed or created by the shard
+        self.blockagotchis: List[BlockaGotchi] = []
+        self.users: List[User] = []
+        # Ether balance changes by address
+        self.balances: Dict[str, int] = {}
+        # (input index, blockagotchi) of every successful creation
+        self.created: List[Tuple[int, BlockaGotchi]] = []
+        # (input index, blockagotchi, user id, points, kind, detail, time, flag) of every care action
+        self.care: List[tuple] = []
+
+class ShardHandler(AdvanceHandler):
+    """Handles the inputs of one shard, recording care actions for the merge instead of applying them."""
+    def __init__(self, rollup: OfflineRollupClient, ether_portal_address: str, dao_address: str, care: List[tuple]):
+        super().__init__(rollup, ether_portal_address, dao_address)
+        self.input_index = -1
+        self.care = care
+
+    def record_care(self, user: User, happiness: int, kind: int, detail: str, flag: bool = False) -> None:
+        blockagotchi = user.blockagotchi
+        self.care.append((self.input_index, blockagotchi, user.id, blockagotchi.happiness - happiness, kind, detail, get_current_time(), flag))
+
+    def process(self, data: dict) -> Tuple[str, str]:
+        # A rejected input is rolled back, care actions included
+        recorded = len(self.care)
+        action, status = super().process(data)
+        if status != "accept":
+            del self.care[recorded:]
+        return action, status
+
+def run_shard(shard: int, shards: int, ether_portal_address: str, dao_address: str, cutoff: Optional[int],
+              assumed: List[bool]) -> ShardResult:
+    state = GlobalState().get_state()
+    result = ShardResult(shard)
+    handler = ShardHandler(OfflineRollupClient(), ether_portal_address, dao_address, result.care)
+    changes = state["changes"]
+    base_version = changes.version
+    base_next_id = state["next_blockagotchi_id"]
+    base_users = set(state["users"])
+    base_blockagotchis = set(state["blockagotchis"])
+    base_balances = {address: balance._ether for address, balance in state["wallet"]._accounts.items()}
+
+    scheduler = state["scheduler"]
+    scheduler.clear()
+    for blockagotchi in state["blockagotchis"].values():
+        if shard_of(blockagotchi.owner, shards) == shard:
+            scheduler.schedule(blockagotchi)
+
+    version = base_version
+    for ordinal, ((input_index, data), owner, accepted) in enumerate(zip(_records, _shards, assumed)):
+        changes.version = version
+        version += accepted
+        if owner != shard:
+            if accepted:
+                set_input_time(data["metadata"].get("timestamp"))
+                changes.begin()
+                handler.process_deadlines()
+            continue
+        # Only the egg limit cutoff decides whether a creation is let through
+        state["global_eggs"] = 0 if cutoff is None or input_index <= cutoff else handler.EGG_LIMIT
+        provisional_id = state["next_blockagotchi_id"] = base_next_id + ordinal
+        handler.input_index = input_index
+        result.inputs += 1
+        status = handler.handle(data) == "accept"
+        result.accepted += status
+        result.statuses.append((ordinal, status))
+        handler.rollup.flush()
+        if state["next_blockagotchi_id"] != provisional_id:
+            result.created.append((input_index, state["blockagotchis"][provisional_id]))
+
+    result.blockagotchis = [blockagotchi for blockagotchi_id, blockagotchi in state["blockagotchis"].items()
+                            if blockagotchi.version > base_version or blockagotchi_id not in base_blockagotchis]
+    result.users = [user for user_id, user in state["users"].items() if user.version > base_version or user_id not in base_users]
+    for address, balance in state["wallet"]._accounts.items():
+        delta = balance._ether - base_balances.get(address, 0)
+        if delta:
+            result.balances[address] = delta
+    return result
+
+def replay_sequential(ether_portal_address: str, dao_address: str) -> Tuple[str, str]:
+    """Digest and state root after replaying every input in order."""
+    state = GlobalState().get_state()
+    handler = AdvanceHandler(OfflineRollupClient(), ether_portal_address, dao_address)
+    for _, data in _records:
+        handler.handle(data)
+        handler.rollup.flush()
+    return state_digest(state), "0x" + state["merkle"].root().hex()
+
+def merge(state: dict, results: List[ShardResult], created: List[Tuple[int, BlockaGotchi]], accepted: int) -> None:
+    next_id = state["next_blockagotchi_id"]
+    for rank, (_, blockagotchi) in enumerate(created):
+        blockagotchi.id = next_id + rank
+
+    blockagotchis = state["blockagotchis"]
+    users = state["users"]
+    wallet = state["wallet"]
+    for result in results:
+        for blockagotchi in result.blockagotchis:
+            blockagotchis[blockagotchi.id] = blockagotchi
+        for user in result.users:
+            users[user.id] = user
+        for address, delta in result.balances.items():
+            balance = wallet.balance_get(address)
+            if delta > 0:
+                balance._ether_increase(delta)
+            else:
+                balance._ether_decrease(-delta)
+
+    # Every input belongs to a single shard, so a stable sort keeps the order within an input
+    care = sorted((entry for result in results for entry in result.care), key=lambda entry: entry[0])
+    history = state["history"]
+    leaderboards = state["leaderboards"]
+    for _, blockagotchi, user_id, points, kind, detail, now, flag in care:
+        history.append(blockagotchi, kind, detail, now, flag)
+        leaderboards.record(user_id, points, now)
+
+    state["global_eggs"] += len(created)
+    state["next_blockagotchi_id"] += len(created)
+    state["changes"].version += accepted
+    # Users still pointing at a blockagotchi a shard replaced are relinked by id
+    restore_state(state, dump_state(state))
+
+def replay_sharded(records: List[Record], workers: int, ether_portal_address: str, dao_address: str,
+                   verify: bool = False) -> dict:
+    """Replay ``records`` on the global state with ``workers`` shards and merge the results into it."""
+    global _records, _shards
+    state = GlobalState().get_state()
+    shards = [shard_of(input_user(data, ether_portal_address), workers) for _, data in records]
+    for input_index, data in records:
+        if data["metadata"]["msg_sender"].lower() == dao_address.lower():
+            raise ShardError(f"Input {input_index} is sent by the DAO address, whose balance is shared by every shard")
+    _records, _shards = records, shards
+
+    # One fresh fork of the recovered state per task
+    context = multiprocessing.get_context("fork")
+    with context.Pool(workers + verify, maxtasksperchild=1) as pool:
+        sequential = pool.apply_async(replay_sequential, (ether_portal_address, dao_address)) if verify else None
+        cutoff = None
+        assumed = [True] * len(records)
+        runs = 0
+        while True:
+            results = pool.starmap(run_shard, [(shard, workers, ether_portal_address, dao_address, cutoff, assumed)
+                                               for shard in range(workers)])
+            runs += 1
+            statuses = list(assumed)
+            for result in results:
+                for ordinal, accepted in result.statuses:
+                    statuses[ordinal] = accepted
+            if statuses != assumed:
+                assumed = statuses
+                continue
+            created = sorted((entry for result in results for entry in result.created), key=lambda entry: entry[0])
+            room = AdvanceHandler.EGG_LIMIT - state["global_eggs"]
+            if cutoff is not None or len(created) <= room:
+                break
+            cutoff = created[room - 1][0] if room > 0 else -1
+        merge(state, results, created, sum(assumed))
+        expected = sequential.get() if sequential is not None else None
+    _records, _shards = [], []
+
+    report = {
+        "shards": [{"shard": result.shard, "inputs": result.inputs, "accepted": result.accepted} for result in results],
+        "runs": runs,
+        "egg_cutoff": cutoff,
+        "digest": state_digest(state),
+    }
+    if expected is not None:
+        report["sequential_digest"], report["sequential_state_root"] = expected
+    return report
@@ -1,135 +1,322 @@
-from datetime import datetime, timedelta
-import logging
-from typing import Dict, Optional, List
-from shop import Item
+from array import array
+from datetime import datetime, timezone
+from functools import lru_cache
+import json
+from operator import attrgetter
+import time
+from typing import Callable, Dict, Optional, List
+from logs import log
+from shop import Inventory, Item
 
-logger = logging.getLogger(__name__)
+# Stage, type, biotype and condition are stored as small integer codes
+# indexing these tables.
+STAGES = ("Blob", "Child", "Teen", "Adult", "Old")
+TYPES = (None, "Cat", "Dog", "Bird", "Tiger", "Lion", "Wolf", "Pigeon", "Eagle", "Duck")
+BIOTYPES = ("Normal", "Fat", "Skinny")
+CONDITIONS = ("Normal", "Muscle", "Sedentary")
 
-def get_current_time() -> datetime:
-    return datetime.utcnow()
+STAGE_CODES = {name: code for code, name in enumerate(STAGES)}
+TYPE_CODES = {name: code for code, name in enumerate(TYPES)}
+BIOTYPE_CODES = {name: code for code, name in enumerate(BIOTYPES)}
+CONDITION_CODES = {name: code for code, name in enumerate(CONDITIONS)}
 
-def datetime_to_str(dt: datetime) -> str:
-    return dt.strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+BLOB, CHILD, TEEN, ADULT, OLD = range(len(STAGES))
 
-def str_to_datetime(s: str) -> datetime:
-    return datetime.strptime(s, "%Y-%m-%dT%H:%M:%S.%fZ")
+# Foods counted in diet_counts, which decide the type. Any other food is
+# accepted and only counts towards feed_count; the full feeding history is
+# kept in the history store, see history.py.
+DIET_FOODS = ("fish", "meat", "vegetal")
+DIET_CODES: Dict[str, int] = {food_type: code for code, food_type in enumerate(DIET_FOODS)}
+
+# Times are integer seconds since the Unix epoch, and ages and deadlines are
+# whole multiples of DAY.
+DAY = 24 * 60 * 60
+
+# Block time of the advance input being processed. Taking time from the input
+# rather than the wall clock makes replaying the same inputs deterministic.
+input_time: Optional[int] = None
+
+def set_input_time(timestamp: Optional[int]) -> None:
+    global input_time
+    input_time = timestamp
+
+def get_current_time() -> int:
+    return input_time if input_time is not None else int(time.time())
+
+@lru_cache(maxsize=1 << 16)
+def epoch_to_str(seconds: int) -> str:
+    # Many blockagotchis share the time of the input that touched them
+    return datetime.fromtimestamp(seconds, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+def str_to_epoch(s: str) -> int:
+    return int(datetime.strptime(s, "%Y-%m-%dT%H:%M:%S.%fZ").replace(tzinfo=timezone.utc).timestamp())
+
+class WalkWindow:
+    """Walk counts for the last DAYS days, kept in a ring of daily buckets."""
+    DAYS = 30
+    __slots__ = ("counts", "last_day", "total")
+
+    def __init__(self):
+        self.counts = array("I", [0] * self.DAYS)
+        self.last_day = 0
+        self.total = 0
+
+    def copy(self) -> "WalkWindow":
+        window = WalkWindow.__new__(WalkWindow)
+        window.counts = array("I", self.counts)
+        window.last_day = self.last_day
+        window.total = self.total
+        return window
+
+    def advance(self, day: int) -> None:
+        # Evict the buckets of the days that fell out of the window
+        if day <= self.last_day:
+            return
+        if day - self.last_day >= self.DAYS:
+            if self.total:
+                self.counts = array("I", [0] * self.DAYS)
+                self.total = 0
+        else:
+            for expired in range(self.last_day + 1, day + 1):
+                slot = expired % self.DAYS
+                self.total -= self.counts[slot]
+                self.counts[slot] = 0
+        self.last_day = day
+
+    def add(self, day: int) -> None:
+        self.advance(day)
+        self.counts[day % self.DAYS] += 1
+        self.total += 1
+
+    def count(self, day: int) -> int:
+        self.advance(day)
+        return self.total
 
 class BlockaGotchi:
-    def __init__(self, owner: str, name: str, birth_time: datetime, id: int):
+    __slots__ = (
+        "id", "owner", "name", "birth_time", "age", "stage_code", "type_code",
+        "biotype_code", "condition_code", "happiness", "last_fed_time",
+        "last_walk_time", "last_bath_time", "alive", "feed_count", "diet_counts",
+        "items", "walk_window", "overall_score", "version", "history_head", "history_count", "history", "_payload",
+    )
+
+    # Called with the blockagotchi whenever its overall score changes
+    score_listeners: List[Callable[["BlockaGotchi"], None]] = []
+    # Called with the blockagotchi whenever any of its fields changes
+    change_listeners: List[Callable[["BlockaGotchi"], None]] = []
+
+    def __init__(self, owner: str, name: str, birth_time: int, id: int):
         self.id = id
         self.owner = owner
         self.name = name
         self.birth_time = birth_time
         self.age = self.get_age()
-        self.stage = "Blob"
-        self.type = None
-        self.biotype = "Normal"
-        self.condition = "Normal"
+        self.stage_code = BLOB
+        self.type_code = TYPE_CODES[None]
+        self.biotype_code = BIOTYPE_CODES["Normal"]
+        self.condition_code = CONDITION_CODES["Normal"]
         self.happiness = 50
-        self.last_fed_time = get_current_time()
-        self.last_walk_time = get_current_time()
-        self.last_bath_time = get_current_time()
+        current_time = get_current_time()
+        self.last_fed_time = current_time
+        self.last_walk_time = current_time
+        self.last_bath_time = current_time
         self.alive = True
-        self.food_history: List[str] = []
-        self.items: List[Item] = []
-        self.walk_dates: List[datetime] = []
+        self.feed_count = 0
+        self.diet_counts = array("I", [0] * len(DIET_FOODS))
+        # Items worn, at most one of each
+        self.items = Inventory()
+        self.walk_window = WalkWindow()
         self.overall_score = self.calculate_overall_score()
+        # State version of the last change, see changes.ChangeLog
+        self.version = 0
+        # Position of the newest record in the history store and the number of records
+        self.history_head = -1
+        self.history_count = 0
+        # History store holding those records, set by the store itself
+        self.history = None
+        # Cached hex-encoded JSON of to_dict(), cleared by mark_dirty()
+        self._payload: Optional[str] = None
+
+    @property
+    def stage(self) -> str:
+        return STAGES[self.stage_code]
+
+    @stage.setter
+    def stage(self, stage: str) -> None:
+        self.stage_code = STAGE_CODES[stage]
+
+    @property
+    def type(self) -> Optional[str]:
+        return TYPES[self.type_code]
+
+    @type.setter
+    def type(self, type: Optional[str]) -> None:
+        self.type_code = TYPE_CODES[type]
+
+    @property
+    def biotype(self) -> str:
+        return BIOTYPES[self.biotype_code]
+
+    @biotype.setter
+    def biotype(self, biotype: str) -> None:
+        self.biotype_code = BIOTYPE_CODES[biotype]
+
+    @property
+    def condition(self) -> str:
+        return CONDITIONS[self.condition_code]
+
+    @condition.setter
+    def condition(self, condition: str) -> None:
+        self.condition_code = CONDITION_CODES[condition]
+
+    def food_count(self, food_type: str) -> int:
+        # Only the diet foods are counted in memory
+        code = DIET_CODES.get(food_type)
+        return 0 if code is None else self.diet_counts[code]
+
+    def mark_dirty(self) -> None:
+        self._payload = None
+        for listener in self.change_listeners:
+            listener(self)
+
+    def copy_fields(self) -> tuple:
+        """Values of every field, copying the mutable ones, for restore_fields()."""
+        fields = tuple(getattr(self, name) for name in SAVED_FIELDS)
+        return fields + (array("I", self.diet_counts), self.items.copy(), self.walk_window.copy())
+
+    def restore_fields(self, fields: tuple) -> None:
+        """Put back the fields saved by copy_fields() and notify the listeners."""
+        for name, value in zip(SAVED_FIELDS + ("diet_counts", "items", "walk_window"), fields):
+            setattr(self, name, value)
+        self.mark_dirty()
+        for listener in self.score_listeners:
+            listener(self)
+
+    def food_history(self) -> List[str]:
+        """Food types of every feed, oldest first, read back from the history store."""
+        return [] if self.history is None else self.history.foods(self)
+
+    def to_payload(self) -> str:
+        """Hex-encoded JSON of to_dict(), without the 0x prefix."""
+        if self._payload is None:
+            self._payload = json.dumps(self.to_dict()).encode("utf-8").hex()
+        return self._payload
 
     def get_age(self) -> int:
-        return (get_current_time() - self.birth_time).days
+        return (get_current_time() - self.birth_time) // DAY
 
     def update_age(self) -> None:
-        self.age = self.get_age()
+        age = self.get_age()
+        if age != self.age:
+            self.age = age
+            self.mark_dirty()
         self.update_overall_score()
 
     def update_happiness(self, change: int) -> None:
         self.happiness += change
+        self.mark_dirty()
         self.update_overall_score()
 
     def calculate_overall_score(self) -> int:
         return self.age + self.happiness
 
     def update_overall_score(self) -> None:
-        self.overall_score = self.calculate_overall_score()
+        overall_score = self.calculate_overall_score()
+        if overall_score != self.overall_score:
+            self.overall_score = overall_score
+            self.mark_dirty()
+            for listener in self.score_listeners:
+                listener(self)
 
     def feed(self, food_type: str) -> None:
         self.last_fed_time = get_current_time()
-        self.food_history.append(food_type)
+        self.feed_count += 1
+        code = DIET_CODES.get(food_type)
+        if code is not None:
+            self.diet_counts[code] += 1
+        self.mark_dirty()
         self.update_happiness(10)
         self.evolve()
-        logger.info(f"{self.name} was fed with {food_type}.")
+        log.debug("blockagotchi", "fed", blockagotchi_id=self.id, food_type=food_type)
         self.update_biotype()
     
     def walk(self, walk_type: str) -> None:
         current_time = get_current_time()
         self.last_walk_time = current_time
-        self.walk_dates.append(current_time)
+        self.walk_window.add(current_time // DAY)
+        self.mark_dirty()
         self.update_happiness(5)
         self.evolve()
-        logger.info(f"{self.name} went for a {walk_type} walk.")
+        log.debug("blockagotchi", "walked", blockagotchi_id=self.id, walk_type=walk_type)
         self.update_condition()
 
     def bathe(self, bath_type: str, is_paid: bool) -> None:
         self.last_bath_time = get_current_time()
+        self.mark_dirty()
         if is_paid:
             # TODO: Transfer tokens to DAO
             self.update_happiness(20)
         else:
             self.update_happiness(8)
         self.evolve()
-        logger.info(f"{self.name} had a {bath_type} bath. Paid: {is_paid}")
+        log.debug("blockagotchi", "bathed", blockagotchi_id=self.id, bath_type=bath_type, is_paid=is_paid)
 
     def add_item(self, item: Item) -> None:
-        self.items.append(item)
-        logger.info(f"{self.name} received item {item.name}.")
+        self.items.add(item)
+        self.mark_dirty()
+        log.debug("blockagotchi", "item_added", blockagotchi_id=self.id, item_id=item.item_id)
 
     def remove_item(self, item: Item) -> None:
-        self.items.remove(item)
-        logger.info(f"{self.name} lost item {item.name}.")
+        self.items.remove(item.item_id)
+        self.mark_dirty()
+        log.debug("blockagotchi", "item_removed", blockagotchi_id=self.id, item_id=item.item_id)
 
     def list_items(self) -> List[Dict[str, any]]:
-        return [item.to_dict() for item in self.items]
+        return [item.to_dict() for item, quantity in self.items.entries() for _ in range(quantity)]
 
     def evolve(self) -> None:
         self.update_age()
         age = self.age
+        stage = self.stage_code
 
-        if self.stage == "Blob" and age >= 3:
-            self.stage = "Child"
+        if stage == BLOB and age >= 3:
+            self.stage_code = CHILD
             self.type = self.determine_type()
-            logger.info(f"{self.name} has evolved to Child stage as a {self.type}.")
-        elif self.stage == "Child" and age >= 7:
-            self.stage = "Teen"
-            logger.info(f"{self.name} has evolved to Teen stage as a {self.type}.")
-        elif self.stage == "Teen" and age >= 14:
-            self.stage = "Adult"
+        elif stage == CHILD and age >= 7:
+            self.stage_code = TEEN
+        elif stage == TEEN and age >= 14:
+            self.stage_code = ADULT
             self.type = self.determine_adult_type()
-            logger.info(f"{self.name} has evolved to Adult stage as a {self.type}.")
-        elif self.stage == "Adult" and age >= 21:
-            self.stage = "Old"
-            logger.info(f"{self.name} has evolved to Old stage as a {self.type}.")
+        elif stage == ADULT and age >= 21:
+            self.stage_code = OLD
+        if self.stage_code != stage:
+            self.mark_dirty()
+            log.debug("blockagotchi", "evolved", blockagotchi_id=self.id, stage=self.stage, type=self.type)
 
     def determine_type(self) -> Optional[str]:
-        if self.food_history.count('fish') > max(self.food_history.count('meat'), self.food_history.count('vegetal')):
+        fish, meat, vegetal = self.diet_counts
+        if fish > max(meat, vegetal):
             return 'Cat'
-        elif self.food_history.count('meat') > max(self.food_history.count('fish'), self.food_history.count('vegetal')):
+        elif meat > max(fish, vegetal):
             return "Dog"
         else:
             return "Bird"
 
     def determine_adult_type(self) -> Optional[str]:
-        if self.stage == "Teen":
-            if self.type == "Cat":
-                if self.food_history.count("Fish") > self.food_history.count('meat'):
+        fish, meat, vegetal = self.diet_counts
+        if self.stage_code == TEEN:
+            type = self.type
+            if type == "Cat":
+                if self.food_count("Fish") > meat:
                     return "Tiger"
                 else:
                     return "Lion"
-            elif self.type == "Dog":
+            elif type == "Dog":
                 return "Wolf"
-            elif self.type == "Bird":
-                if self.food_history.count('vegetal') > max(self.food_history.count('meat'), self.food_history.count('fish')):
+            elif type == "Bird":
+                if vegetal > max(meat, fish):
                     return "Pigeon"
-                elif self.food_history.count('meat') > max(self.food_history.count('fish'), self.food_history.count('vegetal')):
+                elif meat > max(fish, vegetal):
                     return "Eagle"
                 else:
                     return "Duck"
@@ -137,49 +324,69 @@ class BlockaGotchi:
 
 
     def update_biotype(self) -> None:
-        feeding_frequency = len(self.food_history) / (self.get_age() + 1)
+        # Called right after evolve(), so the age is current
+        feeding_frequency = self.feed_count / (self.age + 1)
         if feeding_frequency > 2:
-            self.biotype = "Fat"
+            biotype = BIOTYPE_CODES["Fat"]
         elif feeding_frequency < 1:
-            self.biotype = "Skinny"
+            biotype = BIOTYPE_CODES["Skinny"]
         else:
-            self.biotype = "Normal"
+            biotype = BIOTYPE_CODES["Normal"]
+        if biotype != self.biotype_code:
+            self.biotype_code = biotype
+            self.mark_dirty()
 
     def update_condition(self) -> None:
-        # Filter walk dates for the last 30 days
-        thirty_days_ago = get_current_time() - timedelta(days=30)
-        recent_walks = [date for date in self.walk_dates if date >= thirty_days_ago]
-
-        walking_frequency = (get_current_time() - self.last_walk_time).days
-        if walking_frequency <= 1 and len(recent_walks) >= 20:
-            self.condition = "Muscle"
-        elif walking_frequency <= 3 and len(recent_walks) >= 10:
-            self.condition = "Normal"
+        # Walks over the last 30 days
+        current_time = get_current_time()
+        recent_walks = self.walk_window.count(current_time // DAY)
+
+        walking_frequency = (current_time - self.last_walk_time) // DAY
+        if walking_frequency <= 1 and recent_walks >= 20:
+            condition = CONDITION_CODES["Muscle"]
+        elif walking_frequency <= 3 and recent_walks >= 10:
+            condition = CONDITION_CODES["Normal"]
         else:
-            self.condition = "Sedentary"
+            condition = CONDITION_CODES["Sedentary"]
+        if condition != self.condition_code:
+            self.condition_code = condition
+            self.mark_dirty()
 
     def check_status(self) -> None:
-        if (get_current_time() - self.last_fed_time).days > 7:
+        if (get_current_time() - self.last_fed_time) // DAY > 7:
             self.alive = False
-            logger.info(f"{self.name} has died due to neglect.")
+            self.mark_dirty()
+            log.debug("blockagotchi", "died", blockagotchi_id=self.id)
 
     def to_dict(self) -> Dict[str, any]:
-        return {
-            "id": self.id,
-            "owner": self.owner,
-            "name": self.name,
-            "birth_time": datetime_to_str(self.birth_time),
-            "age": self.age,
-            "stage": self.stage,
-            "type": self.type,
-            "biotype": self.biotype,
-            "condition": self.condition,
-            "happiness": self.happiness,
-            "last_fed_time": datetime_to_str(self.last_fed_time),
-            "last_walk_time": datetime_to_str(self.last_walk_time),
-            "last_bath_time": datetime_to_str(self.last_bath_time),
-            "alive": self.alive,
-            "food_history": self.food_history,
-            "items": self.list_items(),
-            "overall_score": self.overall_score
-        }
+        return {name: getter(self) for name, getter in FIELDS.items()}
+
+    def to_fields(self, fields: List[str]) -> Dict[str, any]:
+        """Projection of to_dict() on the given field names."""
+        return {name: FIELDS[name](self) for name in fields}
+
+# Fields copy_fields() saves as they are; the arrays and the items are copied
+SAVED_FIELDS = tuple(name for name in BlockaGotchi.__slots__ if name not in ("diet_counts", "items", "walk_window", "history", "_payload"))
+
+# to_dict() fields in order, with the getter of each one
+FIELDS: Dict[str, Callable[[BlockaGotchi], any]] = {
+    "id": attrgetter("id"),
+    "owner": attrgetter("owner"),
+    "name": attrgetter("name"),
+    "birth_time": lambda blockagotchi: epoch_to_str(blockagotchi.birth_time),
+    "age": attrgetter("age"),
+    "stage": attrgetter("stage"),
+    "type": attrgetter("type"),
+    "biotype": attrgetter("biotype"),
+    "condition": attrgetter("condition"),
+    "happiness": attrgetter("happiness"),
+    "last_fed_time": lambda blockagotchi: epoch_to_str(blockagotchi.last_fed_time),
+    "last_walk_time": lambda blockagotchi: epoch_to_str(blockagotchi.last_walk_time),
+    "last_bath_time": lambda blockagotchi: epoch_to_str(blockagotchi.last_bath_time),
+    "alive": attrgetter("alive"),
+    "food_history": BlockaGotchi.food_history,
+    "feed_count": attrgetter("feed_count"),
+    "items": BlockaGotchi.list_items,
+    "overall_score": attrgetter("overall_score"),
+    "version": attrgetter("version"),
+}
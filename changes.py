@@ -0,0 +1,92 @@
+from typing import Dict, List, Set, Tuple
+
+class ChangeLog:
+    """Global state version and the blockagotchis and users in order of their last change.
+
+    The version goes up by one for every advance input. Each blockagotchi
+    and user changed while an input is handled is stamped with its version
+    and moved to the end of an insertion-ordered dict, so the entities
+    changed after a given version are found by walking back from the end,
+    in time proportional to the number of changes.
+
+    Entities whose changes were rolled back get their earlier version back
+    but stay where the rolled back change moved them. They are kept aside as
+    displaced until they change again, and walks step over them.
+    """
+    def __init__(self):
+        self.version = 0
+        self._blockagotchis: Dict[int, "BlockaGotchi"] = {}
+        self._users: Dict[str, "User"] = {}
+        self._displaced_blockagotchis: Set[int] = set()
+        self._displaced_users: Set[str] = set()
+
+    def clear(self, version: int = 0) -> None:
+        self.version = version
+        self._blockagotchis = {}
+        self._users = {}
+        self._displaced_blockagotchis = set()
+        self._displaced_users = set()
+
+    def begin(self) -> int:
+        """Start the version of the next advance input."""
+        self.version += 1
+        return self.version
+
+    def touch_blockagotchi(self, blockagotchi: "BlockaGotchi") -> None:
+        if blockagotchi.version == self.version and blockagotchi.id in self._blockagotchis:
+            return
+        blockagotchi.version = self.version
+        self._blockagotchis.pop(blockagotchi.id, None)
+        self._blockagotchis[blockagotchi.id] = blockagotchi
+        self._displaced_blockagotchis.discard(blockagotchi.id)
+
+    def touch_user(self, user: "User") -> None:
+        if user.version == self.version and user.id in self._users:
+            return
+        user.version = self.version
+        self._users.pop(user.id, None)
+        self._users[user.id] = user
+        self._displaced_users.discard(user.id)
+
+    def restore_blockagotchi(self, blockagotchi: "BlockaGotchi", version: int) -> None:
+        """Stamp a blockagotchi whose changes were rolled back with its earlier ``version``."""
+        self.touch_blockagotchi(blockagotchi)
+        blockagotchi.version = version
+        self._displaced_blockagotchis.add(blockagotchi.id)
+
+    def restore_user(self, user: "User", version: int) -> None:
+        self.touch_user(user)
+        user.version = version
+        self._displaced_users.add(user.id)
+
+    def remove_blockagotchi(self, blockagotchi_id: int) -> None:
+        self._blockagotchis.pop(blockagotchi_id, None)
+        self._displaced_blockagotchis.discard(blockagotchi_id)
+
+    def remove_user(self, user_id: str) -> None:
+        self._users.pop(user_id, None)
+        self._displaced_users.discard(user_id)
+
+    def add(self, blockagotchis: List["BlockaGotchi"], users: List["User"]) -> None:
+        """Track restored entities, keeping the versions they were stamped with."""
+        for blockagotchi in sorted(blockagotchis, key=lambda blockagotchi: (blockagotchi.version, blockagotchi.id)):
+            self._blockagotchis[blockagotchi.id] = blockagotchi
+        for user in sorted(users, key=lambda user: (user.version, user.id)):
+            self._users[user.id] = user
+
+    def since(self, version: int) -> Tuple[List["BlockaGotchi"], List["User"]]:
+        """Blockagotchis and users changed after ``version``, oldest change first."""
+        return (self.changed(self._blockagotchis, self._displaced_blockagotchis, version),
+                self.changed(self._users, self._displaced_users, version))
+
+    def changed(self, entities: dict, displaced: set, version: int) -> list:
+        changed = []
+        for entity in reversed(entities.values()):
+            if entity.version <= version:
+                if entity.id in displaced:
+                    continue
+                break
+            changed.append(entity)
+        # Entities changed by the same input come out in id order, as after a restore
+        changed.sort(key=lambda entity: (entity.version, entity.id))
+        return changed
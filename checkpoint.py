@@ -0,0 +1,123 @@
+"""Undo log putting the state back as it was before a rejected input.
+
+A rejected input makes the rollup discard every change the input made,
+but a host process keeps running on the same objects. Before an input is
+handled the handler saves what it can change: the sender's user with its
+blockagotchi and leaderboard points, the balances that can move, the
+history position and the global counters, and then each blockagotchi the
+scheduler finds due. ``rollback`` writes these back in place and removes
+the blockagotchis and users created since, and the indexes, scheduler,
+change log and Merkle trees follow.
+"""
+from typing import Dict, List, Optional, Tuple
+
+from blockagotchi import BlockaGotchi
+
+class Checkpoint:
+    def __init__(self, state: dict):
+        self.state = state
+        history = state["history"]
+        self.globals = (state["global_eggs"], state["next_blockagotchi_id"], state["changes"].version)
+        self.history = (len(history), history.chain)
+        self.boards = [(board, board.window, board.ranking, board.final_window, board.final)
+                       for board in state["leaderboards"].boards.values()]
+        # Saved fields and version of each blockagotchi, by id
+        self.blockagotchis: Dict[int, Tuple[BlockaGotchi, tuple, int]] = {}
+        # Saved user, or None for a user that did not exist yet
+        self.users: Dict[str, Optional[tuple]] = {}
+        # Leaderboard points of each saved user, one per board
+        self.points: Dict[str, List[Optional[int]]] = {}
+        # Saved balance, or None for an account that did not exist yet
+        self.accounts: Dict[str, Optional[tuple]] = {}
+        # Blockagotchis taken off the scheduler and their deadlines
+        self.deadlines: List[Tuple[BlockaGotchi, int]] = []
+
+    def save_blockagotchi(self, blockagotchi: BlockaGotchi) -> None:
+        if blockagotchi.id not in self.blockagotchis:
+            self.blockagotchis[blockagotchi.id] = (blockagotchi, blockagotchi.copy_fields(), blockagotchi.version)
+
+    def save_deadline(self, blockagotchi: BlockaGotchi, deadline: int) -> None:
+        self.save_blockagotchi(blockagotchi)
+        self.deadlines.append((blockagotchi, deadline))
+
+    def save_user(self, user_id: str) -> None:
+        if user_id in self.users:
+            return
+        user = self.state["users"].get(user_id)
+        if user is None:
+            self.users[user_id] = None
+        else:
+            self.users[user_id] = (user, user.blockagotchi, user.items.copy(), user.version)
+            if user.blockagotchi is not None:
+                self.save_blockagotchi(user.blockagotchi)
+        self.points[user_id] = [board.ranking.score(user_id) for board, *_ in self.boards]
+
+    def save_account(self, address: str) -> None:
+        if address in self.accounts:
+            return
+        balance = self.state["wallet"]._accounts.get(address)
+        self.accounts[address] = None if balance is None else (
+            balance._ether, dict(balance._erc20), {token: set(ids) for token, ids in balance._erc721.items()})
+
+    def rollback(self) -> None:
+        state = self.state
+        global_eggs, next_blockagotchi_id, version = self.globals
+        changes = state["changes"]
+        merkle = state["merkle"]
+
+        blockagotchis = state["blockagotchis"]
+        for blockagotchi_id in range(next_blockagotchi_id, state["next_blockagotchi_id"]):
+            if blockagotchis.pop(blockagotchi_id, None) is None:
+                continue
+            state["ranking"].remove(blockagotchi_id)
+            state["scheduler"].remove(blockagotchi_id)
+            state["columns"].remove(blockagotchi_id)
+            state["indexes"].remove(blockagotchi_id)
+            changes.remove_blockagotchi(blockagotchi_id)
+            merkle.remove_blockagotchi(blockagotchi_id)
+        for blockagotchi, fields, blockagotchi_version in self.blockagotchis.values():
+            blockagotchi.restore_fields(fields)
+            changes.restore_blockagotchi(blockagotchi, blockagotchi_version)
+        for blockagotchi, deadline in self.deadlines:
+            state["scheduler"].restore(blockagotchi, deadline)
+
+        users = state["users"]
+        for user_id, saved in self.users.items():
+            if saved is None:
+                if users.pop(user_id, None) is not None:
+                    changes.remove_user(user_id)
+                    merkle.remove_user(user_id)
+                continue
+            user, blockagotchi, items, user_version = saved
+            user.blockagotchi = blockagotchi
+            user.items = items
+            user.mark_changed()
+            changes.restore_user(user, user_version)
+
+        wallet_accounts = state["wallet"]._accounts
+        for address, saved in self.accounts.items():
+            balance = wallet_accounts.get(address)
+            if balance is None:
+                continue
+            if saved is None:
+                balance._ether, balance._erc20, balance._erc721 = 0, {}, {}
+                del wallet_accounts[address]
+            else:
+                balance._ether, balance._erc20, balance._erc721 = saved
+            merkle.touch_account(balance)
+
+        state["history"].rewind(*self.history)
+        for position, (board, window, ranking, final_window, final) in enumerate(self.boards):
+            board.window = window
+            board.ranking = ranking
+            board.final_window = final_window
+            board.final = final
+            for user_id, points in self.points.items():
+                if points[position] is None:
+                    board.ranking.remove(user_id)
+                else:
+                    board.ranking.set(user_id, points[position])
+
+        state["global_eggs"] = global_eggs
+        state["next_blockagotchi_id"] = next_blockagotchi_id
+        changes.version = version
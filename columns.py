@@ -0,0 +1,185 @@
+from array import array
+from typing import Dict, List
+
+from blockagotchi import BlockaGotchi, BIOTYPES, CONDITIONS, DAY, STAGES, TYPES
+
+# Optional: not in requirements.txt, as there are no riscv64 wheels for the
+# Cartesi machine image. Without it the stats are computed in plain Python.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class PopulationColumns:
+    """Columnar mirror of the blockagotchi fields used by aggregate queries.
+
+    Each field is an ``array`` with one row per blockagotchi, in creation
+    order. A mutation only records the blockagotchi as changed; its row is
+    rewritten before the next query. Aggregates run on zero-copy NumPy
+    views of the columns when NumPy is installed and fall back to plain
+    Python loops over the same arrays otherwise.
+    """
+    COLUMNS = (
+        ("id", "I"),
+        ("age", "i"),
+        ("happiness", "q"),
+        ("overall_score", "q"),
+        ("stage", "B"),
+        ("type", "B"),
+        ("biotype", "B"),
+        ("condition", "B"),
+        ("alive", "B"),
+        ("last_fed", "q"),
+    )
+
+    def __init__(self):
+        self.columns: Dict[str, array] = {name: array(typecode) for name, typecode in self.COLUMNS}
+        self._rows: Dict[int, int] = {}
+        self._changed: Dict[int, BlockaGotchi] = {}
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def clear(self) -> None:
+        self.columns = {name: array(typecode) for name, typecode in self.COLUMNS}
+        self._rows = {}
+        self._changed = {}
+
+    def values(self, blockagotchi: BlockaGotchi) -> tuple:
+        return (
+            blockagotchi.id, blockagotchi.age, blockagotchi.happiness, blockagotchi.overall_score,
+            blockagotchi.stage_code, blockagotchi.type_code, blockagotchi.biotype_code, blockagotchi.condition_code,
+            blockagotchi.alive, blockagotchi.last_fed_time,
+        )
+
+    def add(self, blockagotchi: BlockaGotchi) -> None:
+        if blockagotchi.id in self._rows:
+            self.touch(blockagotchi)
+            return
+        self._rows[blockagotchi.id] = len(self._rows)
+        for column, value in zip(self.columns.values(), self.values(blockagotchi)):
+            column.append(value)
+
+    def remove(self, blockagotchi_id: int) -> None:
+        """Drop the row of a blockagotchi; the last row moves into its place."""
+        self._changed.pop(blockagotchi_id, None)
+        row = self._rows.pop(blockagotchi_id, None)
+        if row is None:
+            return
+        last = len(self._rows)
+        if row != last:
+            self._rows[self.columns["id"][last]] = row
+        for column in self.columns.values():
+            column[row] = column[last]
+            column.pop()
+
+    def touch(self, blockagotchi: BlockaGotchi) -> None:
+        self._changed[blockagotchi.id] = blockagotchi
+
+    def sync(self) -> None:
+        changed, self._changed = self._changed, {}
+        columns = list(self.columns.values())
+        for blockagotchi in changed.values():
+            row = self._rows.get(blockagotchi.id)
+            if row is None:
+                self.add(blockagotchi)
+                continue
+            for column, value in zip(columns, self.values(blockagotchi)):
+                column[row] = value
+
+    def stats(self, now: int, bin_width: int) -> dict:
+        """Population aggregates; ``bin_width`` sets the overall score histogram buckets."""
+        self.sync()
+        if not self._rows:
+            return {"population": 0}
+        if numpy is not None:
+            return self.numpy_stats(now, bin_width)
+        return self.python_stats(now, bin_width)
+
+    def numpy_stats(self, now: int, bin_width: int) -> dict:
+        c = {name: numpy.frombuffer(column, dtype=column.typecode) for name, column in self.columns.items()}
+        alive = c["alive"].astype(bool)
+        biotype_counts = numpy.bincount(c["biotype"], minlength=len(BIOTYPES))
+        biotype_happiness = numpy.bincount(c["biotype"], weights=c["happiness"], minlength=len(BIOTYPES))
+        scores = c["overall_score"]
+        start = int(scores.min()) // bin_width * bin_width
+        unfed = now - c["last_fed"][alive]
+        return summarize(
+            population=len(scores),
+            alive=int(alive.sum()),
+            stages=numpy.bincount(c["stage"], minlength=len(STAGES)).tolist(),
+            types=numpy.bincount(c["type"], minlength=len(TYPES)).tolist(),
+            conditions=numpy.bincount(c["condition"], minlength=len(CONDITIONS)).tolist(),
+            biotype_counts=biotype_counts.tolist(),
+            biotype_happiness=[int(total) for total in biotype_happiness],
+            happiness=(int(c["happiness"].sum()), int(c["happiness"].min()), int(c["happiness"].max())),
+            scores=(int(scores.sum()), int(scores.min()), int(scores.max())),
+            histogram=(start, numpy.bincount((scores - start) // bin_width).tolist()),
+            unfed=(int(unfed.sum()), int(unfed.max())) if len(unfed) else (0, 0),
+            bin_width=bin_width,
+        )
+
+    def python_stats(self, now: int, bin_width: int) -> dict:
+        c = self.columns
+        stages = [0] * len(STAGES)
+        types = [0] * len(TYPES)
+        conditions = [0] * len(CONDITIONS)
+        biotype_counts = [0] * len(BIOTYPES)
+        biotype_happiness = [0] * len(BIOTYPES)
+        for code in c["stage"]:
+            stages[code] += 1
+        for code in c["type"]:
+            types[code] += 1
+        for code in c["condition"]:
+            conditions[code] += 1
+        for code, happiness in zip(c["biotype"], c["happiness"]):
+            biotype_counts[code] += 1
+            biotype_happiness[code] += happiness
+        scores = c["overall_score"]
+        start = min(scores) // bin_width * bin_width
+        histogram = [0] * ((max(scores) - start) // bin_width + 1)
+        for score in scores:
+            histogram[(score - start) // bin_width] += 1
+        unfed = [now - last_fed for last_fed, alive in zip(c["last_fed"], c["alive"]) if alive]
+        return summarize(
+            population=len(scores),
+            alive=sum(c["alive"]),
+            stages=stages,
+            types=types,
+            conditions=conditions,
+            biotype_counts=biotype_counts,
+            biotype_happiness=biotype_happiness,
+            happiness=(sum(c["happiness"]), min(c["happiness"]), max(c["happiness"])),
+            scores=(sum(scores), min(scores), max(scores)),
+            histogram=(start, histogram),
+            unfed=(sum(unfed), max(unfed)) if unfed else (0, 0),
+            bin_width=bin_width,
+        )
+
+def summarize(population: int, alive: int, stages: List[int], types: List[int], conditions: List[int],
+              biotype_counts: List[int], biotype_happiness: List[int], happiness: tuple, scores: tuple,
+              histogram: tuple, unfed: tuple, bin_width: int) -> dict:
+    return {
+        "population": population,
+        "alive": alive,
+        "alive_ratio": alive / population,
+        "stages": dict(zip(STAGES, stages)),
+        # Blobs have no type yet
+        "types": {name: count for name, count in zip(TYPES, types) if name is not None},
+        "conditions": dict(zip(CONDITIONS, conditions)),
+        "biotypes": {
+            name: {"count": count, "average_happiness": total / count if count else 0}
+            for name, count, total in zip(BIOTYPES, biotype_counts, biotype_happiness)
+        },
+        "happiness": {"mean": happiness[0] / population, "min": happiness[1], "max": happiness[2]},
+        "overall_score": {
+            "mean": scores[0] / population,
+            "min": scores[1],
+            "max": scores[2],
+            "histogram": {"start": histogram[0], "bin_width": bin_width, "counts": histogram[1]},
+        },
+        "days_since_fed": {
+            "mean": unfed[0] / alive / DAY if alive else 0,
+            "max": unfed[1] / DAY,
+        },
+    }
@@ -1,6 +1,13 @@
 import logging
-import requests
-from os import environ
+import time
+from os import environ, makedirs, path
+from logs import log
+from metrics import metrics
+from rollup_client import OfflineRollupClient, RollupClient
+from user import GlobalState
+from history import HistoryStore
+import journal
+import snapshot
 from advance_handler import AdvanceHandler
 from inspect_handler import InspectHandler
 
@@ -16,8 +23,44 @@ dapp_relay_address = "0xF5DE34d6BbC0446E2a45719E718efEbaaE179daE"
 ether_portal_address = "0xFfdbe43d4c855BF7e0f105c400A50857f53AB044"
 dao_address = "0x0000000000000000000000000000000000000000"
 
-advance_handler = AdvanceHandler(rollup_server, ether_portal_address, dao_address)
-inspect_handler = InspectHandler(rollup_server)
+rollup = RollupClient(rollup_server)
+
+# Optional journal of every advance input, and snapshots written every
+# SNAPSHOT_INTERVAL advance inputs as its checkpoints. On startup the state
+# is rebuilt from the latest snapshot plus the journal tail. The status and
+# outputs of every input are recorded too, and the inputs the state already
+# contains are answered with them instead of being handled again.
+journal_dir = environ.get("JOURNAL_DIR")
+snapshot_dir = environ.get("SNAPSHOT_DIR")
+snapshot_interval = int(environ.get("SNAPSHOT_INTERVAL", "0"))
+last_recovered_input = -1
+output_journal = None
+if snapshot_dir:
+    makedirs(snapshot_dir, exist_ok=True)
+
+# Full history segments are kept in HISTORY_DIR, by default next to the
+# snapshots that refer to them. Without either, history stays in memory.
+history_dir = environ.get("HISTORY_DIR") or (path.join(snapshot_dir, "history") if snapshot_dir else None)
+if history_dir:
+    GlobalState().get_state()["history"] = HistoryStore(history_dir)
+if snapshot_dir or journal_dir:
+    outputs_dir = journal.outputs_dir(journal_dir or snapshot_dir)
+    # Directories written before outputs were recorded are recovered whole.
+    # Otherwise recovery stops at the last input whose outputs were recorded,
+    # as the rollup delivers the inputs after it again.
+    recorded_outputs = path.isdir(outputs_dir)
+    output_journal = journal.OutputJournal(outputs_dir)
+    recovery_handler = AdvanceHandler(OfflineRollupClient(), ether_portal_address, dao_address)
+    last_recovered_input = journal.recover(recovery_handler.handle, GlobalState().get_state(), snapshot_dir, journal_dir,
+                                           output_journal.last_input_index if recorded_outputs else None)
+    metrics.reset()
+
+# With STATE_ROOT_NOTICES=1 every accepted input ends with a notice of the
+# Merkle root of the state, see merkle.py
+state_root_notices = environ.get("STATE_ROOT_NOTICES", "0") == "1"
+advance_handler = AdvanceHandler(rollup, ether_portal_address, dao_address, journal.Journal(journal_dir) if journal_dir else None,
+                                 state_root_notices)
+inspect_handler = InspectHandler(rollup)
 
 handlers = {
     "advance_state": advance_handler.handle,
@@ -26,13 +69,33 @@ handlers = {
 finish = {"status": "accept"}
 
 while True:
-    logger.info("Sending finish")
-    response = requests.post(rollup_server + "/finish", json=finish)
-    logger.info(f"Received finish status {response.status_code}")
+    response = rollup.finish(finish)
+    log.debug("dapp", "finish", sent=finish["status"], status=response.status_code)
     if response.status_code == 202:
-        logger.info("No pending rollup request, trying again")
+        log.debug("dapp", "idle")
     else:
+        start = time.perf_counter()
         rollup_request = response.json()
         data = rollup_request["data"]
+        input_index = data.get("metadata", {}).get("input_index")
+        if input_index is not None and input_index <= last_recovered_input:
+            recorded = output_journal.recorded(input_index)
+            if recorded is None:
+                logger.warning(f"Skipping input {input_index}, already in the recovered state but without recorded outputs")
+                finish["status"] = "accept"
+            else:
+                logger.info(f"Skipping input {input_index}, already in the recovered state, and sending its recorded outputs")
+                for endpoint, payload in recorded["outputs"]:
+                    getattr(rollup, endpoint)(payload)
+                finish["status"] = recorded["status"]
+            continue
         handler = handlers[rollup_request["request_type"]]
         finish["status"] = handler(data)
+        if output_journal is not None and input_index is not None:
+            output_journal.record(input_index, finish["status"], rollup.pending)
+        rollup.flush()
+        metrics.observe(f"loop.{rollup_request['request_type']}", time.perf_counter() - start)
+        if snapshot_dir and snapshot_interval and input_index is not None and (input_index + 1) % snapshot_interval == 0:
+            with metrics.timer("snapshot.write"):
+                digest = snapshot.write_snapshot(snapshot.snapshot_path(snapshot_dir, input_index), GlobalState().get_state(), input_index)
+            logger.info(f"Wrote snapshot at input {input_index} with digest {digest}")
@@ -0,0 +1,98 @@
+"""Minimal MessagePack encoder for compact inspect reports.
+
+Covers the types reports are made of: None, bool, int, float, str, bytes,
+lists, tuples and dicts. The output is standard MessagePack, so clients can
+decode it with any MessagePack library. Headers are exposed separately so
+pre-encoded elements can be spliced into arrays and maps.
+"""
+import struct
+from typing import Any, Callable, List
+
+def pack(obj: Any) -> bytes:
+    chunks: List[bytes] = []
+    pack_into(obj, chunks.append)
+    return b"".join(chunks)
+
+def array_header(length: int) -> bytes:
+    if length < 16:
+        return bytes((0x90 | length,))
+    if length < 1 << 16:
+        return struct.pack(">BH", 0xdc, length)
+    return struct.pack(">BI", 0xdd, length)
+
+def map_header(length: int) -> bytes:
+    if length < 16:
+        return bytes((0x80 | length,))
+    if length < 1 << 16:
+        return struct.pack(">BH", 0xde, length)
+    return struct.pack(">BI", 0xdf, length)
+
+def pack_int(value: int) -> bytes:
+    if 0 <= value < 128:
+        return bytes((value,))
+    if -32 <= value < 0:
+        return bytes((value & 0xff,))
+    if value >= 0:
+        if value < 1 << 8:
+            return struct.pack(">BB", 0xcc, value)
+        if value < 1 << 16:
+            return struct.pack(">BH", 0xcd, value)
+        if value < 1 << 32:
+            return struct.pack(">BI", 0xce, value)
+        if value < 1 << 64:
+            return struct.pack(">BQ", 0xcf, value)
+    else:
+        if value >= -(1 << 7):
+            return struct.pack(">Bb", 0xd0, value)
+        if value >= -(1 << 15):
+            return struct.pack(">Bh", 0xd1, value)
+        if value >= -(1 << 31):
+            return struct.pack(">Bi", 0xd2, value)
+        if value >= -(1 << 63):
+            return struct.pack(">Bq", 0xd3, value)
+    raise ValueError(f"Integer {value} does not fit in 64 bits")
+
+def pack_str(value: str) -> bytes:
+    data = value.encode("utf-8")
+    length = len(data)
+    if length < 32:
+        return bytes((0xa0 | length,)) + data
+    if length < 1 << 8:
+        return struct.pack(">BB", 0xd9, length) + data
+    if length < 1 << 16:
+        return struct.pack(">BH", 0xda, length) + data
+    return struct.pack(">BI", 0xdb, length) + data
+
+def pack_into(obj: Any, write: Callable[[bytes], Any]) -> None:
+    if obj is None:
+        write(b"\xc0")
+    elif obj is True:
+        write(b"\xc3")
+    elif obj is False:
+        write(b"\xc2")
+    elif isinstance(obj, int):
+        write(pack_int(obj))
+    elif isinstance(obj, str):
+        write(pack_str(obj))
+    elif isinstance(obj, float):
+        write(struct.pack(">Bd", 0xcb, obj))
+    elif isinstance(obj, (list, tuple)):
+        write(array_header(len(obj)))
+        for value in obj:
+            pack_into(value, write)
+    elif isinstance(obj, dict):
+        write(map_header(len(obj)))
+        for key, value in obj.items():
+            pack_into(key, write)
+            pack_into(value, write)
+    elif isinstance(obj, (bytes, bytearray)):
+        length = len(obj)
+        if length < 1 << 8:
+            write(struct.pack(">BB", 0xc4, length))
+        elif length < 1 << 16:
+            write(struct.pack(">BH", 0xc5, length))
+        else:
+            write(struct.pack(">BI", 0xc6, length))
+        write(bytes(obj))
+    else:
+        raise TypeError(f"Cannot pack {type(obj).__name__}")
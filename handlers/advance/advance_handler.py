@@ -1,24 +1,41 @@
 import logging
 import json
-import requests
+import time
 from urllib.parse import urlparse
-from blockagotchi import BlockaGotchi, get_current_time
+from blockagotchi import BlockaGotchi, get_current_time, set_input_time
 from user import User, GlobalState
 from shop import Item, Shop
+from rollup_client import RollupClient
+from journal import Journal
+from checkpoint import Checkpoint
+from history import BATH, FEED, WALK
+from registry import Field, Registry, Route
+from metrics import metrics
+from logs import log
+from typing import Optional, Tuple
 from cartesi_wallet.util import hex_to_str, str_to_hex
 
 logger = logging.getLogger(__name__)
 
+action_registry = Registry()
+
 class AdvanceHandler:
     EGG_LIMIT = 1000
-    GLOBAL_IDS = 1
+    BATCH_LIMIT = 16
+    MAX_ITEM_QUANTITY = 1000
 
-    def __init__(self, rollup_server: str, ether_portal_address: str, dao_address: str):
-        self.rollup_server = rollup_server
+    def __init__(self, rollup: RollupClient, ether_portal_address: str, dao_address: str, journal: Optional[Journal] = None,
+                 state_root_notices: bool = False):
+        self.rollup = rollup
+        self.journal = journal
+        # Close every accepted input with a notice of the state root
+        self.state_root_notices = state_root_notices
         self.ether_portal_address = ether_portal_address
         self.dao_address = dao_address
         self.state = GlobalState().get_state()
         self.wallet = self.state["wallet"]
+        # While a batch runs, notices and reports are collected here instead of being posted
+        self.batch_outputs = None
 
     def encode(self, d: dict) -> str:
         return "0x" + json.dumps(d).encode("utf-8").hex()
@@ -29,64 +46,185 @@ class AdvanceHandler:
         return d
 
     def create_notice(self, payload: str) -> bool:
-        try:
-            response = requests.post(self.rollup_server + "/notice", json={"payload": payload})
-            logger.info(f"Received notice status {response.status_code} body {response.content}")
-            return response.status_code == 200
-        except Exception as error:
-            logger.error(f"Failed to create notice. {error}")
-            return False
+        if self.batch_outputs is not None:
+            self.batch_outputs["notices"].append(payload)
+            return True
+        self.rollup.notice(payload)
+        return True
 
     def create_report(self, payload: str) -> bool:
+        if self.batch_outputs is not None:
+            self.batch_outputs["reports"].append(payload)
+            return True
+        self.rollup.report(payload)
+        return True
+
+    def handle(self, data: dict) -> str:
+        metadata = data["metadata"]
+        log.debug("advance", "input", input_index=metadata.get("input_index"), sender=metadata["msg_sender"], payload_bytes=len(data["payload"]) // 2 - 1)
+        if self.journal is not None:
+            self.journal.append(data)
+        start = time.perf_counter()
+        checkpoint = self.checkpoint(data)
+        set_input_time(data["metadata"].get("timestamp"))
+        self.state["changes"].begin()
+        with metrics.timer("advance.deadlines"):
+            self.process_deadlines(checkpoint)
+        action, status = self.process(data)
+        if status != "accept":
+            # The rollup discards every change of a rejected input, deadlines included
+            with metrics.timer("advance.rollback"):
+                checkpoint.rollback()
+        if self.state_root_notices and status == "accept":
+            with metrics.timer("advance.state_root"):
+                root = self.state["merkle"].root()
+            self.create_notice(self.encode({"event": "state_root", "version": self.state["changes"].version, "root": "0x" + root.hex()}))
+        metrics.record("advance", action, status, time.perf_counter() - start)
+        return status
+
+    def checkpoint(self, data: dict) -> Checkpoint:
+        """Save what an input can change, so it can be rolled back if rejected."""
+        checkpoint = Checkpoint(self.state)
+        sender = data["metadata"]["msg_sender"].lower()
+        if sender == self.ether_portal_address.lower():
+            # The depositor is the first 20 bytes of an Ether deposit
+            checkpoint.save_account("0x" + data["payload"][2:42].lower())
+        else:
+            checkpoint.save_user(sender)
+            checkpoint.save_account(sender)
+            checkpoint.save_account(self.dao_address)
+        return checkpoint
+
+    def process_deadlines(self, checkpoint: Optional[Checkpoint] = None) -> None:
+        """Age, evolve and kill the blockagotchis whose deadlines have passed."""
         try:
-            response = requests.post(self.rollup_server + "/report", json={"payload": payload})
-            logger.info(f"Received report status {response.status_code} body {response.content}")
-            return response.status_code == 200
+            before = None if checkpoint is None else checkpoint.save_deadline
+            for event in self.state["scheduler"].run(get_current_time(), before):
+                self.create_notice(self.encode(event))
+                log.info("advance", event["event"], user_id=event["user_id"], blockagotchi_id=event["blockagotchi_id"])
         except Exception as error:
-            logger.error(f"Failed to create report. {error}")
-            return False
+            logger.error(f"Failed to process blockagotchi deadlines. {error}", exc_info=True)
+            log.dump("Blockagotchi deadlines failed")
 
-    def handle(self, data: dict) -> str:
-        logger.info(f"Received advance request data {data}")
+    def process(self, data: dict) -> Tuple[str, str]:
         msg_sender = data["metadata"]["msg_sender"]
         payload = data["payload"]
+        metrics.observe_size("advance.payload_bytes", len(payload) // 2 - 1)
 
         try:
             notice = None
             if msg_sender.lower() == self.ether_portal_address.lower():
-                notice = self.wallet.ether_deposit_process(payload)
+                with metrics.timer("advance.mutate"):
+                    notice = self.wallet.ether_deposit_process(payload)
+                    self.touch_accounts(self.decode_json(notice.payload)["content"]["address"])
                 self.create_notice(notice.payload)
-                return "accept"
+                return "ether_deposit", "accept"
         except Exception as error:
             error_msg = f"Failed to process command '{payload}'. {error}"
             self.create_report(self.encode(error_msg))
             logger.debug(error_msg, exc_info=True)
-            return "reject"
+            log.dump("Ether deposit failed")
+            return "ether_deposit", "reject"
         
         try:
-            req_json = self.decode_json(payload)
-            logger.info(req_json)
-            action = req_json["action"]
-    
-            if action == "create_blockagotchi":
-                return self.create_blockagotchi(msg_sender.lower(), req_json["name"])
-            elif action == "feed_blockagotchi":
-                return self.feed_blockagotchi(msg_sender.lower(), req_json["food_type"])
-            elif action == "walk_blockagotchi":
-                return self.walk_blockagotchi(msg_sender.lower(), req_json["walk_type"])
-            elif action == "bathe_blockagotchi":
-                return self.bathe_blockagotchi(msg_sender.lower(), req_json["bath_type"], req_json["is_paid"])
-            elif action == "buy_item":
-                return self.buy_item(msg_sender.lower(), req_json["item_id"])
-            elif action == "apply_item":
-                return self.apply_item(msg_sender.lower(), req_json["item_id"])
-            return "reject"
+            with metrics.timer("advance.decode"):
+                req_json = self.decode_json(payload)
+                log.debug("advance", "action", action=req_json.get("action") if isinstance(req_json, dict) else None)
+                route, kwargs = self.validate(req_json)
+        except Exception as error:
+            error_msg = f"Invalid action '{payload}'. {error}"
+            self.create_report(self.encode(error_msg))
+            logger.debug(error_msg, exc_info=True)
+            return "invalid", "reject"
+
+        try:
+            with metrics.timer("advance.mutate"):
+                return route.name, route.handler(self, msg_sender.lower(), **kwargs)
         except Exception as error:
             error_msg = f"Failed to process action '{payload}'. {error}"
             self.create_report(self.encode(error_msg))
             logger.debug(error_msg, exc_info=True)
+            log.dump(f"Action '{route.name}' failed")
+            return route.name, "reject"
+
+    def touch_accounts(self, *addresses: str) -> None:
+        # The wallet has no change listeners, so every balance it changes is marked here
+        for address in addresses:
+            self.state["merkle"].touch_account(self.wallet.balance_get(address))
+
+    def validate(self, req_json: dict) -> Tuple[Route, dict]:
+        if not isinstance(req_json, dict):
+            raise ValueError("Payload must be a JSON object")
+        route = action_registry.get(req_json.get("action"))
+        if route is None:
+            raise ValueError(f"Unknown action '{req_json.get('action')}'")
+        return route, route.schema.validate(req_json)
+
+    @action_registry.register("batch", actions=list)
+    def batch(self, user_id: str, actions: list) -> str:
+        """Run several actions from the same sender as a single input.
+
+        Sub-actions run in order and their notices are folded into one
+        "batch" notice. The first failing sub-action stops the batch and the
+        whole input is rejected, which makes the rollup discard every state
+        change made by the batch; handle() rolls the in-process state back
+        to match.
+        """
+        if not actions or len(actions) > self.BATCH_LIMIT:
+            error_msg = f"A batch must be a list of 1 to {self.BATCH_LIMIT} actions."
+            logger.info(error_msg)
+            self.create_report(self.encode(error_msg))
             return "reject"
 
+        # Validate every sub-action before any of them touches the state
+        calls = []
+        for index, req_json in enumerate(actions):
+            try:
+                route, kwargs = self.validate(req_json)
+                if route.name == "batch":
+                    raise ValueError("Batches cannot be nested")
+                calls.append((route, kwargs))
+            except Exception as error:
+                error_msg = f"Invalid batch action {index} '{req_json}'. {error}"
+                logger.info(error_msg)
+                self.create_report(self.encode(error_msg))
+                return "reject"
+
+        results = []
+        status = "accept"
+        for route, kwargs in calls:
+            self.batch_outputs = {"notices": [], "reports": []}
+            try:
+                status = route.handler(self, user_id, **kwargs)
+            except Exception as error:
+                self.create_report(self.encode(f"Failed to process batch action '{route.name}'. {error}"))
+                status = "reject"
+            finally:
+                outputs, self.batch_outputs = self.batch_outputs, None
+
+            result = {"action": route.name, "status": status}
+            if status == "accept":
+                result["events"] = [self.decode_json(notice) for notice in outputs["notices"]]
+            else:
+                result["errors"] = [self.decode_json(report) for report in outputs["reports"]]
+            results.append(result)
+            if status != "accept":
+                break
+
+        if status != "accept":
+            failed = results[-1]
+            errors = failed["errors"] or [f"Action '{failed['action']}' was rejected."]
+            error_msg = {"event": "batch", "user_id": user_id, "status": "reject", "failed_action": len(results) - 1,
+                         "action": failed["action"], "error": errors[0], "results": results}
+            log.info("advance", "batch_rejected", user_id=user_id, failed_action=len(results) - 1, action=failed["action"])
+            self.create_report(self.encode(error_msg))
+            return "reject"
+
+        self.create_notice(self.encode({"event": "batch", "user_id": user_id, "results": results}))
+        log.info("advance", "batch", user_id=user_id, actions=len(results))
+        return "accept"
+
+    @action_registry.register("create_blockagotchi", name=str)
     def create_blockagotchi(self, user_id: str, name: str) -> str:
         try:
             if self.state["global_eggs"] >= self.EGG_LIMIT:
@@ -116,15 +254,22 @@ class AdvanceHandler:
                 return "reject"
             else:
                 self.wallet.ether_transfer(user_id, self.dao_address, 1)
+                self.touch_accounts(user_id, self.dao_address)
                 birth_time = get_current_time()
-                blockagotchi = BlockaGotchi(user_id, name, birth_time, self.GLOBAL_IDS)
-                self.GLOBAL_IDS += 1
+                blockagotchi = BlockaGotchi(user_id, name, birth_time, self.state["next_blockagotchi_id"])
+                self.state["next_blockagotchi_id"] += 1
                 user.add_blockagotchi(blockagotchi)
                 self.state["blockagotchis"][blockagotchi.id] = blockagotchi
+                self.state["ranking"].add(blockagotchi)
+                self.state["scheduler"].schedule(blockagotchi)
+                self.state["columns"].add(blockagotchi)
+                self.state["indexes"].add(blockagotchi)
+                self.state["changes"].touch_blockagotchi(blockagotchi)
+                self.state["merkle"].touch_blockagotchi(blockagotchi)
                 self.state["global_eggs"] += 1
                 notice_payload = {"event": "create_blockagotchi", "user_id": user_id, "blockagotchi_id": blockagotchi.id}
                 self.create_notice(self.encode(notice_payload))
-                logger.info(f"Created blockagotchi {blockagotchi.name} for user {user_id}. Total eggs: {self.state['global_eggs']}")
+                log.info("advance", "create_blockagotchi", user_id=user_id, blockagotchi_id=blockagotchi.id, eggs=self.state["global_eggs"])
                 return "accept"
         except Exception as error:
             error_msg = f"Failed to create blockagotchi for user '{user_id}'. {error}"
@@ -132,14 +277,23 @@ class AdvanceHandler:
             logger.debug(error_msg, exc_info=True)
             return "reject"
 
+    def record_care(self, user: User, happiness: int, kind: int, detail: str, flag: bool = False) -> None:
+        # Care actions go to the blockagotchi's history and score the happiness they gave on the leaderboards
+        now = get_current_time()
+        self.state["history"].append(user.blockagotchi, kind, detail, now, flag)
+        self.state["leaderboards"].record(user.id, user.blockagotchi.happiness - happiness, now)
+
+    @action_registry.register("feed_blockagotchi", food_type=str)
     def feed_blockagotchi(self, user_id: str, food_type: str) -> str:
         try:
             user = self.state["users"].get(user_id)
             if user and user.blockagotchi:
+                happiness = user.blockagotchi.happiness
                 user.blockagotchi.feed(food_type.lower())
+                self.record_care(user, happiness, FEED, food_type.lower())
                 notice_payload = self.encode({"event": "feed_blockagotchi", "user_id": user_id, "blockagotchi_id": user.blockagotchi.id, "food_type": food_type})
                 self.create_notice(notice_payload)
-                logger.info(f"{user.blockagotchi.name} was fed with {food_type}.")
+                log.info("advance", "feed_blockagotchi", user_id=user_id, blockagotchi_id=user.blockagotchi.id, food_type=food_type)
                 return "accept"
             else:
                 error_msg = f"User {user_id} does not have a blockagotchi to feed."
@@ -152,14 +306,17 @@ class AdvanceHandler:
             logger.debug(error_msg, exc_info=True)
             return "reject"
 
+    @action_registry.register("walk_blockagotchi", walk_type=str)
     def walk_blockagotchi(self, user_id: str, walk_type: str) -> str:
         try:
             user = self.state["users"].get(user_id)
             if user and user.blockagotchi:
+                happiness = user.blockagotchi.happiness
                 user.blockagotchi.walk(walk_type.lower())
+                self.record_care(user, happiness, WALK, walk_type.lower())
                 notice_payload = self.encode({"event": "walk_blockagotchi", "user_id": user_id, "blockagotchi_id": user.blockagotchi.id, "walk_type": walk_type})
                 self.create_notice(notice_payload)
-                logger.info(f"{user.blockagotchi.name} went for a {walk_type} walk.")
+                log.info("advance", "walk_blockagotchi", user_id=user_id, blockagotchi_id=user.blockagotchi.id, walk_type=walk_type)
                 return "accept"
             else:
                 error_msg = f"User {user_id} does not have a blockagotchi to walk."
@@ -172,14 +329,19 @@ class AdvanceHandler:
             logger.debug(error_msg, exc_info=True)
             return "reject"
 
+    @action_registry.register("bathe_blockagotchi", bath_type=str, is_paid=(bool, str))
     def bathe_blockagotchi(self, user_id: str, bath_type: str, is_paid: bool) -> str:
         try:
             user = self.state["users"].get(user_id)
             if user and user.blockagotchi:
-                user.blockagotchi.bathe(bath_type.lower(), is_paid)
+                # Any non-empty string pays, as it always has, "False" included
+                paid = bool(is_paid)
+                happiness = user.blockagotchi.happiness
+                user.blockagotchi.bathe(bath_type.lower(), paid)
+                self.record_care(user, happiness, BATH, bath_type.lower(), paid)
                 notice_payload = self.encode({"event": "bathe_blockagotchi", "user_id": user_id, "blockagotchi_id": user.blockagotchi.id, "bath_type": bath_type, "is_paid": is_paid})
                 self.create_notice(notice_payload)
-                logger.info(f"{user.blockagotchi.name} had a {bath_type} bath. Paid: {is_paid}")
+                log.info("advance", "bathe_blockagotchi", user_id=user_id, blockagotchi_id=user.blockagotchi.id, bath_type=bath_type, is_paid=is_paid)
                 return "accept"
             else:
                 error_msg = f"User {user_id} does not have a blockagotchi to bathe."
@@ -192,24 +354,39 @@ class AdvanceHandler:
             logger.debug(error_msg, exc_info=True)
             return "reject"
 
-    def buy_item(self, user_id: str, item_id: int) -> str:
+    @action_registry.register("buy_item", item_id=int, quantity=Field(int, required=False, default=1, minimum=1))
+    def buy_item(self, user_id: str, item_id: int, quantity: int) -> str:
         try:
+            if quantity > self.MAX_ITEM_QUANTITY:
+                error_msg = f"Cannot buy more than {self.MAX_ITEM_QUANTITY} items at once."
+                logger.info(error_msg)
+                self.create_report(self.encode(error_msg))
+                return "reject"
             user = self.state["users"].get(user_id)
             shop = self.state["shop"]
             item = shop.get_item(item_id)
             if user and item:
-                if self.wallet.balance_get(user_id).ether_get() >= item.price:
-                    user.add_item(item)
-                    self.wallet.ether_transfer(user_id, self.dao_address, item.price)
-                    notice_payload = self.encode({"event": "buy_item", "user_id": user_id, "item_id": item_id})
+                # One balance check and one transfer for the whole quantity
+                price = item.price * quantity
+                if self.wallet.balance_get(user_id).ether_get() >= price:
+                    user.add_item(item, quantity)
+                    self.wallet.ether_transfer(user_id, self.dao_address, price)
+                    self.touch_accounts(user_id, self.dao_address)
+                    notice_payload = self.encode({"event": "buy_item", "user_id": user_id, "item_id": item_id, "quantity": quantity, "price": price})
                     self.create_notice(notice_payload)
-                    logger.info(f"User {user_id} bought item {item.name} for {item.price} Ether.")
+                    log.info("advance", "buy_item", user_id=user_id, item_id=item_id, quantity=quantity, price=price)
                     return "accept"
                 else:
-                    error_msg = f"User {user_id} does not have enough Ether to buy item {item.name}."
+                    error_msg = f"User {user_id} does not have enough Ether to buy {quantity} of item {item.name}."
                     logger.info(error_msg)
                     self.create_report(self.encode(error_msg))
                     return "reject"
+            elif item:
+                error_msg = f"User {user_id} does not exist."
+            else:
+                error_msg = f"Item {item_id} is not sold in the shop."
+            logger.info(error_msg)
+            self.create_report(self.encode(error_msg))
             return "reject"
         except Exception as error:
             error_msg = f"Failed to buy item '{item_id}' for user '{user_id}'. {error}"
@@ -217,13 +394,14 @@ class AdvanceHandler:
             logger.debug(error_msg, exc_info=True)
             return "reject"
 
+    @action_registry.register("apply_item", item_id=int)
     def apply_item(self, user_id: str, item_id: int) -> str:
         try:
             user = self.state["users"].get(user_id)
             if user and user.apply_item_to_blockagotchi(item_id):
                 notice_payload = self.encode({"event": "apply_item", "user_id": user_id, "item_id": item_id})
                 self.create_notice(notice_payload)
-                logger.info(f"User {user_id} applied item {item_id} to their blockagotchi.")
+                log.info("advance", "apply_item", user_id=user_id, item_id=item_id)
                 return "accept"
             else:
                 error_msg = f"User {user_id} got an error while trying to apply item {item_id}"
@@ -236,15 +414,20 @@ class AdvanceHandler:
             logger.debug(error_msg, exc_info=True)
             return "reject"
     
+    @action_registry.register("remove_item", item_id=int)
     def remove_item(self, user_id: str, item_id: int) -> str:
         try:
             user = self.state["users"].get(user_id)
             if user and user.remove_item_from_blockagotchi(item_id):
                 notice_payload = self.encode({"event": "remove_item", "user_id": user_id, "item_id": item_id})
                 self.create_notice(notice_payload)
-                logger.info(f"User {user_id} removed item {item_id} from their blockagotchi.")
+                log.info("advance", "remove_item", user_id=user_id, item_id=item_id)
                 return "accept"
-            return "reject"
+            else:
+                error_msg = f"User {user_id} got an error while trying to remove item {item_id}"
+                logger.info(error_msg)
+                self.create_report(self.encode(error_msg))
+                return "reject"
         except Exception as error:
             error_msg = f"Failed to remove item '{item_id}' for user '{user_id}'. {error}"
             self.create_report(self.encode(error_msg))
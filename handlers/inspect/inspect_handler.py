@@ -1,50 +1,108 @@
 import logging
-from urllib.parse import urlparse
-from blockagotchi import BlockaGotchi, get_current_time
+from urllib.parse import urlparse, parse_qs
+from typing import List, Optional, Tuple
+from blockagotchi import BlockaGotchi, FIELDS, epoch_to_str, get_current_time
 from user import User, GlobalState
 from shop import Item, Shop
 import json
-import requests
+import time
+from rollup_client import RollupClient
+from registry import Field, Registry
+from metrics import metrics
+from logs import log
+from snapshot import state_digest
+from encoding import array_header, map_header, pack
 from cartesi_wallet.util import hex_to_str
 
 logger = logging.getLogger(__name__)
 
+route_registry = Registry(coerce=True)
+
+LIST_OPEN = "[".encode("utf-8").hex()
+LIST_SEPARATOR = ", ".encode("utf-8").hex()
+LIST_CLOSE = "]".encode("utf-8").hex()
+
+# Query parameters of every route returning blockagotchis: a comma separated
+# projection of to_dict() fields, and json or msgpack encoding
+VIEW_FIELDS = {"fields": Field(str, required=False), "encoding": Field(str, required=False, default="json")}
+ENCODINGS = ("json", "msgpack")
+
 class InspectHandler:
-    def __init__(self, rollup_server: str):
-        self.state = GlobalState().get_state()
-        self.rollup_server = rollup_server
+    PAGE_LIMIT = 100
+    MAX_PAGE_LIMIT = 1000
+    MAX_REPORT_BYTES = 64 * 1024
+
+    def __init__(self, rollup: RollupClient, state: Optional[dict] = None):
+        self.state = GlobalState().get_state() if state is None else state
+        self.rollup = rollup
 
     def encode(self, d: dict) -> str:
         return "0x" + json.dumps(d).encode("utf-8").hex()
 
+    def parse_view(self, fields: Optional[str], encoding: str) -> Optional[List[str]]:
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown encoding '{encoding}'")
+        if fields is None:
+            return None
+        names = [name.strip() for name in fields.split(",") if name.strip()]
+        unknown = [name for name in names if name not in FIELDS]
+        if unknown or not names:
+            raise ValueError(f"Unknown fields {unknown}, expected some of {list(FIELDS)}")
+        return names
+
+    def encode_fragment(self, blockagotchi: BlockaGotchi, fields: Optional[List[str]], encoding: str) -> str:
+        """Hex encoding of one blockagotchi, without the 0x prefix."""
+        if encoding == "msgpack":
+            return pack(blockagotchi.to_dict() if fields is None else blockagotchi.to_fields(fields)).hex()
+        if fields is None:
+            return blockagotchi.to_payload()
+        return json.dumps(blockagotchi.to_fields(fields)).encode("utf-8").hex()
+
+    def encode_blockagotchis(self, blockagotchis, fields: Optional[List[str]] = None, encoding: str = "json") -> str:
+        # Splice the per-blockagotchi payloads, cached for full JSON, into a list
+        fragments = [self.encode_fragment(blockagotchi, fields, encoding) for blockagotchi in blockagotchis]
+        if encoding == "msgpack":
+            return "0x" + array_header(len(fragments)).hex() + "".join(fragments)
+        return "0x" + LIST_OPEN + LIST_SEPARATOR.join(fragments) + LIST_CLOSE
+
     def handle(self, data: dict) -> dict:
-        logger.info(f"Received inspect request data {data}")
-        report = {}
+        log.debug("inspect", "request", payload_bytes=len(data["payload"]) // 2 - 1)
+        start = time.perf_counter()
+        route, status = self.process(data)
+        metrics.record("inspect", route, status, time.perf_counter() - start)
+        return status
+
+    def process(self, data: dict) -> Tuple[str, str]:
         try:
             url = urlparse(hex_to_str(data["payload"]))
             path = url.path.lower()
-            if path.startswith("balance/"):
-                report = self.get_balance(path)
-            elif path.startswith("user_blockagotchi/"):
-                report = self.get_user_blockagotchi(path)
-            elif path.startswith("all_blockagotchis"):
-                report = self.get_all_blockagotchis()
-            elif path.startswith("blockagotchi/"):
-                report = self.get_blockagotchi(path)
-            elif path.startswith("shop_items"):
-                report = self.get_shop_items()
-            elif path.startswith("ranking"):
-                report = self.get_ranking()
-
-            response = requests.post(self.rollup_server + "/report", json=report)
-            logger.info(f"Received report status {response.status_code} body {response.content}")
-
-            return "accept"
+            route = route_registry.get(path.split("/", 1)[0])
+            if route is None:
+                raise ValueError(f"Unknown route '{path}'")
+            query = {name: values[0] for name, values in parse_qs(url.query).items()}
+            kwargs = route.schema.validate(query)
+        except Exception as error:
+            error_msg = f"Invalid inspect request. {error}"
+            self.rollup.report(self.encode({"error": error_msg}))
+            logger.debug(error_msg, exc_info=True)
+            return "invalid", "reject"
+
+        try:
+            with metrics.timer("inspect.serialize"):
+                report = route.handler(self, path, **kwargs)
+            reports = report if isinstance(report, list) else [report]
+            for report in reports:
+                metrics.observe_size("inspect.report_bytes", len(report["payload"]) // 2 - 1)
+                self.rollup.report(report["payload"])
+
+            return route.name, "accept"
         except Exception as error:
             error_msg = f"Failed to process inspect request. {error}"
             logger.debug(error_msg, exc_info=True)
-            return "reject"
+            log.dump(f"Inspect route '{route.name}' failed")
+            return route.name, "reject"
 
+    @route_registry.register("balance")
     def get_balance(self, path: str) -> dict:
         try:
             info = path.replace("balance/", "").split("/")
@@ -58,40 +116,141 @@ class InspectHandler:
             logger.debug(error_msg, exc_info=True)
             return {"payload": self.encode({"error": error_msg})}
 
-    def get_user_blockagotchi(self, path: str) -> dict:
+    @route_registry.register("user_blockagotchi", **VIEW_FIELDS)
+    def get_user_blockagotchi(self, path: str, fields: Optional[str], encoding: str) -> dict:
         try:
+            fields = self.parse_view(fields, encoding)
             user_id = path.replace("user_blockagotchi/", "")
             user = self.state["users"].get(user_id)
             if user and user.blockagotchi:
-                return {"payload": self.encode(user.blockagotchi.to_dict())}
+                return {"payload": "0x" + self.encode_fragment(user.blockagotchi, fields, encoding)}
             return {"payload": self.encode({"error": "User or blockagotchi not found"})}
         except Exception as error:
             error_msg = f"Failed to get user blockagotchi for path '{path}'. {error}"
             logger.debug(error_msg, exc_info=True)
             return {"payload": self.encode({"error": error_msg})}
 
-    def get_all_blockagotchis(self) -> dict:
+    @route_registry.register("all_blockagotchis", cursor=Field(int, required=False, minimum=0), limit=Field(int, required=False, minimum=0), **VIEW_FIELDS)
+    def get_all_blockagotchis(self, path: str, cursor: int, limit: int, fields: Optional[str], encoding: str):
         try:
-            blockagotchis = [blockagotchi.to_dict() for blockagotchi in self.state["blockagotchis"].values()]
-            return {"payload": self.encode(blockagotchis)}
+            fields = self.parse_view(fields, encoding)
+            if cursor is not None or limit is not None:
+                return self.get_blockagotchis_page(cursor or 1, self.PAGE_LIMIT if limit is None else limit, fields, encoding)
+            return {"payload": self.encode_blockagotchis(self.state["blockagotchis"].values(), fields, encoding)}
         except Exception as error:
             error_msg = f"Failed to get all blockagotchis. {error}"
             logger.debug(error_msg, exc_info=True)
             return {"payload": self.encode({"error": error_msg})}
 
-    def get_blockagotchi(self, path: str) -> dict:
+    def get_blockagotchis_page(self, cursor: int, limit: int, fields: Optional[List[str]] = None, encoding: str = "json") -> list:
+        # Blockagotchi ids are sequential and never reused, so the page is
+        # walked by id instead of scanning the whole population.
+        limit = min(limit, self.MAX_PAGE_LIMIT)
+        blockagotchis = self.state["blockagotchis"]
+        last_id = next(reversed(blockagotchis), 0)
+
+        page = []
+        blockagotchi_id = cursor
+        while len(page) < limit and blockagotchi_id <= last_id:
+            blockagotchi = blockagotchis.get(blockagotchi_id)
+            blockagotchi_id += 1
+            if blockagotchi is not None:
+                page.append(blockagotchi)
+        next_cursor = blockagotchi_id if blockagotchi_id <= last_id else None
+        return self.encode_page(page, {"next_cursor": next_cursor}, fields, encoding)
+
+    def encode_page(self, blockagotchis, meta: dict, fields: Optional[List[str]] = None, encoding: str = "json",
+                    first_meta: Optional[dict] = None) -> list:
+        # Split the page into reports of bounded size. Every report ends with
+        # its chunk number and ``meta``; the first one also with ``first_meta``.
+        chunks, chunk, chunk_size = [], [], 0
+        for blockagotchi in blockagotchis:
+            fragment = self.encode_fragment(blockagotchi, fields, encoding)
+            if chunk and chunk_size + len(fragment) // 2 > self.MAX_REPORT_BYTES:
+                chunks.append(chunk)
+                chunk, chunk_size = [], 0
+            chunk.append(fragment)
+            chunk_size += len(fragment) // 2
+        chunks.append(chunk)
+
+        reports = []
+        for index, chunk in enumerate(chunks):
+            tail = {"chunk": index, "chunks": len(chunks), **meta}
+            if index == 0 and first_meta:
+                tail.update(first_meta)
+            if encoding == "msgpack":
+                head = (map_header(len(tail) + 1) + pack("blockagotchis") + array_header(len(chunk))).hex()
+                reports.append({"payload": "0x" + head + "".join(chunk) + pack(tail)[len(map_header(len(tail))):].hex()})
+            else:
+                head = '{"blockagotchis": '.encode("utf-8").hex() + LIST_OPEN
+                reports.append({"payload": "0x" + head + LIST_SEPARATOR.join(chunk) + LIST_CLOSE + (", " + json.dumps(tail)[1:]).encode("utf-8").hex()})
+        return reports
+
+    @route_registry.register(
+        "blockagotchis",
+        stage=Field(str, required=False),
+        type=Field(str, required=False),
+        biotype=Field(str, required=False),
+        condition=Field(str, required=False),
+        alive=Field(bool, required=False),
+        owner=Field(str, required=False),
+        cursor=Field(int, required=False, default=0, minimum=0),
+        limit=Field(int, required=False, minimum=0),
+        **VIEW_FIELDS,
+    )
+    def get_filtered_blockagotchis(self, path: str, owner: str, cursor: int, limit: int, fields: Optional[str], encoding: str, **values):
+        try:
+            fields = self.parse_view(fields, encoding)
+            indexes = self.state["indexes"]
+            filters = {field: indexes.code(field, value) for field, value in values.items() if value is not None}
+            within = None
+            if owner is not None:
+                user = self.state["users"].get(owner.lower())
+                within = [user.blockagotchi.id] if user and user.blockagotchi else []
+            limit = min(self.PAGE_LIMIT if limit is None else limit, self.MAX_PAGE_LIMIT)
+            ids, next_cursor = indexes.query(filters, cursor, limit, within)
+            blockagotchis = self.state["blockagotchis"]
+            return self.encode_page([blockagotchis[blockagotchi_id] for blockagotchi_id in ids], {"next_cursor": next_cursor}, fields, encoding)
+        except Exception as error:
+            error_msg = f"Failed to get blockagotchis for path '{path}'. {error}"
+            logger.debug(error_msg, exc_info=True)
+            return {"payload": self.encode({"error": error_msg})}
+
+    @route_registry.register("blockagotchi", offset=Field(int, required=False, default=0, minimum=0), limit=Field(int, required=False, minimum=0), **VIEW_FIELDS)
+    def get_blockagotchi(self, path: str, offset: int, limit: int, fields: Optional[str], encoding: str) -> dict:
         try:
+            if path.endswith("/history"):
+                return self.get_blockagotchi_history(path, offset, limit)
+            fields = self.parse_view(fields, encoding)
             blockagotchi_id = path.replace("blockagotchi/", "")
             blockagotchi = self.state["blockagotchis"].get(int(blockagotchi_id))
             if blockagotchi:
-                return {"payload": self.encode(blockagotchi.to_dict())}
+                return {"payload": "0x" + self.encode_fragment(blockagotchi, fields, encoding)}
             return {"payload": self.encode({"error": "blockagotchi not found"})}
         except Exception as error:
             error_msg = f"Failed to get blockagotchi for path '{path}'. {error}"
             logger.debug(error_msg, exc_info=True)
             return {"payload": self.encode({"error": error_msg})}
 
-    def get_shop_items(self) -> dict:
+    def get_blockagotchi_history(self, path: str, offset: int, limit: int) -> dict:
+        try:
+            blockagotchi_id = int(path[len("blockagotchi/"):-len("/history")])
+            blockagotchi = self.state["blockagotchis"].get(blockagotchi_id)
+            if blockagotchi is None:
+                return {"payload": self.encode({"error": "blockagotchi not found"})}
+            limit = min(self.PAGE_LIMIT if limit is None else limit, self.MAX_PAGE_LIMIT)
+            events = self.state["history"].page(blockagotchi, offset, limit)
+            for event in events:
+                event["time"] = epoch_to_str(event["time"])
+            next_offset = offset + len(events) if offset + len(events) < blockagotchi.history_count else None
+            return {"payload": self.encode({"id": blockagotchi_id, "events": events, "total": blockagotchi.history_count, "next_offset": next_offset})}
+        except Exception as error:
+            error_msg = f"Failed to get blockagotchi history for path '{path}'. {error}"
+            logger.debug(error_msg, exc_info=True)
+            return {"payload": self.encode({"error": error_msg})}
+
+    @route_registry.register("shop_items")
+    def get_shop_items(self, path: str) -> dict:
         try:
             shop = self.state["shop"]
             items = [item.to_dict() for item in shop.get_items().values()]
@@ -101,12 +260,136 @@ class InspectHandler:
             logger.debug(error_msg, exc_info=True)
             return {"payload": self.encode({"error": error_msg})}
 
-    def get_ranking(self) -> dict:
+    @route_registry.register("ranking", offset=Field(int, required=False, default=0, minimum=0), limit=Field(int, required=False, minimum=0), **VIEW_FIELDS)
+    def get_ranking(self, path: str, offset: int, limit: int, fields: Optional[str], encoding: str) -> dict:
         try:
-            blockagotchis = sorted(self.state["blockagotchis"].values(), key=lambda x: x.overall_score, reverse=True)
-            ranking = [blockagotchi.to_dict() for blockagotchi in blockagotchis]
-            return {"payload": self.encode(ranking)}
+            if path.startswith("ranking/rank/"):
+                return self.get_blockagotchi_rank(path)
+            fields = self.parse_view(fields, encoding)
+            # Without a limit the whole ranking is listed, like all_blockagotchis
+            if limit is not None:
+                limit = min(limit, self.MAX_PAGE_LIMIT)
+            blockagotchis = self.state["blockagotchis"]
+            ranking = [blockagotchis[blockagotchi_id] for blockagotchi_id in self.state["ranking"].page(offset, limit)]
+            return {"payload": self.encode_blockagotchis(ranking, fields, encoding)}
         except Exception as error:
             error_msg = f"Failed to get ranking. {error}"
             logger.debug(error_msg, exc_info=True)
             return {"payload": self.encode({"error": error_msg})}
+
+    def get_blockagotchi_rank(self, path: str) -> dict:
+        try:
+            blockagotchi_id = int(path.replace("ranking/rank/", ""))
+            ranking = self.state["ranking"]
+            rank = ranking.rank(blockagotchi_id)
+            if rank is None:
+                return {"payload": self.encode({"error": "blockagotchi not found"})}
+            blockagotchi = self.state["blockagotchis"][blockagotchi_id]
+            return {"payload": self.encode({"id": blockagotchi_id, "rank": rank, "overall_score": blockagotchi.overall_score, "total": len(ranking)})}
+        except Exception as error:
+            error_msg = f"Failed to get rank for path '{path}'. {error}"
+            logger.debug(error_msg, exc_info=True)
+            return {"payload": self.encode({"error": error_msg})}
+
+    @route_registry.register("leaderboard", offset=Field(int, required=False, default=0, minimum=0), limit=Field(int, required=False, minimum=0),
+                             previous=Field(bool, required=False, default=False))
+    def get_leaderboard(self, path: str, offset: int, limit: int, previous: bool) -> dict:
+        try:
+            name = path.replace("leaderboard/", "")
+            board = self.state["leaderboards"].boards.get(name)
+            if board is None:
+                raise ValueError(f"Unknown leaderboard '{name}', expected one of {list(self.state['leaderboards'].boards)}")
+            now = get_current_time()
+            limit = min(self.PAGE_LIMIT if limit is None else limit, self.MAX_PAGE_LIMIT)
+            if previous:
+                window, final = board.previous(now)
+                standings, total = final[offset:offset + limit], len(final)
+            else:
+                window, standings, total = board.standings(now, offset, limit)
+            report = {
+                "leaderboard": name,
+                "start": epoch_to_str(board.window_start(window)) if board.length else None,
+                "end": epoch_to_str(board.window_start(window + 1)) if board.length else None,
+                "standings": [{"rank": offset + position + 1, "user_id": user_id, "points": points} for position, (user_id, points) in enumerate(standings)],
+                "total": total,
+            }
+            return {"payload": self.encode(report)}
+        except Exception as error:
+            error_msg = f"Failed to get leaderboard for path '{path}'. {error}"
+            logger.debug(error_msg, exc_info=True)
+            return {"payload": self.encode({"error": error_msg})}
+
+    @route_registry.register("metrics")
+    def get_metrics(self, path: str) -> dict:
+        try:
+            report = metrics.to_dict()
+            report["population"] = {"users": len(self.state["users"]), "blockagotchis": len(self.state["blockagotchis"]), "eggs": self.state["global_eggs"]}
+            return {"payload": self.encode(report)}
+        except Exception as error:
+            error_msg = f"Failed to get metrics. {error}"
+            logger.debug(error_msg, exc_info=True)
+            return {"payload": self.encode({"error": error_msg})}
+
+    @route_registry.register("changes", since=Field(int, required=False, default=0, minimum=0), **VIEW_FIELDS)
+    def get_changes(self, path: str, since: int, fields: Optional[str], encoding: str):
+        try:
+            fields = self.parse_view(fields, encoding)
+            changes = self.state["changes"]
+            blockagotchis, users = changes.since(since)
+            users = [
+                {
+                    "id": user.id,
+                    "blockagotchi_id": user.blockagotchi.id if user.blockagotchi else None,
+                    "items": user.items.to_list(),
+                    "version": user.version,
+                }
+                for user in users
+            ]
+            return self.encode_page(blockagotchis, {"version": changes.version}, fields, encoding, {"users": users})
+        except Exception as error:
+            error_msg = f"Failed to get changes for path '{path}'. {error}"
+            logger.debug(error_msg, exc_info=True)
+            return {"payload": self.encode({"error": error_msg})}
+
+    @route_registry.register("stats", bin_width=Field(int, required=False, default=25, minimum=1))
+    def get_stats(self, path: str, bin_width: int) -> dict:
+        try:
+            return {"payload": self.encode(self.state["columns"].stats(get_current_time(), bin_width))}
+        except Exception as error:
+            error_msg = f"Failed to get population stats. {error}"
+            logger.debug(error_msg, exc_info=True)
+            return {"payload": self.encode({"error": error_msg})}
+
+    @route_registry.register("state_digest")
+    def get_state_digest(self, path: str) -> dict:
+        try:
+            return {"payload": self.encode({"digest": state_digest(self.state)})}
+        except Exception as error:
+            error_msg = f"Failed to get state digest. {error}"
+            logger.debug(error_msg, exc_info=True)
+            return {"payload": self.encode({"error": error_msg})}
+
+    @route_registry.register("state_root")
+    def get_state_root(self, path: str) -> dict:
+        try:
+            merkle = self.state["merkle"]
+            report = {"root": "0x" + merkle.root().hex(), "roots": merkle.roots(), "version": self.state["changes"].version}
+            return {"payload": self.encode(report)}
+        except Exception as error:
+            error_msg = f"Failed to get state root. {error}"
+            logger.debug(error_msg, exc_info=True)
+            return {"payload": self.encode({"error": error_msg})}
+
+    @route_registry.register("state_proof")
+    def get_state_proof(self, path: str) -> dict:
+        try:
+            kind, key = path.replace("state_proof/", "").split("/", 1)
+            proof = self.state["merkle"].proof(kind, int(key) if kind == "blockagotchi" else key)
+            if proof is None:
+                return {"payload": self.encode({"error": f"No {kind} '{key}' in the state"})}
+            proof["version"] = self.state["changes"].version
+            return {"payload": self.encode(proof)}
+        except Exception as error:
+            error_msg = f"Failed to get state proof for path '{path}'. {error}"
+            logger.debug(error_msg, exc_info=True)
+            return {"payload": self.encode({"error": error_msg})}
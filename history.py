@@ -0,0 +1,271 @@
+"""Append-only activity history of every blockagotchi.
+
+Feeds, walks and baths are fixed-size records in one log shared by all
+blockagotchis. Each record points back to the previous record of the same
+blockagotchi, so a blockagotchi only keeps the position of its newest
+record and its record count in memory, and its history is paged newest
+first by following the chain.
+
+The log is split into segments of SEGMENT_RECORDS records. The segment
+being filled lives in memory. Full segments are written to the history
+directory and memory-mapped, so the OS pages them in only when they are
+read. Without a directory, or when opened read-only, full segments stay in
+memory and no files are written. A SHA-256 chain over the logical content
+of every record is kept so snapshots can prove which history they belong
+to.
+"""
+import hashlib
+import mmap
+import os
+import struct
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from blockagotchi import DIET_FOODS
+
+FEED, WALK, BATH = range(3)
+KINDS = ("feed", "walk", "bath")
+DETAILS = ("food_type", "walk_type", "bath_type")
+# Details recorded as they are sent, by kind. Any other detail is recorded
+# as OTHER, so senders cannot grow the string table.
+VOCABULARIES = (frozenset(DIET_FOODS), frozenset(("walk", "run", "corrida")), frozenset(("normal",)))
+OTHER = "other"
+
+# Previous record of the same blockagotchi, time, blockagotchi id, kind, flag, detail string
+RECORD = struct.Struct("<qqIBBI")
+CANONICAL = struct.Struct("<qIBBI")
+STRING = struct.Struct("<I")
+EMPTY_CHAIN = bytes(32)
+
+class HistoryError(Exception):
+    pass
+
+class HistoryStore:
+    SEGMENT_RECORDS = 1 << 16
+
+    def __init__(self, directory: Optional[str] = None, writable: bool = True, segment_records: int = SEGMENT_RECORDS):
+        self.directory = directory
+        self.writable = writable and directory is not None
+        self.segment_records = segment_records
+        self.sealed: List[bytes] = []
+        self.active = bytearray()
+        # Bytes of the active segment already written to its file
+        self.persisted = 0
+        # Records held in the segments, and how many of them are part of the state
+        self.size = 0
+        self.length = 0
+        self.chain = EMPTY_CHAIN
+        self.strings: List[str] = []
+        self.string_codes: Dict[str, int] = {}
+        self.strings_file = None
+        if directory is not None:
+            if self.writable:
+                os.makedirs(directory, exist_ok=True)
+            self.open()
+
+    def segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:08d}.history")
+
+    def open(self) -> None:
+        # Records left by an earlier run are kept so a snapshot restore can
+        # adopt them, but they are not part of the state until then.
+        strings_path = os.path.join(self.directory, "strings.history")
+        if os.path.exists(strings_path):
+            with open(strings_path, "rb") as file:
+                data = file.read()
+            offset = 0
+            while offset + STRING.size <= len(data):
+                size = STRING.unpack_from(data, offset)[0]
+                if offset + STRING.size + size > len(data):
+                    break
+                self.add_string(data[offset + STRING.size:offset + STRING.size + size].decode("utf-8"))
+                offset += STRING.size + size
+            if self.writable:
+                os.truncate(strings_path, offset)
+        if self.writable:
+            self.strings_file = open(strings_path, "ab")
+
+        segment_bytes = self.segment_records * RECORD.size
+        segment = 0
+        while os.path.exists(self.segment_path(segment)):
+            with open(self.segment_path(segment), "rb") as file:
+                if os.fstat(file.fileno()).st_size < segment_bytes:
+                    data = file.read()
+                    # A torn record can only be the tail of the segment being written
+                    self.active = bytearray(data[:len(data) // RECORD.size * RECORD.size])
+                    self.persisted = len(self.active)
+                    if self.writable:
+                        os.truncate(self.segment_path(segment), self.persisted)
+                    self.size += len(self.active) // RECORD.size
+                    break
+                self.sealed.append(mmap.mmap(file.fileno(), segment_bytes, access=mmap.ACCESS_READ))
+                self.size += self.segment_records
+            segment += 1
+
+    def add_string(self, s: str) -> int:
+        code = self.string_codes[s] = len(self.strings)
+        self.strings.append(s)
+        return code
+
+    def intern(self, s: str) -> int:
+        code = self.string_codes.get(s)
+        if code is None:
+            code = self.add_string(s)
+            if self.strings_file is not None:
+                data = s.encode("utf-8")
+                # Written before any record that refers to it
+                self.strings_file.write(STRING.pack(len(data)) + data)
+                self.strings_file.flush()
+        return code
+
+    def __len__(self) -> int:
+        return self.length
+
+    def append(self, blockagotchi, kind: int, detail: str, now: int, flag: bool = False) -> None:
+        if self.size != self.length:
+            self.truncate(self.length)
+        if detail not in VOCABULARIES[kind]:
+            detail = OTHER
+        detail_code = self.intern(detail)
+        self.active += RECORD.pack(blockagotchi.history_head, now, blockagotchi.id, kind, flag, detail_code)
+        self.chain = self.link(self.chain, now, blockagotchi.id, kind, flag, detail)
+        blockagotchi.history_head = self.length
+        blockagotchi.history_count += 1
+        blockagotchi.history = self
+        self.length += 1
+        self.size += 1
+        if len(self.active) == self.segment_records * RECORD.size:
+            self.seal()
+
+    def link(self, chain: bytes, now: int, blockagotchi_id: int, kind: int, flag: bool, detail: str) -> bytes:
+        data = detail.encode("utf-8")
+        return hashlib.sha256(chain + CANONICAL.pack(now, blockagotchi_id, kind, flag, len(data)) + data).digest()
+
+    def seal(self) -> None:
+        segment = len(self.sealed)
+        if self.writable:
+            self.persist()
+            with open(self.segment_path(segment), "rb") as file:
+                self.sealed.append(mmap.mmap(file.fileno(), len(self.active), access=mmap.ACCESS_READ))
+        else:
+            self.sealed.append(bytes(self.active))
+        self.active = bytearray()
+        self.persisted = 0
+
+    def persist(self) -> None:
+        """Make every record appended so far durable; snapshots call this before they are written."""
+        if not self.writable:
+            return
+        self.strings_file.flush()
+        os.fsync(self.strings_file.fileno())
+        if self.persisted == len(self.active):
+            return
+        with open(self.segment_path(len(self.sealed)), "ab") as file:
+            file.write(self.active[self.persisted:])
+            file.flush()
+            os.fsync(file.fileno())
+        self.persisted = len(self.active)
+
+    def truncate(self, length: int) -> None:
+        """Keep the first ``length`` records and drop the rest."""
+        if length > self.size:
+            raise HistoryError(f"History holds {self.size} records, {length} are needed")
+        segment, records = divmod(length, self.segment_records)
+        if segment < len(self.sealed):
+            # The segment was full and on disk
+            self.active = bytearray(self.sealed[segment][:records * RECORD.size])
+            self.sealed = self.sealed[:segment]
+            self.persisted = len(self.active)
+        else:
+            del self.active[records * RECORD.size:]
+            self.persisted = min(self.persisted, len(self.active))
+        if self.writable:
+            path = self.segment_path(segment)
+            if os.path.exists(path):
+                os.truncate(path, self.persisted)
+            stale = segment + 1
+            while os.path.exists(self.segment_path(stale)):
+                os.remove(self.segment_path(stale))
+                stale += 1
+        self.size = self.length = length
+
+    def clear(self) -> None:
+        self.truncate(0)
+        self.chain = EMPTY_CHAIN
+
+    def rewind(self, length: int, chain: bytes) -> None:
+        """Go back to the history of ``length`` records with hash ``chain``, dropping later records."""
+        if length != self.length:
+            self.truncate(length)
+        self.chain = chain
+
+    def restore(self, length: int, chain: bytes, blockagotchis: Dict[int, object], verify: bool = False) -> None:
+        """Adopt the first ``length`` records as the history with hash ``chain``.
+
+        The blockagotchis already carry their newest record and record count.
+        With ``verify`` every record is read back to recompute the chain and
+        check them.
+        """
+        self.truncate(length)
+        self.chain = chain
+        for blockagotchi in blockagotchis.values():
+            blockagotchi.history = self
+        if not verify:
+            return
+        computed = EMPTY_CHAIN
+        heads: Dict[int, Tuple[int, int]] = {}
+        strings = self.strings
+        for position, (_, now, blockagotchi_id, kind, flag, detail) in enumerate(self.records(0, length)):
+            if blockagotchi_id not in blockagotchis:
+                raise HistoryError(f"History record {position} belongs to unknown blockagotchi {blockagotchi_id}")
+            heads[blockagotchi_id] = (position, heads.get(blockagotchi_id, (-1, 0))[1] + 1)
+            computed = self.link(computed, now, blockagotchi_id, kind, flag, strings[detail])
+        if computed != chain:
+            raise HistoryError("History records do not match the expected chain")
+        for blockagotchi_id, blockagotchi in blockagotchis.items():
+            if (blockagotchi.history_head, blockagotchi.history_count) != heads.get(blockagotchi_id, (-1, 0)):
+                raise HistoryError(f"History of blockagotchi {blockagotchi_id} does not match its records")
+
+    def segment(self, index: int):
+        return self.sealed[index] if index < len(self.sealed) else self.active
+
+    def record(self, position: int) -> Tuple[int, int, int, int, int, int]:
+        segment, records = divmod(position, self.segment_records)
+        return RECORD.unpack_from(self.segment(segment), records * RECORD.size)
+
+    def records(self, start: int, stop: int) -> Iterator[Tuple[int, int, int, int, int, int]]:
+        position = start
+        while position < stop:
+            segment, records = divmod(position, self.segment_records)
+            count = min(self.segment_records - records, stop - position)
+            with memoryview(self.segment(segment)) as view:
+                yield from RECORD.iter_unpack(view[records * RECORD.size:(records + count) * RECORD.size])
+            position += count
+
+    def foods(self, blockagotchi) -> List[str]:
+        """Food types of a blockagotchi's feeds, oldest first."""
+        foods = []
+        position = blockagotchi.history_head
+        while position >= 0:
+            previous, _, _, kind, _, detail = self.record(position)
+            if kind == FEED:
+                foods.append(self.strings[detail])
+            position = previous
+        foods.reverse()
+        return foods
+
+    def page(self, blockagotchi, offset: int, limit: int) -> List[dict]:
+        """Events of a blockagotchi, newest first, skipping the ``offset`` newest."""
+        events = []
+        position = blockagotchi.history_head
+        skipped = 0
+        while position >= 0 and len(events) < limit:
+            previous, now, _, kind, flag, detail = self.record(position)
+            if skipped < offset:
+                skipped += 1
+            else:
+                event = {"time": now, "event": KINDS[kind], DETAILS[kind]: self.strings[detail]}
+                if kind == BATH:
+                    event["is_paid"] = bool(flag)
+                events.append(event)
+            position = previous
+        return events
@@ -0,0 +1,97 @@
+import heapq
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from blockagotchi import BlockaGotchi, BIOTYPES, CONDITIONS, STAGES, TYPES
+
+class PetIndexes:
+    """Ids of the blockagotchis holding each stage, type, biotype, condition and alive value.
+
+    Indexes are kept current from BlockaGotchi.change_listeners, so evolution,
+    biotype and condition updates and deaths move a blockagotchi between
+    sets as they happen. Filtered queries intersect the sets, smallest
+    first, and page through the result by id.
+    """
+    FIELDS = ("stage", "type", "biotype", "condition", "alive")
+    NAMES = {
+        "stage": STAGES,
+        "type": tuple("none" if name is None else name for name in TYPES),
+        "biotype": BIOTYPES,
+        "condition": CONDITIONS,
+    }
+    CODES = {field: {name.lower(): code for code, name in enumerate(names)} for field, names in NAMES.items()}
+
+    def __init__(self):
+        self._indexes: Tuple[Dict[int, Set[int]], ...] = tuple({} for _ in self.FIELDS)
+        self._keys: Dict[int, Tuple[int, ...]] = {}
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def clear(self) -> None:
+        self._indexes = tuple({} for _ in self.FIELDS)
+        self._keys = {}
+
+    def key(self, blockagotchi: BlockaGotchi) -> Tuple[int, ...]:
+        return (blockagotchi.stage_code, blockagotchi.type_code, blockagotchi.biotype_code,
+                blockagotchi.condition_code, int(blockagotchi.alive))
+
+    def add(self, blockagotchi: BlockaGotchi) -> None:
+        self.update(blockagotchi)
+
+    def update(self, blockagotchi: BlockaGotchi) -> None:
+        key = self.key(blockagotchi)
+        old_key = self._keys.get(blockagotchi.id)
+        if key == old_key:
+            return
+        self._keys[blockagotchi.id] = key
+        for position, index in enumerate(self._indexes):
+            code = key[position]
+            if old_key is not None:
+                if old_key[position] == code:
+                    continue
+                ids = index[old_key[position]]
+                ids.discard(blockagotchi.id)
+                if not ids:
+                    del index[old_key[position]]
+            index.setdefault(code, set()).add(blockagotchi.id)
+
+    def remove(self, blockagotchi_id: int) -> None:
+        key = self._keys.pop(blockagotchi_id, None)
+        if key is None:
+            return
+        for position, index in enumerate(self._indexes):
+            ids = index[key[position]]
+            ids.discard(blockagotchi_id)
+            if not ids:
+                del index[key[position]]
+
+    def code(self, field: str, value) -> int:
+        """Code of a query value: a case-insensitive name, or a bool for alive."""
+        if field == "alive":
+            return int(value)
+        code = self.CODES[field].get(value.lower())
+        if code is None:
+            raise ValueError(f"Unknown {field} '{value}'")
+        return code
+
+    def ids(self, field: str, code: int) -> Set[int]:
+        return self._indexes[self.FIELDS.index(field)].get(code, set())
+
+    def query(self, filters: Dict[str, int], cursor: int, limit: int,
+              within: Optional[Iterable[int]] = None) -> Tuple[List[int], Optional[int]]:
+        """Ids, from ``cursor`` upwards, that match every filter and are ``within`` the given ids.
+
+        Returns at most ``limit`` ids and the cursor of the next page, or None.
+        """
+        sets = [self.ids(field, code) for field, code in filters.items()]
+        if within is not None:
+            sets.append(set(within))
+        if not sets:
+            sets.append(self._keys.keys())
+        sets.sort(key=len)
+        smallest, rest = sets[0], sets[1:]
+        matches = heapq.nsmallest(limit + 1, (
+            blockagotchi_id for blockagotchi_id in smallest
+            if blockagotchi_id >= cursor and all(blockagotchi_id in ids for ids in rest)
+        ))
+        return matches[:limit], matches[limit] if len(matches) > limit else None
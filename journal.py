@@ -0,0 +1,188 @@
+"""Append-only journal of advance inputs.
+
+Every advance input (metadata and payload) is appended to the journal before
+it is handled. The journal is split into segments named after the first
+input index they hold; each record is the input index, the length and the
+CRC-32 of its JSON encoding. Together with the snapshots written by
+snapshot.py as checkpoints, the state at any input can be rebuilt from the
+nearest earlier snapshot plus the journal records after it. Rejected inputs
+are journaled too; the advance handler rolls them back, so replaying them
+leaves the state as the rollup did.
+
+The status and the notices and reports of every handled input are written
+to a second journal of the same format, in the "outputs" subdirectory.
+When the rollup delivers again an input the recovered state already
+contains, they are sent again instead of handling the input a second time.
+"""
+import json
+import logging
+import os
+import struct
+import zlib
+from typing import Callable, Iterator, List, Optional, Tuple
+
+import snapshot
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"BGJN"
+VERSION = 1
+HEADER = struct.Struct("<4sH")
+RECORD = struct.Struct("<qII")
+
+class JournalError(Exception):
+    pass
+
+def segment_path(directory: str, first_input_index: int) -> str:
+    return os.path.join(directory, f"{first_input_index:012d}.journal")
+
+def segments(directory: str) -> List[Tuple[int, str]]:
+    """(first input index, path) of every segment, oldest first."""
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        (int(name[:-len(".journal")]), os.path.join(directory, name))
+        for name in os.listdir(directory) if name.endswith(".journal")
+    )
+
+def scan_segment(path: str) -> Iterator[Tuple[int, int, dict]]:
+    """Yield (input index, end offset, data) for each complete record.
+
+    Reading stops at the first torn or corrupt record, which can only be the
+    tail of a segment that was being written when the process stopped.
+    """
+    with open(path, "rb") as file:
+        data = file.read()
+    if len(data) < HEADER.size:
+        return
+    magic, version = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise JournalError(f"'{path}' is not a blockagotchi journal segment")
+    if version != VERSION:
+        raise JournalError(f"Journal segment '{path}' has unsupported version {version}")
+    offset = HEADER.size
+    while offset + RECORD.size <= len(data):
+        input_index, size, checksum = RECORD.unpack_from(data, offset)
+        start = offset + RECORD.size
+        record = data[start:start + size]
+        if len(record) != size or zlib.crc32(record) != checksum:
+            logger.warning(f"Journal segment '{path}' has a torn record at offset {offset}")
+            return
+        offset = start + size
+        yield input_index, offset, json.loads(record)
+
+def read_journal(directory: str, start: int = 0, stop: Optional[int] = None) -> Iterator[Tuple[int, dict]]:
+    """Yield (input index, data) for the journaled inputs in [start, stop]."""
+    found = segments(directory)
+    for position, (first_input_index, path) in enumerate(found):
+        # Skip whole segments that end before the requested range
+        if position + 1 < len(found) and found[position + 1][0] <= start:
+            continue
+        if stop is not None and first_input_index > stop:
+            return
+        for input_index, _, data in scan_segment(path):
+            if stop is not None and input_index > stop:
+                return
+            if input_index >= start:
+                yield input_index, data
+
+class Journal:
+    SEGMENT_BYTES = 64 * 1024 * 1024
+
+    def __init__(self, directory: str, segment_bytes: int = SEGMENT_BYTES):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.file = None
+        self.last_input_index = -1
+        os.makedirs(directory, exist_ok=True)
+
+        found = segments(directory)
+        if found:
+            # Reopen the last segment, dropping a torn tail left by a crash
+            path = found[-1][1]
+            end = HEADER.size
+            for input_index, end, _ in scan_segment(path):
+                self.last_input_index = input_index
+            if self.last_input_index < 0:
+                self.last_input_index = found[-1][0] - 1
+            self.file = open(path, "r+b")
+            self.file.truncate(end)
+            self.file.seek(end)
+
+    def append(self, data: dict) -> bool:
+        """Append an advance input; inputs already in the journal are ignored."""
+        return self.write(data["metadata"]["input_index"], data)
+
+    def write(self, input_index: int, record: dict) -> bool:
+        if input_index <= self.last_input_index:
+            return False
+        if self.file is None or self.file.tell() >= self.segment_bytes:
+            self.roll(input_index)
+        data = json.dumps(record, separators=(",", ":")).encode("utf-8")
+        self.file.write(RECORD.pack(input_index, len(data), zlib.crc32(data)) + data)
+        self.file.flush()
+        self.last_input_index = input_index
+        return True
+
+    def roll(self, first_input_index: int) -> None:
+        self.close()
+        self.file = open(segment_path(self.directory, first_input_index), "wb")
+        self.file.write(HEADER.pack(MAGIC, VERSION))
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+
+def outputs_dir(directory: str) -> str:
+    return os.path.join(directory, "outputs")
+
+class OutputJournal(Journal):
+    """Status and outputs of every handled advance input, by input index."""
+    def __init__(self, directory: str, segment_bytes: int = Journal.SEGMENT_BYTES):
+        super().__init__(directory, segment_bytes)
+        self.records: Optional[Iterator[Tuple[int, dict]]] = None
+        self.current: Optional[Tuple[int, dict]] = None
+
+    def record(self, input_index: int, status: str, outputs: List[Tuple[str, dict]]) -> bool:
+        """Record the status and the pending (endpoint, body) outputs of an input."""
+        return self.write(input_index, {"status": status, "outputs": [[endpoint, body["payload"]] for endpoint, body in outputs]})
+
+    def recorded(self, input_index: int) -> Optional[dict]:
+        """Status and outputs recorded for ``input_index``; inputs must be asked for in increasing order."""
+        if self.records is None:
+            self.records = read_journal(self.directory, input_index, self.last_input_index)
+            self.current = next(self.records, None)
+        while self.current is not None and self.current[0] < input_index:
+            self.current = next(self.records, None)
+        return self.current[1] if self.current is not None and self.current[0] == input_index else None
+
+def replay(handle: Callable[[dict], str], records: Iterator[Tuple[int, dict]]) -> int:
+    """Feed journaled inputs to an advance handler; returns the last input index."""
+    last_input_index = -1
+    for input_index, data in records:
+        handle(data)
+        last_input_index = input_index
+    return last_input_index
+
+def recover(handle: Callable[[dict], str], state: dict, snapshot_dir: Optional[str], journal_dir: Optional[str],
+            stop: Optional[int] = None) -> int:
+    """Rebuild ``state`` up to input ``stop`` (or the end of the journal).
+
+    The nearest snapshot at or before ``stop`` is restored and the journal
+    records after it are replayed through ``handle``. Returns the index of
+    the last input the state contains, or -1 if there was nothing to load.
+    """
+    last_input_index = -1
+    path = snapshot.latest_snapshot(snapshot_dir, stop) if snapshot_dir else None
+    if path:
+        last_input_index = snapshot.load_snapshot(path, state)
+        logger.info(f"Restored state from snapshot {path} at input {last_input_index}")
+    if journal_dir:
+        replayed = replay(handle, read_journal(journal_dir, last_input_index + 1, stop))
+        if replayed >= 0:
+            logger.info(f"Replayed journal inputs {last_input_index + 1} to {replayed}")
+            last_input_index = replayed
+    return last_input_index
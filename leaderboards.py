@@ -0,0 +1,91 @@
+from typing import Dict, List, Optional, Tuple
+
+from blockagotchi import DAY
+from ranking import RankingIndex
+
+WEEK = 7 * DAY
+# The epoch fell on a Thursday; shifting by 3 days starts weeks on Monday
+WEEK_OFFSET = 3 * DAY
+
+class Leaderboard:
+    """Care points per user within the current window of a fixed length, ranked.
+
+    Windows are aligned to the epoch, so every node agrees on them. Points
+    recorded in a new window first roll the board over: the standings of
+    the window that ended are kept as its final top table, and the ranking
+    starts again from zero. A board without a length never rolls over.
+    """
+    FINAL_SIZE = 100
+
+    def __init__(self, length: Optional[int] = None, offset: int = 0):
+        self.length = length
+        self.offset = offset
+        self.window = None
+        self.ranking = RankingIndex()
+        self.final_window = None
+        self.final: List[Tuple[str, int]] = []
+
+    def clear(self) -> None:
+        self.window = None
+        self.ranking.clear()
+        self.final_window = None
+        self.final = []
+
+    def window_of(self, now: int) -> int:
+        return 0 if self.length is None else (now + self.offset) // self.length
+
+    def window_start(self, window: int) -> int:
+        return 0 if self.length is None else window * self.length - self.offset
+
+    def roll(self, now: int) -> None:
+        window = self.window_of(now)
+        if window == self.window:
+            return
+        if self.window is not None and len(self.ranking):
+            self.final_window = self.window
+            self.final = self.top(0, self.FINAL_SIZE)
+        self.window = window
+        # A new index rather than a cleared one, so a rolled back input can put the old one back
+        self.ranking = RankingIndex()
+
+    def record(self, user_id: str, points: int, now: int) -> None:
+        self.roll(now)
+        self.ranking.set(user_id, (self.ranking.score(user_id) or 0) + points)
+
+    def top(self, offset: int, limit: int) -> List[Tuple[str, int]]:
+        ranking = self.ranking
+        return [(user_id, ranking.score(user_id)) for user_id in ranking.page(offset, limit)]
+
+    def standings(self, now: int, offset: int, limit: int) -> Tuple[int, List[Tuple[str, int]], int]:
+        """Window holding ``now``, a page of its (user, points) standings and the number of users ranked."""
+        window = self.window_of(now)
+        if window != self.window:
+            # Nothing was recorded since the window started
+            return window, [], 0
+        return window, self.top(offset, limit), len(self.ranking)
+
+    def previous(self, now: int) -> Tuple[int, List[Tuple[str, int]]]:
+        """The window before the one holding ``now`` and its final top table."""
+        window = self.window_of(now) - 1
+        if window == self.window:
+            return window, self.top(0, self.FINAL_SIZE)
+        if window == self.final_window:
+            return window, self.final
+        return window, []
+
+class CareLeaderboards:
+    """Daily, weekly and all-time boards of the happiness users' care actions gave their blockagotchis."""
+    WINDOWS = {"daily": (DAY, 0), "weekly": (WEEK, WEEK_OFFSET), "all_time": (None, 0)}
+
+    def __init__(self):
+        self.boards: Dict[str, Leaderboard] = {name: Leaderboard(length, offset) for name, (length, offset) in self.WINDOWS.items()}
+
+    def clear(self) -> None:
+        for board in self.boards.values():
+            board.clear()
+
+    def record(self, user_id: str, points: int, now: int) -> None:
+        if points <= 0:
+            return
+        for board in self.boards.values():
+            board.record(user_id, points, now)
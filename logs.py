@@ -0,0 +1,146 @@
+"""Structured event logging for the advance and inspect hot paths.
+
+    log.info("advance", "fed", user_id=user_id, blockagotchi_id=blockagotchi.id, food_type=food_type)
+
+An event is a subsystem, a name and keyword fields. Fields are stored as
+given and only rendered, as ``name key=value ...``, when the event is
+actually written; a field may also be a zero-argument callable that is only
+called then. Configuration comes from the environment:
+
+- ``LOG_LEVEL``: default level, shared with cartesi_wallet (INFO)
+- ``LOG_LEVELS``: per-subsystem levels, e.g. ``advance=WARNING,rollup=ERROR``
+- ``LOG_SAMPLE``: write one in N of an event, e.g. ``advance.input=100``
+- ``LOG_RING_SIZE``, ``LOG_RING_LEVEL``: recent events kept in memory (1000, INFO)
+
+Every event at or above the ring level goes to the ring buffer, whatever
+its subsystem level or sampling, and ``dump`` writes the buffer out when
+something fails. The ring keeps the fields as given, so events should carry
+small values such as ids and sizes rather than raw payloads. Unknown level
+names are rejected when the configuration is read.
+"""
+from collections import deque
+from datetime import datetime, timezone
+import json
+import logging
+import os
+from time import time
+from typing import Any, Deque, Dict, Optional, Tuple
+
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+
+Record = Tuple[float, int, str, str, Dict[str, Any]]
+
+def parse_level(name: str) -> int:
+    level = logging.getLevelName(name.strip().upper())
+    if not isinstance(level, int):
+        raise ValueError(f"Unknown log level '{name}', expected one of DEBUG, INFO, WARNING, ERROR or CRITICAL")
+    return level
+
+def render_value(value: Any) -> str:
+    if callable(value):
+        value = value()
+    if isinstance(value, str):
+        return json.dumps(value) if not value or " " in value or '"' in value or "=" in value else value
+    return str(value)
+
+class Message:
+    """Event rendered only when the logging handler formats it."""
+    __slots__ = ("event", "fields")
+
+    def __init__(self, event: str, fields: Dict[str, Any]):
+        self.event = event
+        self.fields = fields
+
+    def __str__(self) -> str:
+        return " ".join([self.event] + [f"{key}={render_value(value)}" for key, value in self.fields.items()])
+
+class EventLog:
+    def __init__(self, level: int = INFO, levels: Optional[Dict[str, int]] = None,
+                 sample: Optional[Dict[str, int]] = None, ring_size: int = 1000, ring_level: int = INFO):
+        self.level = level
+        self.levels: Dict[str, int] = {}
+        self.sample: Dict[Tuple[str, str], int] = {}
+        self.counts: Dict[Tuple[str, str], int] = {}
+        self.ring: Optional[Deque[Record]] = deque(maxlen=ring_size) if ring_size else None
+        self.ring_level = ring_level
+        self.loggers: Dict[str, logging.Logger] = {}
+        for subsystem, subsystem_level in (levels or {}).items():
+            self.set_level(subsystem, subsystem_level)
+        for name, every in (sample or {}).items():
+            self.set_sample(name, every)
+
+    @classmethod
+    def from_environ(cls) -> "EventLog":
+        def pairs(name: str) -> Dict[str, str]:
+            entries = (entry.split("=", 1) for entry in os.environ.get(name, "").split(",") if "=" in entry)
+            return {key.strip(): value.strip() for key, value in entries}
+
+        return cls(
+            level=parse_level(os.environ.get("LOG_LEVEL", "INFO")),
+            levels={subsystem: parse_level(level) for subsystem, level in pairs("LOG_LEVELS").items()},
+            sample={name: int(every) for name, every in pairs("LOG_SAMPLE").items()},
+            ring_size=int(os.environ.get("LOG_RING_SIZE", "1000")),
+            ring_level=parse_level(os.environ.get("LOG_RING_LEVEL", "INFO")),
+        )
+
+    def set_level(self, subsystem: str, level: int) -> None:
+        self.levels[subsystem] = level
+        self.logger(subsystem).setLevel(level)
+
+    def set_sample(self, name: str, every: int) -> None:
+        """Write only the first of every ``every`` events named ``subsystem.event``."""
+        subsystem, event = name.split(".", 1)
+        self.sample[(subsystem, event)] = every
+
+    def logger(self, subsystem: str) -> logging.Logger:
+        logger = self.loggers.get(subsystem)
+        if logger is None:
+            logger = self.loggers[subsystem] = logging.getLogger(subsystem)
+        return logger
+
+    def enabled(self, subsystem: str, level: int) -> bool:
+        return level >= self.levels.get(subsystem, self.level)
+
+    def log(self, level: int, subsystem: str, event: str, fields: Dict[str, Any], stacklevel: int = 3) -> None:
+        if self.ring is not None and level >= self.ring_level:
+            self.ring.append((time(), level, subsystem, event, fields))
+        if level < self.levels.get(subsystem, self.level):
+            return
+        every = self.sample.get((subsystem, event))
+        if every:
+            count = self.counts.get((subsystem, event), 0)
+            self.counts[(subsystem, event)] = count + 1
+            if count % every:
+                return
+            # The ring holds the original fields
+            fields = dict(fields, sampled=f"1/{every}")
+        self.logger(subsystem).log(level, Message(event, fields), stacklevel=stacklevel)
+
+    def debug(self, subsystem: str, event: str, **fields) -> None:
+        self.log(DEBUG, subsystem, event, fields)
+
+    def info(self, subsystem: str, event: str, **fields) -> None:
+        self.log(INFO, subsystem, event, fields)
+
+    def warning(self, subsystem: str, event: str, **fields) -> None:
+        self.log(WARNING, subsystem, event, fields)
+
+    def error(self, subsystem: str, event: str, **fields) -> None:
+        self.log(ERROR, subsystem, event, fields)
+
+    def dump(self, reason: str) -> int:
+        """Write out and clear the ring buffer; returns the number of events written."""
+        if not self.ring:
+            return 0
+        records, self.ring = list(self.ring), deque(maxlen=self.ring.maxlen)
+        logger = self.logger("logs")
+        logger.error(f"{reason}. Last {len(records)} events:")
+        for created, level, subsystem, event, fields in records:
+            logger.error("  %s %s %s %s", datetime.fromtimestamp(created, timezone.utc).isoformat(timespec="milliseconds"),
+                         logging.getLevelName(level), subsystem, Message(event, fields))
+        return len(records)
+
+log = EventLog.from_environ()
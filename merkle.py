@@ -0,0 +1,262 @@
+"""Incremental Merkle commitment over the blockagotchis, users and balances.
+
+Each kind of entity has its own sparse Merkle tree, keyed by the SHA-256 of
+its MessagePack encoded key (blockagotchi id, user address or account
+address) and walked by the bits of that hash. A subtree holding a single
+entity is replaced by its leaf, so a tree only depends on the entities in
+it, and leaves sit about log2(n) levels deep. The state root is the hash of
+the three tree roots.
+
+Entities are only marked when they change; the paths of the marked leaves
+are rehashed the next time the root or a proof is asked for, in O(log n)
+hashes per changed entity.
+
+    leaf   = SHA-256(0x00 || key hash || leaf value)
+    branch = SHA-256(0x01 || left || right), with 32 zero bytes for empty
+    root   = SHA-256(blockagotchis root || users root || accounts root)
+"""
+import hashlib
+from typing import Dict, List, Optional, Tuple
+
+from encoding import pack
+
+EMPTY = bytes(32)
+LEAF = b"\x00"
+BRANCH = b"\x01"
+
+def sha256(data: bytes) -> bytes:
+    return hashlib.sha256(data).digest()
+
+def key_hash(key) -> bytes:
+    return sha256(pack(key))
+
+def bit(key: bytes, depth: int) -> int:
+    return (key[depth >> 3] >> (7 - (depth & 7))) & 1
+
+def branch_hash(left, right) -> bytes:
+    return sha256(BRANCH + (EMPTY if left is None else left.hash) + (EMPTY if right is None else right.hash))
+
+class Leaf:
+    __slots__ = ("key", "value", "hash")
+
+    def __init__(self, key: bytes, value: bytes):
+        self.key = key
+        self.value = value
+        self.hash = sha256(LEAF + key + value)
+
+class Branch:
+    __slots__ = ("left", "right", "hash")
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+        self.hash = branch_hash(left, right)
+
+def split(a: Leaf, b: Leaf, depth: int) -> Branch:
+    """Smallest subtree at ``depth`` holding two leaves."""
+    side = bit(a.key, depth)
+    if side != bit(b.key, depth):
+        return Branch(b, a) if side else Branch(a, b)
+    child = split(a, b, depth + 1)
+    return Branch(None, child) if side else Branch(child, None)
+
+def put(node, leaf: Leaf, depth: int):
+    if node is None:
+        return leaf
+    if type(node) is Leaf:
+        return leaf if node.key == leaf.key else split(node, leaf, depth)
+    if bit(leaf.key, depth):
+        node.right = put(node.right, leaf, depth + 1)
+    else:
+        node.left = put(node.left, leaf, depth + 1)
+    node.hash = branch_hash(node.left, node.right)
+    return node
+
+def remove(node, key: bytes, depth: int):
+    if node is None:
+        return None
+    if type(node) is Leaf:
+        return None if node.key == key else node
+    if bit(key, depth):
+        node.right = remove(node.right, key, depth + 1)
+    else:
+        node.left = remove(node.left, key, depth + 1)
+    # A subtree left with a single leaf collapses into it
+    if node.left is None and (node.right is None or type(node.right) is Leaf):
+        return node.right
+    if node.right is None and type(node.left) is Leaf:
+        return node.left
+    node.hash = branch_hash(node.left, node.right)
+    return node
+
+class MerkleTree:
+    def __init__(self):
+        self.top = None
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    @property
+    def root(self) -> bytes:
+        return EMPTY if self.top is None else self.top.hash
+
+    def set(self, key, value: Optional[bytes]) -> None:
+        """Set the leaf value of ``key``; None removes the leaf."""
+        hashed = key_hash(key)
+        found = self.find(hashed) is not None
+        if value is None:
+            if found:
+                self.top = remove(self.top, hashed, 0)
+                self.size -= 1
+            return
+        self.top = put(self.top, Leaf(hashed, value), 0)
+        if not found:
+            self.size += 1
+
+    def find(self, hashed: bytes) -> Optional[Leaf]:
+        node, depth = self.top, 0
+        while type(node) is Branch:
+            node = node.right if bit(hashed, depth) else node.left
+            depth += 1
+        return node if node is not None and node.key == hashed else None
+
+    def proof(self, key) -> Optional[Tuple[bytes, List[bytes]]]:
+        """Leaf value of ``key`` and the sibling hashes from the root down, or None if it has no leaf."""
+        hashed = key_hash(key)
+        siblings = []
+        node, depth = self.top, 0
+        while type(node) is Branch:
+            if bit(hashed, depth):
+                sibling, node = node.left, node.right
+            else:
+                sibling, node = node.right, node.left
+            siblings.append(EMPTY if sibling is None else sibling.hash)
+            depth += 1
+        if node is None or node.key != hashed:
+            return None
+        return node.value, siblings
+
+def verify(key, value: bytes, siblings: List[bytes], root: bytes) -> bool:
+    """Check an inclusion proof of one tree against its root."""
+    hashed = key_hash(key)
+    node = sha256(LEAF + hashed + value)
+    for depth in range(len(siblings) - 1, -1, -1):
+        if bit(hashed, depth):
+            node = sha256(BRANCH + siblings[depth] + node)
+        else:
+            node = sha256(BRANCH + node + siblings[depth])
+    return node == root
+
+def inventory_value(inventory) -> list:
+    return [[item.item_id, quantity] for item, quantity in inventory.entries()]
+
+def blockagotchi_value(blockagotchi) -> bytes:
+    window = blockagotchi.walk_window
+    return pack([
+        blockagotchi.id, blockagotchi.owner, blockagotchi.name, blockagotchi.birth_time, blockagotchi.age,
+        blockagotchi.stage, blockagotchi.type, blockagotchi.biotype, blockagotchi.condition,
+        blockagotchi.happiness, blockagotchi.last_fed_time, blockagotchi.last_walk_time, blockagotchi.last_bath_time,
+        blockagotchi.alive, blockagotchi.overall_score, blockagotchi.feed_count, list(blockagotchi.diet_counts),
+        window.last_day, window.total, list(window.counts), inventory_value(blockagotchi.items),
+    ])
+
+def user_value(user) -> bytes:
+    return pack([user.id, user.blockagotchi.id if user.blockagotchi else None, inventory_value(user.items)])
+
+def account_value(balance) -> Optional[bytes]:
+    # Amounts are decimal strings, they do not fit in MessagePack integers.
+    # Empty accounts have no leaf, as they are not part of the state.
+    erc20 = [[token, str(amount)] for token, amount in sorted(balance._erc20.items()) if amount]
+    erc721 = [[token, [str(token_id) for token_id in sorted(ids)]] for token, ids in sorted(balance._erc721.items()) if ids]
+    if not (balance._ether or erc20 or erc721):
+        return None
+    return pack([balance._account, str(balance._ether), erc20, erc721])
+
+class StateCommitment:
+    """The three trees and the entities changed since they were last rehashed."""
+    KINDS = ("blockagotchi", "user", "account")
+
+    def __init__(self):
+        self.trees: Dict[str, MerkleTree] = {kind: MerkleTree() for kind in self.KINDS}
+        self._blockagotchis: Dict[int, "BlockaGotchi"] = {}
+        self._users: Dict[str, "User"] = {}
+        self._accounts: Dict[str, "Balance"] = {}
+
+    def clear(self) -> None:
+        self.trees = {kind: MerkleTree() for kind in self.KINDS}
+        self._blockagotchis = {}
+        self._users = {}
+        self._accounts = {}
+
+    def touch_blockagotchi(self, blockagotchi: "BlockaGotchi") -> None:
+        self._blockagotchis[blockagotchi.id] = blockagotchi
+
+    def touch_user(self, user: "User") -> None:
+        self._users[user.id] = user
+
+    def touch_account(self, balance: "Balance") -> None:
+        self._accounts[balance._account] = balance
+
+    def remove_blockagotchi(self, blockagotchi_id: int) -> None:
+        self._blockagotchis.pop(blockagotchi_id, None)
+        self.trees["blockagotchi"].set(blockagotchi_id, None)
+
+    def remove_user(self, user_id: str) -> None:
+        self._users.pop(user_id, None)
+        self.trees["user"].set(user_id, None)
+
+    def rebuild(self, state: dict) -> None:
+        self.clear()
+        for blockagotchi in state["blockagotchis"].values():
+            self.touch_blockagotchi(blockagotchi)
+        for user in state["users"].values():
+            self.touch_user(user)
+        for balance in state["wallet"]._accounts.values():
+            self.touch_account(balance)
+        self.commit()
+
+    def commit(self) -> None:
+        """Rehash the paths of the entities changed since the last commit."""
+        if self._blockagotchis:
+            tree = self.trees["blockagotchi"]
+            for blockagotchi_id, blockagotchi in self._blockagotchis.items():
+                tree.set(blockagotchi_id, blockagotchi_value(blockagotchi))
+            self._blockagotchis = {}
+        if self._users:
+            tree = self.trees["user"]
+            for user_id, user in self._users.items():
+                tree.set(user_id, user_value(user))
+            self._users = {}
+        if self._accounts:
+            tree = self.trees["account"]
+            for address, balance in self._accounts.items():
+                tree.set(address, account_value(balance))
+            self._accounts = {}
+
+    def roots(self) -> Dict[str, str]:
+        self.commit()
+        return {kind: "0x" + tree.root.hex() for kind, tree in self.trees.items()}
+
+    def root(self) -> bytes:
+        self.commit()
+        return sha256(b"".join(tree.root for tree in self.trees.values()))
+
+    def proof(self, kind: str, key) -> Optional[dict]:
+        """Inclusion proof of one entity against the state root, or None if it has no leaf."""
+        tree = self.trees.get(kind)
+        if tree is None:
+            raise ValueError(f"Unknown kind '{kind}', expected one of {list(self.KINDS)}")
+        self.commit()
+        found = tree.proof(key)
+        if found is None:
+            return None
+        value, siblings = found
+        return {
+            "kind": kind,
+            "key": key,
+            "value": "0x" + value.hex(),
+            "siblings": ["0x" + sibling.hex() for sibling in siblings],
+            "roots": self.roots(),
+            "root": "0x" + self.root().hex(),
+        }
@@ -0,0 +1,101 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+import threading
+import time
+from typing import Dict, Iterator, Tuple
+
+class Histogram:
+    """Fixed-bucket histogram; observing a value is a bisect and two adds."""
+    __slots__ = ("bounds", "buckets", "count", "total", "max")
+
+    # Upper bounds in seconds, or in bytes for the size histograms
+    SECONDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+    BYTES = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, value: float) -> None:
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        # Upper bound of the bucket holding the q-th value
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return self.bounds[index] if index < len(self.bounds) else self.max
+        return 0
+
+    def to_dict(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "mean": self.total / self.count if self.count else 0,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+        }
+
+class Metrics:
+    """Counters and histograms by name; safe to update from the query server threads."""
+    def __init__(self):
+        self.counters: Dict[str, int] = {}
+        self.histograms: Dict[str, Histogram] = {}
+        self.lock = threading.Lock()
+
+    def reset(self) -> None:
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def _increment(self, name: str, value: int) -> None:
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def _observe(self, name: str, value: float, bounds: Tuple[float, ...]) -> None:
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(bounds)
+        histogram.observe(value)
+
+    def increment(self, name: str, value: int = 1) -> None:
+        with self.lock:
+            self._increment(name, value)
+
+    def observe(self, name: str, value: float, bounds: Tuple[float, ...] = Histogram.SECONDS) -> None:
+        with self.lock:
+            self._observe(name, value, bounds)
+
+    def observe_size(self, name: str, size: int) -> None:
+        self.observe(name, size, Histogram.BYTES)
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def record(self, kind: str, name: str, status: str, seconds: float) -> None:
+        with self.lock:
+            self._observe(f"{kind}.{name}", seconds, Histogram.SECONDS)
+            self._increment(f"{kind}.{name}.{status}", 1)
+
+    def to_dict(self) -> Dict[str, dict]:
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "histograms": {name: histogram.to_dict() for name, histogram in self.histograms.items()},
+            }
+
+metrics = Metrics()
@@ -0,0 +1,208 @@
+"""Read-only inspect server over the snapshots published by the dapp.
+
+    SNAPSHOT_DIR=/data/snapshots SNAPSHOT_INTERVAL=10 python3 dapp.py
+    python3 query_server.py --snapshots /data/snapshots --port 8081 --workers 8
+
+Serves the InspectHandler routes at ``/inspect/<route>``, answering like
+the rollup node's inspect endpoint, from the latest snapshot in the
+directory. Each snapshot is restored into a state of its own, off the
+request path, and then published by swapping a single reference. A
+published state is never modified again, so any number of pool threads
+read it without locks while the next one loads, and the dapp's advance
+loop is never involved.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+import os
+import sys
+import threading
+from typing import Dict, Optional
+from urllib.parse import unquote
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(ROOT, "handlers", "inspect")]
+
+from cartesi_wallet.balance import Balance
+from changes import ChangeLog
+from columns import PopulationColumns
+from indexes import PetIndexes
+from inspect_handler import InspectHandler
+from history import HistoryStore
+from leaderboards import CareLeaderboards
+from merkle import StateCommitment
+from ranking import RankingIndex
+from rollup_client import OfflineRollupClient
+from scheduler import DeadlineScheduler
+from shop import Shop
+import snapshot
+
+logger = logging.getLogger(__name__)
+
+class SnapshotWallet:
+    """Accounts of a restored state; unlike the wallet module, reading a balance does not create an account."""
+    def __init__(self):
+        self._accounts: Dict[str, Balance] = {}
+
+    def balance_get(self, account: str) -> Balance:
+        balance = self._accounts.get(account)
+        return balance if balance is not None else Balance(account)
+
+def empty_state(history_dir: Optional[str]) -> dict:
+    # Same keys as GlobalState, with no listeners attached: published states never change
+    return {
+        "blockagotchis": {},
+        "ranking": RankingIndex(),
+        "scheduler": DeadlineScheduler(),
+        "columns": PopulationColumns(),
+        "indexes": PetIndexes(),
+        "changes": ChangeLog(),
+        "leaderboards": CareLeaderboards(),
+        "history": HistoryStore(history_dir, writable=False),
+        "merkle": StateCommitment(),
+        "users": {},
+        "tokens": {},
+        "global_eggs": 0,
+        "next_blockagotchi_id": 1,
+        "wallet": SnapshotWallet(),
+        "shop": Shop(),
+    }
+
+class StateView:
+    def __init__(self, path: str, state: dict, input_index: int):
+        self.path = path
+        self.state = state
+        self.input_index = input_index
+
+class SnapshotPublisher:
+    """Loads new snapshots from a directory and publishes them as immutable views."""
+    def __init__(self, directory: str, history_dir: Optional[str] = None, verify: bool = True):
+        self.directory = directory
+        self.history_dir = history_dir
+        self.verify = verify
+        self.view: Optional[StateView] = None
+        self.failed: Optional[str] = None
+
+    def refresh(self) -> bool:
+        """Publish the latest snapshot if it is newer than the current view."""
+        path = snapshot.latest_snapshot(self.directory)
+        view = self.view
+        if path is None or path == self.failed or (view is not None and view.path == path):
+            return False
+        state = empty_state(self.history_dir)
+        try:
+            # Later snapshots extend the same history, so only the first one is verified
+            input_index = snapshot.load_snapshot(path, state, self.verify and view is None)
+        except (OSError, snapshot.SnapshotError) as error:
+            logger.error(f"Failed to load snapshot '{path}'. {error}")
+            self.failed = path
+            return False
+        state["columns"].sync()
+        self.view = StateView(path, state, input_index)
+        logger.info(f"Published snapshot at input {input_index}")
+        return True
+
+    def run(self, interval: float, stopped: threading.Event) -> None:
+        while not stopped.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Failed to refresh the published snapshot")
+            stopped.wait(interval)
+
+class PooledHTTPServer(HTTPServer):
+    """HTTPServer handing each connection to a fixed pool of worker threads."""
+    def __init__(self, address, handler_class, publisher: SnapshotPublisher, workers: int):
+        super().__init__(address, handler_class)
+        self.publisher = publisher
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="query")
+
+    def process_request(self, request, client_address) -> None:
+        self.pool.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address) -> None:
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.pool.shutdown(wait=True)
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:
+        if not self.path.startswith("/inspect/"):
+            self.reply(404, {"error": f"Unknown path '{self.path}'"})
+            return
+        self.inspect(unquote(self.path[len("/inspect/"):]).encode("utf-8"))
+
+    def do_POST(self) -> None:
+        if self.path.rstrip("/") != "/inspect":
+            self.reply(404, {"error": f"Unknown path '{self.path}'"})
+            return
+        self.inspect(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+
+    def inspect(self, payload: bytes) -> None:
+        # Hold on to one view for the whole request, even if a newer one is published meanwhile
+        view = self.server.publisher.view
+        if view is None:
+            self.reply(503, {"error": "No snapshot has been published yet"})
+            return
+        rollup = OfflineRollupClient()
+        status = InspectHandler(rollup, view.state).handle({"payload": "0x" + payload.hex()})
+        self.reply(200, {
+            "status": "Accepted" if status == "accept" else "Rejected",
+            "exception_payload": None,
+            "reports": [body for _, body in rollup.pending],
+            "processed_input_count": view.input_index + 1,
+        })
+
+    def reply(self, code: int, body: dict) -> None:
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug(format, *args)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--snapshots", default=os.environ.get("SNAPSHOT_DIR"), help="snapshot directory (SNAPSHOT_DIR of the dapp)")
+    parser.add_argument("--history", default=os.environ.get("HISTORY_DIR"), help="history directory (HISTORY_DIR of the dapp)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--workers", type=int, default=8, help="request worker threads")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between checks for a new snapshot")
+    parser.add_argument("--no-verify", action="store_true", help="skip checking the first restored state against its digest and activity history")
+    args = parser.parse_args()
+    if not args.snapshots:
+        parser.error("--snapshots or SNAPSHOT_DIR is required")
+
+    logging.basicConfig(level="INFO")
+    publisher = SnapshotPublisher(args.snapshots, args.history or os.path.join(args.snapshots, "history"), not args.no_verify)
+    publisher.refresh()
+    stopped = threading.Event()
+    threading.Thread(target=publisher.run, args=(args.interval, stopped), name="publisher", daemon=True).start()
+
+    server = PooledHTTPServer((args.host, args.port), QueryRequestHandler, publisher, args.workers)
+    logger.info(f"Serving snapshots from {args.snapshots} on {args.host}:{args.port} with {args.workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stopped.set()
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+from bisect import bisect_left, insort
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+RankKey = Tuple[int, Any]
+
+class RankingIndex:
+    """Blockagotchi ids ordered by overall score, highest first.
+
+    Keys are ``(-overall_score, id)`` so ties keep the id order the old
+    ``sorted(..., reverse=True)`` produced. They live in sorted buckets of
+    bounded size, with a Fenwick tree over the bucket lengths, so updates,
+    rank lookups and page seeks are all logarithmic in the population.
+    """
+    LOAD = 256
+
+    def __init__(self):
+        self._buckets: List[List[RankKey]] = []
+        self._maxes: List[RankKey] = []
+        self._tree: List[int] = []
+        self._keys: Dict[int, RankKey] = {}
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __contains__(self, blockagotchi_id: int) -> bool:
+        return blockagotchi_id in self._keys
+
+    def __iter__(self) -> Iterator[int]:
+        for bucket in self._buckets:
+            for key in bucket:
+                yield key[1]
+
+    def clear(self) -> None:
+        self._buckets = []
+        self._maxes = []
+        self._tree = []
+        self._keys = {}
+
+    def add(self, blockagotchi) -> None:
+        self.set(blockagotchi.id, blockagotchi.overall_score)
+
+    def update(self, blockagotchi) -> None:
+        if blockagotchi.id in self._keys:
+            self.set(blockagotchi.id, blockagotchi.overall_score)
+
+    def set(self, entity_id, score: int) -> None:
+        """Insert ``entity_id`` with ``score``, or move it there; ids of one index must be comparable."""
+        key = (-score, entity_id)
+        old_key = self._keys.get(entity_id)
+        if key == old_key:
+            return
+        if old_key is not None:
+            self._delete(old_key)
+        self._keys[entity_id] = key
+        self._insert(key)
+
+    def score(self, entity_id) -> Optional[int]:
+        key = self._keys.get(entity_id)
+        return None if key is None else -key[0]
+
+    def remove(self, blockagotchi_id: int) -> None:
+        key = self._keys.pop(blockagotchi_id, None)
+        if key is not None:
+            self._delete(key)
+
+    def rank(self, blockagotchi_id) -> Optional[int]:
+        """1-based position of a blockagotchi in the ranking."""
+        key = self._keys.get(blockagotchi_id)
+        if key is None:
+            return None
+        index = bisect_left(self._maxes, key)
+        return self._prefix(index) + bisect_left(self._buckets[index], key) + 1
+
+    def page(self, offset: int = 0, limit: Optional[int] = None) -> List[int]:
+        """Ids at positions ``offset`` to ``offset + limit`` of the ranking."""
+        if offset >= len(self._keys) or limit == 0:
+            return []
+        index, position = self._locate(offset)
+        ids = []
+        while index < len(self._buckets):
+            for key in self._buckets[index][position:]:
+                ids.append(key[1])
+                if limit is not None and len(ids) >= limit:
+                    return ids
+            index += 1
+            position = 0
+        return ids
+
+    def _insert(self, key: RankKey) -> None:
+        if not self._buckets:
+            self._buckets.append([key])
+            self._maxes.append(key)
+            self._rebuild_tree()
+            return
+        index = bisect_left(self._maxes, key)
+        if index == len(self._maxes):
+            index -= 1
+            self._buckets[index].append(key)
+            self._maxes[index] = key
+        else:
+            insort(self._buckets[index], key)
+        self._tree_add(index, 1)
+        if len(self._buckets[index]) > 2 * self.LOAD:
+            bucket = self._buckets[index]
+            self._buckets[index:index + 1] = [bucket[:self.LOAD], bucket[self.LOAD:]]
+            self._maxes[index:index + 1] = [bucket[self.LOAD - 1], bucket[-1]]
+            self._rebuild_tree()
+
+    def _delete(self, key: RankKey) -> None:
+        index = bisect_left(self._maxes, key)
+        bucket = self._buckets[index]
+        del bucket[bisect_left(bucket, key)]
+        if bucket:
+            self._maxes[index] = bucket[-1]
+            self._tree_add(index, -1)
+        else:
+            del self._buckets[index]
+            del self._maxes[index]
+            self._rebuild_tree()
+
+    def _rebuild_tree(self) -> None:
+        tree = [len(bucket) for bucket in self._buckets]
+        for i in range(1, len(tree) + 1):
+            parent = i + (i & -i)
+            if parent <= len(tree):
+                tree[parent - 1] += tree[i - 1]
+        self._tree = tree
+
+    def _tree_add(self, index: int, delta: int) -> None:
+        index += 1
+        while index <= len(self._tree):
+            self._tree[index - 1] += delta
+            index += index & -index
+
+    def _prefix(self, index: int) -> int:
+        # Number of keys in buckets [0, index)
+        total = 0
+        while index > 0:
+            total += self._tree[index - 1]
+            index &= index - 1
+        return total
+
+    def _locate(self, position: int) -> Tuple[int, int]:
+        # Bucket index and offset inside it holding the key at ``position``
+        index = 0
+        step = 1 << (len(self._tree).bit_length() - 1) if self._tree else 0
+        while step:
+            upper = index + step
+            if upper <= len(self._tree) and self._tree[upper - 1] <= position:
+                index = upper
+                position -= self._tree[upper - 1]
+            step >>= 1
+        return index, position
@@ -0,0 +1,77 @@
+from typing import Any, Callable, Dict, Optional, Tuple
+
+class Field:
+    def __init__(self, types, required: bool = True, default: Any = None, minimum: Optional[int] = None):
+        self.types = types if isinstance(types, tuple) else (types,)
+        self.required = required
+        self.default = default
+        self.minimum = minimum
+
+class Schema:
+    """Field checks compiled once into a tuple and run on every payload.
+
+    With ``coerce`` set, string values are converted to the field type, which
+    is how query string parameters are read.
+    """
+    def __init__(self, fields: Dict[str, Any], coerce: bool = False):
+        self.coerce = coerce
+        self.fields: Tuple[Tuple[str, Field], ...] = tuple(
+            (name, spec if isinstance(spec, Field) else Field(spec)) for name, spec in fields.items()
+        )
+
+    def validate(self, values: dict) -> dict:
+        if not isinstance(values, dict):
+            raise ValueError("Payload must be a JSON object")
+        kwargs = {}
+        for name, field in self.fields:
+            if name not in values:
+                if field.required:
+                    raise ValueError(f"Missing field '{name}'")
+                kwargs[name] = field.default
+                continue
+            value = values[name]
+            if self.coerce and isinstance(value, str) and str not in field.types:
+                value = self.convert(name, value, field.types[0])
+            if not isinstance(value, field.types) or (isinstance(value, bool) and bool not in field.types):
+                expected = " or ".join(t.__name__ for t in field.types)
+                raise ValueError(f"Field '{name}' must be {expected}")
+            if field.minimum is not None and value < field.minimum:
+                raise ValueError(f"Field '{name}' must be at least {field.minimum}")
+            kwargs[name] = value
+        return kwargs
+
+    def convert(self, name: str, value: str, type: type) -> Any:
+        if type is bool:
+            if value.lower() in ("true", "false"):
+                return value.lower() == "true"
+            raise ValueError(f"Field '{name}' must be true or false")
+        try:
+            return type(value)
+        except ValueError:
+            raise ValueError(f"Field '{name}' must be {type.__name__}") from None
+
+class Route:
+    def __init__(self, name: str, handler: Callable, schema: Schema):
+        self.name = name
+        self.handler = handler
+        self.schema = schema
+
+class Registry:
+    """Maps advance actions or inspect routes to their handler and schema."""
+    def __init__(self, coerce: bool = False):
+        self.coerce = coerce
+        self.routes: Dict[str, Route] = {}
+
+    def register(self, route: str, /, **fields) -> Callable:
+        def decorator(handler: Callable) -> Callable:
+            if route in self.routes:
+                raise ValueError(f"'{route}' is already registered")
+            self.routes[route] = Route(route, handler, Schema(fields, self.coerce))
+            return handler
+        return decorator
+
+    def get(self, name: str) -> Optional[Route]:
+        return self.routes.get(name)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.routes
@@ -0,0 +1,77 @@
+import logging
+import time
+from typing import List, Tuple
+import requests
+from metrics import metrics
+from logs import log
+
+logger = logging.getLogger(__name__)
+
+class RollupClient:
+    """Shared client for the rollup HTTP server.
+
+    All calls go through one keep-alive session. Notices and reports created
+    while an input is being handled are queued and only posted, in order,
+    right before the next /finish. Request time and error counts for each
+    endpoint are recorded as "rollup.<endpoint>" metrics.
+    """
+    def __init__(self, rollup_server: str):
+        self.rollup_server = rollup_server
+        self.session = requests.Session()
+        self.pending: List[Tuple[str, dict]] = []
+
+    def post(self, endpoint: str, body: dict) -> requests.Response:
+        start = time.perf_counter()
+        try:
+            response = self.session.post(f"{self.rollup_server}/{endpoint}", json=body)
+        except Exception:
+            metrics.increment(f"rollup.{endpoint}.errors")
+            raise
+        finally:
+            metrics.observe(f"rollup.{endpoint}", time.perf_counter() - start)
+        if response.status_code >= 400:
+            metrics.increment(f"rollup.{endpoint}.errors")
+        return response
+
+    def notice(self, payload: str) -> None:
+        self.pending.append(("notice", {"payload": payload}))
+
+    def report(self, payload: str) -> None:
+        self.pending.append(("report", {"payload": payload}))
+
+    def flush(self) -> bool:
+        pending, self.pending = self.pending, []
+        flushed = True
+        for endpoint, body in pending:
+            try:
+                response = self.post(endpoint, body)
+                log.debug("rollup", endpoint, status=response.status_code, body=response.content)
+                flushed = flushed and response.status_code < 400
+            except Exception as error:
+                logger.error(f"Failed to create {endpoint}. {error}")
+                flushed = False
+        return flushed
+
+    def finish(self, finish: dict) -> requests.Response:
+        self.flush()
+        return self.post("finish", finish)
+
+class OfflineRollupClient(RollupClient):
+    """Client for replaying inputs without a rollup server.
+
+    Outputs are counted and dropped instead of being posted.
+    """
+    def __init__(self):
+        self.rollup_server = None
+        self.pending = []
+        self.outputs = 0
+        self.output_bytes = 0
+
+    def post(self, endpoint: str, body: dict) -> requests.Response:
+        raise RuntimeError(f"Cannot post to /{endpoint} while offline")
+
+    def flush(self) -> bool:
+        pending, self.pending = self.pending, []
+        self.outputs += len(pending)
+        self.output_bytes += sum(len(body["payload"]) // 2 - 1 for _, body in pending)
+        return True
@@ -0,0 +1,99 @@
+import heapq
+from typing import Callable, Dict, List, Optional, Tuple
+
+from blockagotchi import BlockaGotchi, DAY
+
+class DeadlineScheduler:
+    """Living blockagotchis keyed on the next time their status can change.
+
+    A blockagotchi's deadline is the earlier of its next birthday, when its
+    age and score change and it may reach the 3, 7, 14 or 21 day stage
+    thresholds, and the moment it has gone more than 7 days without food.
+    Deadlines live in a min-heap, so each input only touches the k
+    blockagotchis that are due, in O(k log n). Entries made stale by a
+    reschedule are skipped when popped.
+    """
+    # check_status kills a blockagotchi after more than 7 whole days unfed
+    STARVATION = 8 * DAY
+
+    def __init__(self):
+        self._heap: List[Tuple[int, int]] = []
+        self._deadlines: Dict[int, int] = {}
+        self._blockagotchis: Dict[int, BlockaGotchi] = {}
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def __contains__(self, blockagotchi_id: int) -> bool:
+        return blockagotchi_id in self._deadlines
+
+    def clear(self) -> None:
+        self._heap = []
+        self._deadlines = {}
+        self._blockagotchis = {}
+
+    def next_deadline(self, blockagotchi: BlockaGotchi) -> int:
+        birthday = blockagotchi.birth_time + (blockagotchi.age + 1) * DAY
+        return min(birthday, blockagotchi.last_fed_time + self.STARVATION)
+
+    def schedule(self, blockagotchi: BlockaGotchi) -> None:
+        if not blockagotchi.alive:
+            self._deadlines.pop(blockagotchi.id, None)
+            self._blockagotchis.pop(blockagotchi.id, None)
+            return
+        deadline = self.next_deadline(blockagotchi)
+        if self._deadlines.get(blockagotchi.id) == deadline:
+            return
+        self._deadlines[blockagotchi.id] = deadline
+        self._blockagotchis[blockagotchi.id] = blockagotchi
+        heapq.heappush(self._heap, (deadline, blockagotchi.id))
+
+    def remove(self, blockagotchi_id: int) -> None:
+        # Its heap entry is skipped as stale
+        self._deadlines.pop(blockagotchi_id, None)
+        self._blockagotchis.pop(blockagotchi_id, None)
+
+    def restore(self, blockagotchi: BlockaGotchi, deadline: int) -> None:
+        """Put back a deadline taken by a run() that was rolled back."""
+        self._deadlines[blockagotchi.id] = deadline
+        self._blockagotchis[blockagotchi.id] = blockagotchi
+        heapq.heappush(self._heap, (deadline, blockagotchi.id))
+
+    def run(self, now: int, before: Optional[Callable[[BlockaGotchi, int], None]] = None) -> List[dict]:
+        """Bring every blockagotchi due at ``now`` up to date.
+
+        ``before`` is called with each due blockagotchi and its deadline
+        before it changes. Returns one event per evolution or death, ordered
+        by deadline and id.
+        """
+        events = []
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            deadline, blockagotchi_id = heapq.heappop(heap)
+            if self._deadlines.get(blockagotchi_id) != deadline:
+                continue
+            del self._deadlines[blockagotchi_id]
+            blockagotchi = self._blockagotchis.pop(blockagotchi_id)
+            if before is not None:
+                before(blockagotchi, deadline)
+
+            blockagotchi.check_status()
+            if not blockagotchi.alive:
+                events.append({"event": "blockagotchi_died", "user_id": blockagotchi.owner, "blockagotchi_id": blockagotchi_id})
+                continue
+
+            # A blockagotchi that was not due for several days may cross more than one stage
+            while True:
+                stage = blockagotchi.stage_code
+                blockagotchi.evolve()
+                if blockagotchi.stage_code == stage:
+                    break
+                events.append({
+                    "event": "blockagotchi_evolved",
+                    "user_id": blockagotchi.owner,
+                    "blockagotchi_id": blockagotchi_id,
+                    "stage": blockagotchi.stage,
+                    "type": blockagotchi.type,
+                })
+            self.schedule(blockagotchi)
+        return events
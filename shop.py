@@ -1,4 +1,4 @@
-from typing import Dict
+from typing import Dict, Iterator, List, Optional, Tuple
 
 class Item:
     def __init__(self, item_id: int, name: str, description: str, price: int):
@@ -15,6 +15,57 @@ class Item:
             "price": self.price
         }
 
+class Inventory:
+    """Multiset of shop items: item id -> quantity, in order of first addition."""
+    __slots__ = ("_items", "_counts")
+
+    def __init__(self):
+        self._items: Dict[int, Item] = {}
+        self._counts: Dict[int, int] = {}
+
+    def __len__(self) -> int:
+        # Number of distinct items
+        return len(self._counts)
+
+    def __contains__(self, item_id: int) -> bool:
+        return item_id in self._counts
+
+    def get(self, item_id: int) -> Optional[Item]:
+        return self._items.get(item_id)
+
+    def count(self, item_id: int) -> int:
+        return self._counts.get(item_id, 0)
+
+    def entries(self) -> Iterator[Tuple[Item, int]]:
+        for item_id, quantity in self._counts.items():
+            yield self._items[item_id], quantity
+
+    def add(self, item: Item, quantity: int = 1) -> None:
+        self._items[item.item_id] = item
+        self._counts[item.item_id] = self._counts.get(item.item_id, 0) + quantity
+
+    def remove(self, item_id: int, quantity: int = 1) -> Optional[Item]:
+        """Take ``quantity`` of an item out; returns None, removing nothing, if there are fewer."""
+        count = self._counts.get(item_id, 0)
+        if count < quantity or quantity < 1:
+            return None
+        item = self._items[item_id]
+        if count == quantity:
+            del self._counts[item_id]
+            del self._items[item_id]
+        else:
+            self._counts[item_id] = count - quantity
+        return item
+
+    def copy(self) -> "Inventory":
+        inventory = Inventory()
+        inventory._items = dict(self._items)
+        inventory._counts = dict(self._counts)
+        return inventory
+
+    def to_list(self) -> List[Dict[str, any]]:
+        return [dict(item.to_dict(), quantity=quantity) for item, quantity in self.entries()]
+
 class Shop:
     def __init__(self):
         self.items = {}
@@ -0,0 +1,373 @@
+"""Versioned binary snapshots of the GlobalState.
+
+Layout: header (magic, format version, input index), body, SHA-256 of the
+body. The body is a canonical encoding of the state: strings are interned
+in a table and referenced by index, blockagotchis are fixed-size packed
+records followed by their arrays, and users and wallet accounts are sorted
+by address. The body digest therefore identifies the logical state, and a
+restored node can prove it matches the live one by comparing digests.
+
+The activity history is not copied into snapshots. The body holds its
+length and chain hash, and every blockagotchi its newest record and record
+count, so a restore adopts that many records from the history store, which
+must hold at least as many, without reading them.
+"""
+from array import array
+import hashlib
+import json
+import os
+import struct
+import sys
+from typing import Dict, List, Optional, Tuple
+
+from blockagotchi import BlockaGotchi, WalkWindow, DIET_FOODS
+from cartesi_wallet.balance import Balance
+from history import HistoryError
+from shop import Inventory
+from user import User
+
+MAGIC = b"BGSN"
+VERSION = 7
+HEADER = struct.Struct("<4sHq")
+DIGEST_SIZE = 32
+
+COUNT = struct.Struct("<I")
+PET = struct.Struct("<IIIqiBBBBqqqq?q" + "I" * len(DIET_FOODS) + "IIIHqqI")
+USER = struct.Struct("<IIHq")
+STATE_VERSION = struct.Struct("<q")
+HISTORY = struct.Struct("<q32s")
+ACCOUNT = struct.Struct("<IHH")
+BOARD = struct.Struct("<qIqI")
+STANDING = struct.Struct("<Iq")
+
+class SnapshotError(Exception):
+    pass
+
+def pack_uint(value: int) -> bytes:
+    data = value.to_bytes((value.bit_length() + 7) // 8, "big")
+    return bytes((len(data),)) + data
+
+def pack_inventory(inventory: Inventory) -> bytes:
+    # Item ids followed by their quantities
+    entries = list(inventory.entries())
+    return pack_array(array("H", [item.item_id for item, _ in entries])) + pack_array(array("I", [quantity for _, quantity in entries]))
+
+def pack_array(values: array) -> bytes:
+    if sys.byteorder == "big":
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+class Writer:
+    def __init__(self):
+        self.chunks: List[bytes] = []
+        self.strings: Dict[str, int] = {}
+
+    def intern(self, s: str) -> int:
+        index = self.strings.get(s)
+        if index is None:
+            index = self.strings[s] = len(self.strings)
+        return index
+
+    def write(self, data: bytes) -> None:
+        self.chunks.append(data)
+
+    def count(self, n: int) -> None:
+        self.chunks.append(COUNT.pack(n))
+
+class Reader:
+    def __init__(self, data: bytes):
+        self.data = memoryview(data)
+        self.offset = 0
+        self.strings: List[str] = []
+
+    def unpack(self, layout: struct.Struct) -> tuple:
+        values = layout.unpack_from(self.data, self.offset)
+        self.offset += layout.size
+        return values
+
+    def count(self) -> int:
+        return self.unpack(COUNT)[0]
+
+    def uint(self) -> int:
+        size = self.data[self.offset]
+        value = int.from_bytes(self.data[self.offset + 1:self.offset + 1 + size], "big")
+        self.offset += 1 + size
+        return value
+
+    def array(self, typecode: str, n: int) -> array:
+        values = array(typecode)
+        end = self.offset + n * values.itemsize
+        values.frombytes(self.data[self.offset:end])
+        if sys.byteorder == "big":
+            values.byteswap()
+        self.offset = end
+        return values
+
+    def inventory(self, n: int, shop) -> Inventory:
+        inventory = Inventory()
+        item_ids = self.array("H", n)
+        for item_id, quantity in zip(item_ids, self.array("I", n)):
+            inventory.add(shop.get_item(item_id), quantity)
+        return inventory
+
+def dump_state(state: dict) -> bytes:
+    """Canonical body encoding of the state; its SHA-256 is the state digest."""
+    writer = Writer()
+
+    history = state["history"]
+    writer.write(COUNT.pack(state["global_eggs"]) + COUNT.pack(state["next_blockagotchi_id"]) + STATE_VERSION.pack(state["changes"].version))
+    writer.write(HISTORY.pack(len(history), history.chain))
+
+    blockagotchis = sorted(state["blockagotchis"].values(), key=lambda blockagotchi: blockagotchi.id)
+    writer.count(len(blockagotchis))
+    for blockagotchi in blockagotchis:
+        window = blockagotchi.walk_window
+        writer.write(PET.pack(
+            blockagotchi.id, writer.intern(blockagotchi.owner), writer.intern(blockagotchi.name),
+            blockagotchi.birth_time, blockagotchi.age,
+            blockagotchi.stage_code, blockagotchi.type_code, blockagotchi.biotype_code, blockagotchi.condition_code,
+            blockagotchi.happiness, blockagotchi.last_fed_time,
+            blockagotchi.last_walk_time, blockagotchi.last_bath_time,
+            blockagotchi.alive, blockagotchi.overall_score, *blockagotchi.diet_counts,
+            window.last_day, window.total, blockagotchi.feed_count, len(blockagotchi.items), blockagotchi.version,
+            blockagotchi.history_head, blockagotchi.history_count,
+        ))
+        writer.write(pack_array(window.counts))
+        writer.write(pack_inventory(blockagotchi.items))
+
+    users = sorted(state["users"].values(), key=lambda user: user.id)
+    writer.count(len(users))
+    for user in users:
+        writer.write(USER.pack(writer.intern(user.id), user.blockagotchi.id if user.blockagotchi else 0, len(user.items), user.version))
+        writer.write(pack_inventory(user.items))
+
+    # Windows of each leaderboard and their standings in rank order; -1 for no window
+    for board in state["leaderboards"].boards.values():
+        standings = board.top(0, None)
+        writer.write(BOARD.pack(
+            -1 if board.window is None else board.window, len(standings),
+            -1 if board.final_window is None else board.final_window, len(board.final),
+        ))
+        for user_id, points in standings + board.final:
+            writer.write(STANDING.pack(writer.intern(user_id), points))
+
+    # Reading a balance creates an empty account, so only non-empty accounts
+    # are part of the state.
+    accounts = []
+    for address, balance in sorted(state["wallet"]._accounts.items()):
+        erc721 = {token: ids for token, ids in balance._erc721.items() if ids}
+        if balance._ether or any(balance._erc20.values()) or erc721:
+            accounts.append((address, balance, erc721))
+    writer.count(len(accounts))
+    for address, balance, erc721 in accounts:
+        writer.write(ACCOUNT.pack(writer.intern(address), len(balance._erc20), len(erc721)))
+        writer.write(pack_uint(balance._ether))
+        for token, amount in sorted(balance._erc20.items()):
+            writer.count(writer.intern(token))
+            writer.write(pack_uint(amount))
+        for token, ids in sorted(erc721.items()):
+            writer.write(COUNT.pack(writer.intern(token)) + COUNT.pack(len(ids)))
+            writer.write(b"".join(pack_uint(token_id) for token_id in sorted(ids)))
+
+    tokens = json.dumps(state["tokens"], sort_keys=True).encode("utf-8")
+    writer.write(COUNT.pack(len(tokens)) + tokens)
+
+    strings = [COUNT.pack(len(writer.strings))]
+    for s in writer.strings:
+        data = s.encode("utf-8")
+        strings.append(COUNT.pack(len(data)) + data)
+    return b"".join(strings + writer.chunks)
+
+def state_digest(state: dict) -> str:
+    return hashlib.sha256(dump_state(state)).hexdigest()
+
+def write_snapshot(path: str, state: dict, input_index: int) -> str:
+    """Atomically write a snapshot taken after ``input_index``; returns its digest."""
+    state["history"].persist()
+    body = dump_state(state)
+    digest = hashlib.sha256(body).digest()
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as file:
+        file.write(HEADER.pack(MAGIC, VERSION, input_index))
+        file.write(body)
+        file.write(digest)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_path, path)
+    return digest.hex()
+
+def read_snapshot(path: str) -> Tuple[bytes, int, str]:
+    with open(path, "rb") as file:
+        data = file.read()
+    if len(data) < HEADER.size + DIGEST_SIZE:
+        raise SnapshotError(f"Snapshot '{path}' is truncated")
+    magic, version, input_index = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise SnapshotError(f"'{path}' is not a blockagotchi snapshot")
+    if version != VERSION:
+        raise SnapshotError(f"Snapshot '{path}' has unsupported version {version}")
+    body, digest = data[HEADER.size:-DIGEST_SIZE], data[-DIGEST_SIZE:]
+    if hashlib.sha256(body).digest() != digest:
+        raise SnapshotError(f"Snapshot '{path}' failed its integrity check")
+    return body, input_index, digest.hex()
+
+def restore_state(state: dict, body: bytes, verify: bool = False) -> None:
+    """Replace the contents of ``state`` in place with the decoded body.
+
+    With ``verify`` the adopted activity history is read back and checked
+    against the body.
+    """
+    reader = Reader(body)
+    for _ in range(reader.count()):
+        size = reader.count()
+        reader.strings.append(bytes(reader.data[reader.offset:reader.offset + size]).decode("utf-8"))
+        reader.offset += size
+    strings = reader.strings
+    shop = state["shop"]
+
+    global_eggs, next_blockagotchi_id = reader.count(), reader.count()
+    version = reader.unpack(STATE_VERSION)[0]
+    history_length, history_chain = reader.unpack(HISTORY)
+
+    blockagotchis: Dict[int, BlockaGotchi] = {}
+    for _ in range(reader.count()):
+        values = reader.unpack(PET)
+        (blockagotchi_id, owner, name, birth_time, age, stage_code, type_code, biotype_code, condition_code,
+         happiness, last_fed_time, last_walk_time, last_bath_time, alive, overall_score) = values[:15]
+        diet_counts = values[15:15 + len(DIET_FOODS)]
+        (walk_last_day, walk_total, feed_count, item_count, blockagotchi_version,
+         history_head, history_count) = values[15 + len(DIET_FOODS):]
+
+        blockagotchi = BlockaGotchi.__new__(BlockaGotchi)
+        blockagotchi.id = blockagotchi_id
+        blockagotchi.owner = strings[owner]
+        blockagotchi.name = strings[name]
+        blockagotchi.birth_time = birth_time
+        blockagotchi.age = age
+        blockagotchi.stage_code = stage_code
+        blockagotchi.type_code = type_code
+        blockagotchi.biotype_code = biotype_code
+        blockagotchi.condition_code = condition_code
+        blockagotchi.happiness = happiness
+        blockagotchi.last_fed_time = last_fed_time
+        blockagotchi.last_walk_time = last_walk_time
+        blockagotchi.last_bath_time = last_bath_time
+        blockagotchi.alive = alive
+        blockagotchi.overall_score = overall_score
+        blockagotchi.diet_counts = array("I", diet_counts)
+        blockagotchi.feed_count = feed_count
+        window = WalkWindow()
+        window.counts = reader.array("I", WalkWindow.DAYS)
+        window.last_day = walk_last_day
+        window.total = walk_total
+        blockagotchi.walk_window = window
+        blockagotchi.items = reader.inventory(item_count, shop)
+        blockagotchi.version = blockagotchi_version
+        blockagotchi.history_head = history_head
+        blockagotchi.history_count = history_count
+        blockagotchi._payload = None
+        blockagotchis[blockagotchi_id] = blockagotchi
+
+    users: Dict[str, User] = {}
+    for _ in range(reader.count()):
+        address, blockagotchi_id, item_count, user_version = reader.unpack(USER)
+        user = User(strings[address])
+        if blockagotchi_id:
+            user.add_blockagotchi(blockagotchis[blockagotchi_id])
+        user.items = reader.inventory(item_count, shop)
+        user.version = user_version
+        users[user.id] = user
+
+    boards = []
+    for _ in state["leaderboards"].boards:
+        window, count, final_window, final_count = reader.unpack(BOARD)
+        standings = [reader.unpack(STANDING) for _ in range(count)]
+        final = [(strings[user_id], points) for user_id, points in (reader.unpack(STANDING) for _ in range(final_count))]
+        boards.append((window, standings, final_window, final))
+
+    accounts: Dict[str, Balance] = {}
+    for _ in range(reader.count()):
+        address, erc20_count, erc721_count = reader.unpack(ACCOUNT)
+        ether = reader.uint()
+        erc20 = {}
+        for _ in range(erc20_count):
+            token = strings[reader.count()]
+            erc20[token] = reader.uint()
+        erc721 = {}
+        for _ in range(erc721_count):
+            token, ids = strings[reader.count()], reader.count()
+            erc721[token] = {reader.uint() for _ in range(ids)}
+        accounts[strings[address]] = Balance(strings[address], ether, erc20, erc721)
+
+    size = reader.count()
+    tokens = json.loads(bytes(reader.data[reader.offset:reader.offset + size]).decode("utf-8"))
+    reader.offset += size
+    if reader.offset != len(body):
+        raise SnapshotError("Snapshot has trailing data")
+
+    history = state["history"]
+    try:
+        history.restore(history_length, history_chain, blockagotchis, verify)
+    except HistoryError as error:
+        raise SnapshotError(f"Cannot restore the activity history. {error}") from None
+
+    state["global_eggs"] = global_eggs
+    state["next_blockagotchi_id"] = next_blockagotchi_id
+    state["blockagotchis"].clear()
+    state["blockagotchis"].update(blockagotchis)
+    state["users"].clear()
+    state["users"].update(users)
+    state["tokens"].clear()
+    state["tokens"].update(tokens)
+    state["wallet"]._accounts.clear()
+    state["wallet"]._accounts.update(accounts)
+    ranking = state["ranking"]
+    scheduler = state["scheduler"]
+    columns = state["columns"]
+    indexes = state["indexes"]
+    ranking.clear()
+    scheduler.clear()
+    columns.clear()
+    indexes.clear()
+    for blockagotchi in blockagotchis.values():
+        ranking.add(blockagotchi)
+        scheduler.schedule(blockagotchi)
+        columns.add(blockagotchi)
+        indexes.add(blockagotchi)
+    for board, (window, standings, final_window, final) in zip(state["leaderboards"].boards.values(), boards):
+        board.clear()
+        board.window = None if window < 0 else window
+        for user_id, points in standings:
+            board.ranking.set(strings[user_id], points)
+        board.final_window = None if final_window < 0 else final_window
+        board.final = final
+    state["changes"].clear(version)
+    state["changes"].add(list(blockagotchis.values()), list(users.values()))
+    state["merkle"].rebuild(state)
+
+def load_snapshot(path: str, state: dict, verify: bool = True) -> int:
+    """Restore ``state`` from a snapshot and return the input index it was taken at.
+
+    With ``verify`` the activity history is checked against the snapshot, and
+    the restored state is encoded again and its digest must match the one
+    recorded by the live node.
+    """
+    body, input_index, digest = read_snapshot(path)
+    restore_state(state, body, verify)
+    if verify and state_digest(state) != digest:
+        raise SnapshotError(f"State restored from '{path}' does not match the snapshot digest")
+    return input_index
+
+def latest_snapshot(directory: str, at_most: Optional[int] = None) -> Optional[str]:
+    """Path of the newest snapshot, or of the newest one taken at or before input ``at_most``."""
+    if not os.path.isdir(directory):
+        return None
+    snapshots = sorted(
+        name for name in os.listdir(directory)
+        if name.endswith(".snapshot") and (at_most is None or int(name[:-len(".snapshot")]) <= at_most)
+    )
+    return os.path.join(directory, snapshots[-1]) if snapshots else None
+
+def snapshot_path(directory: str, input_index: int) -> str:
+    return os.path.join(directory, f"{input_index:012d}.snapshot")
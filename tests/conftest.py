@@ -0,0 +1,103 @@
+"""Drive the advance and inspect handlers in process, without a rollup server."""
+import json
+import os
+import sys
+from typing import List, Optional, Union
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "handlers", "advance"), os.path.join(ROOT, "handlers", "inspect"), os.path.join(ROOT, "bench")]
+
+import pytest
+from cartesi_wallet import wallet
+
+from advance_handler import AdvanceHandler
+from blockagotchi import BlockaGotchi, set_input_time
+from inspect_handler import InspectHandler
+from rollup_client import OfflineRollupClient
+from user import GlobalState, User
+
+ETHER_PORTAL_ADDRESS = "0xFfdbe43d4c855BF7e0f105c400A50857f53AB044"
+DAO_ADDRESS = "0x0000000000000000000000000000000000000000"
+START_TIMESTAMP = 1700000000
+ONE_ETHER = 10 ** 18
+
+def account(index: int) -> str:
+    return "0x%040x" % (index + 1)
+
+def decode(payload: str):
+    text = bytes.fromhex(payload[2:]).decode("utf-8")
+    return json.loads(text)
+
+class RecordingRollupClient(OfflineRollupClient):
+    """Keeps the decoded notices and reports of the last input."""
+    def __init__(self):
+        super().__init__()
+        self.notices: List = []
+        self.reports: List = []
+
+    def clear(self) -> None:
+        self.notices, self.reports = [], []
+
+    def flush(self) -> bool:
+        for endpoint, body in self.pending:
+            (self.notices if endpoint == "notice" else self.reports).append(decode(body["payload"]))
+        return super().flush()
+
+class Dapp:
+    def __init__(self):
+        self.rollup = RecordingRollupClient()
+        self.advance_handler = AdvanceHandler(self.rollup, ETHER_PORTAL_ADDRESS, DAO_ADDRESS)
+        self.inspect_handler = InspectHandler(self.rollup)
+        self.state = GlobalState().get_state()
+        self.inputs: List[dict] = []
+        self.timestamp = START_TIMESTAMP
+
+    def advance(self, sender: str, payload: Union[dict, str], timestamp: Optional[int] = None) -> str:
+        """Handle one advance input; a dict payload is sent as JSON."""
+        if isinstance(payload, dict):
+            payload = "0x" + json.dumps(payload).encode("utf-8").hex()
+        self.timestamp = self.timestamp + 60 if timestamp is None else timestamp
+        data = {
+            "metadata": {
+                "msg_sender": sender,
+                "epoch_index": 0,
+                "input_index": len(self.inputs),
+                "block_number": len(self.inputs),
+                "timestamp": self.timestamp,
+            },
+            "payload": payload,
+        }
+        self.inputs.append(data)
+        self.rollup.clear()
+        status = self.advance_handler.handle(data)
+        self.rollup.flush()
+        return status
+
+    def deposit(self, sender: str, amount: int = ONE_ETHER) -> str:
+        return self.advance(ETHER_PORTAL_ADDRESS, "0x" + bytes.fromhex(sender[2:]).hex() + amount.to_bytes(32, "big").hex())
+
+    def create(self, sender: str, name: str = "Gottito") -> str:
+        self.deposit(sender)
+        return self.advance(sender, {"action": "create_blockagotchi", "name": name})
+
+    def inspect(self, path: str) -> list:
+        """Reports of one inspect request."""
+        self.rollup.clear()
+        self.inspect_handler.handle({"payload": "0x" + path.encode("utf-8").hex()})
+        self.rollup.flush()
+        return self.rollup.reports
+
+def reset_state() -> None:
+    """Drop the global state, its listeners and the wallet balances."""
+    GlobalState._instance = None
+    BlockaGotchi.score_listeners.clear()
+    BlockaGotchi.change_listeners.clear()
+    User.change_listeners.clear()
+    wallet._accounts.clear()
+    set_input_time(None)
+
+@pytest.fixture
+def dapp() -> Dapp:
+    reset_state()
+    yield Dapp()
+    reset_state()
@@ -0,0 +1,21 @@
+from conftest import account
+
+ALICE = account(0)
+
+def test_remove_item_reject_is_reported(dapp):
+    dapp.create(ALICE)
+    assert dapp.advance(ALICE, {"action": "remove_item", "item_id": 1}) == "reject"
+    assert dapp.rollup.reports == [f"User {ALICE} got an error while trying to remove item 1"]
+
+def test_buy_unknown_item_is_reported(dapp):
+    dapp.create(ALICE)
+    assert dapp.advance(ALICE, {"action": "buy_item", "item_id": 99}) == "reject"
+    assert dapp.rollup.reports == ["Item 99 is not sold in the shop."]
+
+def test_batch_reject_names_the_failed_action(dapp):
+    dapp.create(ALICE)
+    actions = [{"action": "feed_blockagotchi", "food_type": "fish"}, {"action": "remove_item", "item_id": 1}]
+    assert dapp.advance(ALICE, {"action": "batch", "actions": actions}) == "reject"
+    report = dapp.rollup.reports[-1]
+    assert (report["failed_action"], report["action"]) == (1, "remove_item")
+    assert report["error"] == f"User {ALICE} got an error while trying to remove item 1"
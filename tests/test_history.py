@@ -0,0 +1,25 @@
+from conftest import account
+
+ALICE = account(0)
+
+def test_unknown_details_are_not_interned(dapp):
+    dapp.create(ALICE)
+    history = dapp.state["history"]
+    dapp.advance(ALICE, {"action": "feed_blockagotchi", "food_type": "fish"})
+    strings = len(history.strings)
+    for n in range(10):
+        assert dapp.advance(ALICE, {"action": "feed_blockagotchi", "food_type": f"food {n}"}) == "accept"
+        assert dapp.advance(ALICE, {"action": "walk_blockagotchi", "walk_type": f"walk {n}"}) == "accept"
+        assert dapp.advance(ALICE, {"action": "bathe_blockagotchi", "bath_type": f"bath {n}", "is_paid": False}) == "accept"
+    assert len(history.strings) == strings + 1
+    events = dapp.inspect("blockagotchi/1/history?limit=3")[0]["events"]
+    assert [event[key] for event, key in zip(events, ("bath_type", "walk_type", "food_type"))] == ["other"] * 3
+
+def test_food_history(dapp):
+    dapp.create(ALICE)
+    for food_type in ("fish", "Peixe", "meat"):
+        dapp.advance(ALICE, {"action": "feed_blockagotchi", "food_type": food_type})
+        dapp.advance(ALICE, {"action": "walk_blockagotchi", "walk_type": "run"})
+    report = dapp.inspect(f"user_blockagotchi/{ALICE}")[0]
+    assert report["food_history"] == ["fish", "other", "meat"]
+    assert report["feed_count"] == 3
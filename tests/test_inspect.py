@@ -0,0 +1,10 @@
+from conftest import account
+
+from inspect_handler import InspectHandler
+
+def test_ranking_page_limit(dapp, monkeypatch):
+    monkeypatch.setattr(InspectHandler, "MAX_PAGE_LIMIT", 2)
+    for index in range(3):
+        dapp.create(account(index))
+    assert len(dapp.inspect("ranking?limit=100")[0]) == 2
+    assert len(dapp.inspect("ranking")[0]) == 3
@@ -0,0 +1,14 @@
+from journal import OutputJournal
+
+def test_recorded_outputs(tmp_path):
+    outputs = OutputJournal(str(tmp_path))
+    outputs.record(0, "accept", [("notice", {"payload": "0x01"}), ("report", {"payload": "0x02"})])
+    outputs.record(2, "reject", [("report", {"payload": "0x03"})])
+    outputs.close()
+
+    reopened = OutputJournal(str(tmp_path))
+    assert reopened.last_input_index == 2
+    assert reopened.recorded(0) == {"status": "accept", "outputs": [["notice", "0x01"], ["report", "0x02"]]}
+    assert reopened.recorded(1) is None
+    assert reopened.recorded(2) == {"status": "reject", "outputs": [["report", "0x03"]]}
+    assert reopened.recorded(3) is None
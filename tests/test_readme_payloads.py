@@ -0,0 +1,51 @@
+"""The advance payloads documented in README.md, sent as they are written there."""
+import json
+import os
+import re
+
+from conftest import ROOT, account
+
+ALICE = account(0)
+
+def readme_payloads() -> list:
+    with open(os.path.join(ROOT, "README.md"), encoding="utf-8") as file:
+        blocks = re.findall(r"^\{$.*?^\}$", file.read(), re.MULTILINE | re.DOTALL)
+    return [payload for payload in map(json.loads, blocks) if "action" in payload]
+
+def readme_payload(action: str) -> dict:
+    return next(payload for payload in readme_payloads() if payload["action"] == action)
+
+def test_every_payload_is_accepted(dapp):
+    dapp.deposit(ALICE)
+    payloads = readme_payloads()
+    assert [payload["action"] for payload in payloads] == [
+        "create_blockagotchi", "feed_blockagotchi", "walk_blockagotchi", "bathe_blockagotchi",
+        "buy_item", "buy_item", "apply_item", "remove_item", "batch",
+    ]
+    for payload in payloads:
+        assert dapp.advance(ALICE, payload) == "accept", (payload, dapp.rollup.reports)
+        assert dapp.rollup.notices
+
+def test_bathe(dapp):
+    dapp.create(ALICE)
+    happiness = dapp.state["users"][ALICE].blockagotchi.happiness
+    payload = readme_payload("bathe_blockagotchi")
+    assert payload["is_paid"] == "False"
+    assert dapp.advance(ALICE, payload) == "accept"
+    assert dapp.rollup.notices[0]["event"] == "bathe_blockagotchi"
+    # A non-empty string pays, as it did before the history was recorded
+    assert dapp.state["users"][ALICE].blockagotchi.happiness == happiness + 20
+    events = dapp.inspect("blockagotchi/1/history")[0]["events"]
+    assert events[0] == {"time": events[0]["time"], "event": "bath", "bath_type": "normal", "is_paid": True}
+
+def test_feed(dapp):
+    dapp.create(ALICE)
+    assert dapp.advance(ALICE, readme_payload("feed_blockagotchi")) == "accept"
+    assert dapp.rollup.notices[0]["food_type"] == "Peixe"
+    blockagotchi = dapp.state["users"][ALICE].blockagotchi
+    assert blockagotchi.feed_count == 1 and list(blockagotchi.diet_counts) == [0, 0, 0]
+
+def test_walk(dapp):
+    dapp.create(ALICE)
+    assert dapp.advance(ALICE, readme_payload("walk_blockagotchi")) == "accept"
+    assert dapp.inspect("blockagotchi/1/history")[0]["events"][0]["walk_type"] == "corrida"
@@ -0,0 +1,86 @@
+"""Snapshots, rollback, sharded replay and Merkle proofs of the whole state."""
+import random
+
+from conftest import DAO_ADDRESS, ETHER_PORTAL_ADDRESS, Dapp, account, reset_state
+
+import merkle
+from history import HistoryStore
+from sharded_replay import replay_sharded
+from snapshot import load_snapshot, state_digest, write_snapshot
+from user import GlobalState
+
+USERS = [account(index) for index in range(6)]
+DAY = 86400
+
+def populate(dapp: Dapp, inputs: int = 120, seed: int = 1) -> None:
+    """Accepted and rejected care, shop and batch inputs over a few weeks."""
+    rng = random.Random(seed)
+    for user in USERS:
+        dapp.create(user)
+    actions = [
+        lambda: {"action": "feed_blockagotchi", "food_type": rng.choice(("fish", "meat", "vegetal", "Peixe"))},
+        lambda: {"action": "walk_blockagotchi", "walk_type": "run"},
+        lambda: {"action": "bathe_blockagotchi", "bath_type": "normal", "is_paid": rng.random() < 0.5},
+        lambda: {"action": "buy_item", "item_id": rng.randint(1, 8), "quantity": rng.randint(1, 3)},
+        lambda: {"action": "apply_item", "item_id": rng.randint(1, 7)},
+        lambda: {"action": "remove_item", "item_id": rng.randint(1, 7)},
+        lambda: {"action": "create_blockagotchi", "name": "again"},
+        lambda: {"action": "batch", "actions": [{"action": "feed_blockagotchi", "food_type": "fish"},
+                                                {"action": "buy_item", "item_id": rng.randint(1, 9)}]},
+    ]
+    for _ in range(inputs):
+        dapp.advance(rng.choice(USERS), rng.choice(actions)(), dapp.timestamp + rng.randint(0, DAY // 2))
+
+def test_snapshot_round_trip(dapp, tmp_path):
+    dapp.state["history"] = HistoryStore(str(tmp_path / "history"))
+    populate(dapp)
+    path = str(tmp_path / "snapshot")
+    digest = write_snapshot(path, dapp.state, len(dapp.inputs) - 1)
+    assert digest == state_digest(dapp.state)
+    root = dapp.state["merkle"].root()
+
+    reset_state()
+    state = GlobalState().get_state()
+    state["history"] = HistoryStore(str(tmp_path / "history"))
+    assert load_snapshot(path, state) == len(dapp.inputs) - 1
+    assert state_digest(state) == digest
+    assert state["merkle"].root() == root
+
+def test_rejected_input_is_rolled_back(dapp):
+    populate(dapp)
+    digest, root, history = state_digest(dapp.state), dapp.state["merkle"].root(), len(dapp.state["history"])
+    rejected = [
+        # Each one is far enough in the future to age every blockagotchi first
+        (account(99), {"action": "create_blockagotchi", "name": "broke"}),
+        (USERS[0], {"action": "batch", "actions": [{"action": "feed_blockagotchi", "food_type": "fish"},
+                                                   {"action": "remove_item", "item_id": 99}]}),
+        (USERS[1], {"action": "buy_item", "item_id": 1, "quantity": 1001}),
+        (USERS[2], {"action": "unknown"}),
+    ]
+    for sender, payload in rejected:
+        assert dapp.advance(sender, payload, dapp.timestamp + 3 * DAY) == "reject"
+        assert state_digest(dapp.state) == digest
+        assert dapp.state["merkle"].root() == root
+        assert len(dapp.state["history"]) == history
+
+def test_sharded_replay_matches_sequential(dapp):
+    populate(dapp)
+    digest = state_digest(dapp.state)
+    records = [(data["metadata"]["input_index"], data) for data in dapp.inputs]
+
+    reset_state()
+    report = replay_sharded(records, 3, ETHER_PORTAL_ADDRESS, DAO_ADDRESS, verify=True)
+    assert report["digest"] == report["sequential_digest"] == digest
+
+def test_state_proof(dapp):
+    populate(dapp, inputs=40)
+    root = dapp.inspect("state_root")[0]
+    for kind, key in (("blockagotchi", 1), ("user", USERS[0]), ("account", USERS[0])):
+        proof = dapp.inspect(f"state_proof/{kind}/{key}")[0]
+        assert proof["root"] == root["root"] and proof["roots"] == root["roots"]
+        value = bytes.fromhex(proof["value"][2:])
+        siblings = [bytes.fromhex(sibling[2:]) for sibling in proof["siblings"]]
+        assert merkle.verify(key, value, siblings, bytes.fromhex(proof["roots"][kind][2:]))
+        assert not merkle.verify(key, value + b"\x00", siblings, bytes.fromhex(proof["roots"][kind][2:]))
+    roots = b"".join(bytes.fromhex(root["roots"][kind][2:]) for kind in ("blockagotchi", "user", "account"))
+    assert "0x" + merkle.sha256(roots).hex() == root["root"]
@@ -1,46 +1,68 @@
-from typing import Optional, Dict, List
+from typing import Callable, Optional, Dict, List
 from blockagotchi import BlockaGotchi
 from cartesi_wallet import wallet as Wallet
-from shop import Item, Shop
+from shop import Inventory, Item, Shop
+from ranking import RankingIndex
+from scheduler import DeadlineScheduler
+from columns import PopulationColumns
+from indexes import PetIndexes
+from changes import ChangeLog
+from leaderboards import CareLeaderboards
+from history import HistoryStore
+from merkle import StateCommitment
 
 class User:
+    # Called with the user whenever its blockagotchi or items change
+    change_listeners: List[Callable[["User"], None]] = []
+
     def __init__(self, user_id: str):
         self.id = user_id
         self.blockagotchi: Optional[BlockaGotchi] = None
-        self.items: List[Item] = []
+        self.items = Inventory()
+        # State version of the last change, see changes.ChangeLog
+        self.version = 0
+
+    def mark_changed(self) -> None:
+        for listener in self.change_listeners:
+            listener(self)
 
     def add_blockagotchi(self, blockagotchi: BlockaGotchi) -> None:
         self.blockagotchi = blockagotchi
+        self.mark_changed()
 
     def get_blockagotchi(self) -> Optional[BlockaGotchi]:
         return self.blockagotchi
 
     def remove_blockagotchi(self) -> None:
         self.blockagotchi = None
+        self.mark_changed()
 
-    def add_item(self, item: Item) -> None:
-        self.items.append(item)
+    def add_item(self, item: Item, quantity: int = 1) -> None:
+        self.items.add(item, quantity)
+        self.mark_changed()
 
-    def get_items(self) -> List[Item]:
+    def get_items(self) -> Inventory:
         return self.items
 
     def apply_item_to_blockagotchi(self, item_id: int) -> bool:
-        if self.blockagotchi:
-            item = next((item for item in self.items if item.item_id == item_id), None)
-            if item and item not in self.blockagotchi.items:
-                self.blockagotchi.add_item(item)
-                self.blockagotchi.happiness += item.price
-                self.items.remove(item)
-                return True
+        if self.blockagotchi and item_id in self.items and item_id not in self.blockagotchi.items:
+            item = self.items.remove(item_id)
+            self.blockagotchi.add_item(item)
+            self.blockagotchi.happiness += item.price
+            self.blockagotchi.mark_dirty()
+            self.mark_changed()
+            return True
         return False
     
     def remove_item_from_blockagotchi(self, item_id: int) -> bool:
         if self.blockagotchi:
-            item = next((item for item in self.blockagotchi.items if item.item_id == item_id), None)
+            item = self.blockagotchi.items.get(item_id)
             if item:
                 self.blockagotchi.remove_item(item)
                 self.blockagotchi.happiness -= item.price
-                self.items.append(item)
+                self.blockagotchi.mark_dirty()
+                self.items.add(item)
+                self.mark_changed()
                 return True
         return False
 
@@ -48,7 +70,7 @@ class User:
         return {
             "id": self.id,
             "blockagotchi": self.blockagotchi.to_dict() if self.blockagotchi else None,
-            "items": [item.to_dict() for item in self.items]
+            "items": self.items.to_list()
         }
 
 class GlobalState:
@@ -57,11 +79,32 @@ class GlobalState:
     def __new__(cls):
         if cls._instance is None:
             cls._instance = super(GlobalState, cls).__new__(cls)
+            ranking = RankingIndex()
+            BlockaGotchi.score_listeners.append(ranking.update)
+            columns = PopulationColumns()
+            BlockaGotchi.change_listeners.append(columns.touch)
+            indexes = PetIndexes()
+            BlockaGotchi.change_listeners.append(indexes.update)
+            changes = ChangeLog()
+            BlockaGotchi.change_listeners.append(changes.touch_blockagotchi)
+            User.change_listeners.append(changes.touch_user)
+            merkle = StateCommitment()
+            BlockaGotchi.change_listeners.append(merkle.touch_blockagotchi)
+            User.change_listeners.append(merkle.touch_user)
             cls._instance.state = {
                 "blockagotchis": {},
+                "ranking": ranking,
+                "scheduler": DeadlineScheduler(),
+                "columns": columns,
+                "indexes": indexes,
+                "changes": changes,
+                "leaderboards": CareLeaderboards(),
+                "history": HistoryStore(),
+                "merkle": merkle,
                 "users": {},
                 "tokens": {},
                 "global_eggs": 0,
+                "next_blockagotchi_id": 1,
                 "wallet": Wallet,
                 "shop": Shop()
             }